@@ -0,0 +1,616 @@
+"""
+Request parsing and response shaping shared by the Flask app (app.py) and the
+async ASGI app (asgi_app.py), so both serve exactly the same API
+
+The routes of both apps only do the Redis I/O: the parse_* functions read a
+request and raise ApiError when it is rejected, the *_response functions
+build the (body, status[, headers]) tuple both frameworks turn into JSON.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+from assessment_format import blob_json, decode_assessment, is_blob, stored_fields
+from assessment_index import parse_assessment_key
+from assessment_scores import parse_aggregate_args
+from lab_series import (
+    LAB_NAMES,
+    check_setup_results,
+    is_timeseries_missing_error,
+    madd_command,
+    parse_mrange,
+    parse_points,
+    parse_range_args,
+    parse_samples,
+    series_setup_commands,
+)
+from medications import (
+    is_search_missing_error,
+    parse_medication_names,
+    parse_search_result,
+    search_query,
+    validate_slot,
+)
+from retention import DISCHARGED_FIELD, parse_discharge
+from risk_model import parse_risk_request
+
+# Pagination of the assessment history
+DEFAULT_PAGE_SIZE = int(os.getenv('ASSESSMENT_PAGE_SIZE', 200))
+MAX_PAGE_SIZE = int(os.getenv('ASSESSMENT_MAX_PAGE_SIZE', 1000))
+
+# Upper bound of patients x assessments served by one ward snapshot
+MAX_SNAPSHOT_CELLS = int(os.getenv('WARD_SNAPSHOT_MAX_CELLS', 5000))
+
+# Read cache, a size or TTL of 0 disables it
+READ_CACHE_MAXSIZE = int(os.getenv('READ_CACHE_MAXSIZE', 10000))
+READ_CACHE_TTL = float(os.getenv('READ_CACHE_TTL', 5))
+# Announce writes to the other workers via Redis pub/sub; on by default in
+# write-behind mode, where the writes are applied by another process
+READ_CACHE_PUBSUB = os.getenv('READ_CACHE_PUBSUB', os.getenv('WRITE_BEHIND', '0')) == '1'
+
+
+def create_timestamp():
+    """Generate both Unix and human-readable timestamps"""
+    unix_ts = int(time.time())
+    return unix_ts, human_timestamp(unix_ts)
+
+
+def human_timestamp(unix_ts):
+    """Format a Unix timestamp the way it appears in assessment keys"""
+    return datetime.fromtimestamp(unix_ts).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def latest_payload(latest_key, raw_data, decode_json=True):
+    """Build the body returned for a latest assessment"""
+    parsed_key = parse_assessment_key(latest_key)
+    if parsed_key is not None:
+        _, _, unix_timestamp, human_readable = parsed_key
+    else:
+        unix_timestamp, human_readable = 0, "Unknown"
+
+    return {
+        'timestamp': human_readable,
+        'unix_timestamp': unix_timestamp,
+        'data': decode_assessment(raw_data) if decode_json else stored_fields(raw_data),
+        'key': latest_key
+    }
+
+
+def latest_payload_json(latest_key, raw_data):
+    """
+    Serialize the body of a latest assessment stored as a blob, splicing the
+    stored JSON document in without parsing it.
+
+    Returns:
+        str: The JSON body, or None for records in the hash format.
+    """
+    if not is_blob(raw_data):
+        return None
+    envelope = latest_payload(latest_key, {}, decode_json=False)
+    del envelope['data']
+    return '{"data":' + blob_json(raw_data) + ',' + json.dumps(envelope)[1:]
+
+
+def all_data_entry(key, data):
+    """Build the entry of one key in the /all response"""
+    key_parts = key.split(':')
+    if len(key_parts) >= 4:  # If key contains timestamp information
+        unix_timestamp = key_parts[2]
+        human_timestamp = key_parts[3]
+        return {
+            'data': data,
+            'timestamp': human_timestamp,
+            'unix_timestamp': unix_timestamp
+        }
+    return data
+
+
+def parse_page_args(args):
+    """
+    Read the pagination parameters from the query string.
+
+    Supported query parameters: limit, cursor, since, until (unix timestamps)
+    and assessment_name.
+
+    Returns:
+        dict: Keyword arguments for assessment_page.
+
+    Raises:
+        ValueError: If one of the parameters is malformed.
+    """
+    limit = args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    since = args.get('since')
+    until = args.get('until')
+    if limit is None or not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    return {
+        'assessment_name': args.get('assessment_name'),
+        'limit': limit,
+        'cursor': args.get('cursor'),
+        'since': int(since) if since is not None else None,
+        'until': int(until) if until is not None else None,
+    }
+
+
+def parse_export_args(args):
+    """
+    Read the since and chunk_size query parameters of the export.
+
+    Returns:
+        tuple: (since, chunk_size), None where a parameter is omitted.
+
+    Raises:
+        ValueError: If one of the parameters is malformed.
+    """
+    since = args.get('since')
+    chunk_size = args.get('chunk_size')
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        raise ValueError('since must be a unix timestamp')
+    try:
+        chunk_size = int(chunk_size) if chunk_size is not None else None
+    except ValueError:
+        raise ValueError('chunk_size must be an integer')
+    if chunk_size is not None and chunk_size <= 0:
+        raise ValueError('chunk_size must be positive')
+    return since, chunk_size
+
+
+def parse_snapshot_request(method, payload, args):
+    """
+    Read the patients and assessment names of a ward snapshot request.
+
+    Returns:
+        tuple: (patient_ids, assessment_names)
+
+    Raises:
+        ValueError: If either list is missing or the matrix is too large.
+    """
+    if method == 'POST':
+        payload = payload or {}
+        patient_ids = payload.get('patients') or []
+        assessment_names = payload.get('assessments') or []
+    else:
+        patient_ids = [p for p in args.get('patients', '').split(',') if p]
+        assessment_names = [a for a in args.get('assessments', '').split(',') if a]
+
+    if not isinstance(patient_ids, list) or not isinstance(assessment_names, list) \
+            or not patient_ids or not assessment_names:
+        raise ValueError('Invalid input')
+    if len(patient_ids) * len(assessment_names) > MAX_SNAPSHOT_CELLS:
+        raise ValueError(f'At most {MAX_SNAPSHOT_CELLS} patient/assessment pairs per request')
+    return patient_ids, assessment_names
+
+
+def wants_ndjson(args, headers):
+    """Whether the client asked for newline delimited JSON"""
+    return args.get('format') == 'ndjson' or \
+        'application/x-ndjson' in headers.get('Accept', '')
+
+
+def snapshot_row(row):
+    """Shape one patient of a ward snapshot, None for unknown patients"""
+    if row is None:
+        return None
+    return {
+        name: latest_payload(key, data) if key and data else None
+        for name, (key, data) in row.items()
+    }
+
+
+def snapshot_ndjson(matrix):
+    """Yield a ward snapshot as one JSON line per patient"""
+    for patient_id, row in matrix.items():
+        yield json.dumps({
+            'patient_id': patient_id,
+            'assessments': snapshot_row(row)
+        }) + '\n'
+
+
+class ApiError(Exception):
+    """
+    A rejected request, turned into its JSON response by the error handlers
+    of both apps.
+
+    Args:
+        status (int): The HTTP status code.
+        body (dict): The JSON body of the response.
+    """
+
+    def __init__(self, status, body):
+        super().__init__(body.get('error') or body.get('message'))
+        self.status = status
+        self.body = body
+
+    def response(self):
+        return self.body, self.status
+
+
+def invalid_input(details=None, error='Invalid input'):
+    """400 for a malformed request, details is usually the ValueError of a parser"""
+    body = {'error': error}
+    if details is not None:
+        body['details'] = str(details)
+    return ApiError(400, body)
+
+
+def patient_not_found(error='Patient ID does not exist'):
+    """404 for an unknown patient"""
+    return ApiError(404, {'error': error})
+
+
+def module_unavailable(module, error):
+    """503 of a route whose Redis module is not loaded"""
+    return ApiError(503, {'error': f'{module} module is not available', 'details': str(error)})
+
+
+def failure_response(error, exception):
+    """500 for a request that failed in Redis, the exception is logged and passed on"""
+    print(f"{error}: {exception}")
+    return {'error': error, 'details': str(exception)}, 500
+
+
+def redis_error_response(error):
+    """
+    Response of a Redis error a route did not handle itself: 503 when the
+    command belongs to a module that is not loaded, 500 otherwise.
+    """
+    if is_timeseries_missing_error(error):
+        return module_unavailable('RedisTimeSeries', error).response()
+    if is_search_missing_error(error):
+        return module_unavailable('RediSearch', error).response()
+    return failure_response('Redis error', error)
+
+
+def paged_response(body, next_cursor, message):
+    """A page of the assessment history, the cursor of the next page goes into X-Next-Cursor"""
+    if not body:
+        return {'message': message}, 404
+    if next_cursor is None:
+        return body, 200
+    return body, 200, {'X-Next-Cursor': next_cursor}
+
+
+# Patients
+
+def parse_new_patient(payload):
+    """The alphanumeric identifier of a patient to create"""
+    identifier = (payload or {}).get('identifier')
+    if not isinstance(identifier, str) or not identifier.isalnum():
+        raise invalid_input()
+    return identifier
+
+
+def patient_exists_error():
+    return ApiError(400, {'error': 'Patient with this ID already exists'})
+
+
+def patient_created_response():
+    return {'message': 'Patient created successfully'}, 201
+
+
+def patient_response(hashmap):
+    if hashmap:
+        return hashmap, 200
+    return {'message': 'Hashmap not found'}, 404
+
+
+def parse_discharge_request(payload):
+    """The discharge date of a discharge request, see retention.parse_discharge"""
+    try:
+        return parse_discharge(payload)
+    except ValueError as e:
+        raise invalid_input(e)
+
+
+def discharged_response(discharge_date):
+    return {'message': 'Patient discharged', DISCHARGED_FIELD: discharge_date}, 200
+
+
+def readmitted_response():
+    return {'message': 'Patient readmitted'}, 200
+
+
+# Assessments
+
+def parse_assessment(payload):
+    """The answers of an assessment to save"""
+    if not payload:
+        raise invalid_input()
+    return payload
+
+
+def saved_response(key, score, unix_timestamp, human_readable):
+    return {
+        'message': 'Assessment saved successfully',
+        'timestamp': human_readable,
+        'unix_timestamp': unix_timestamp,
+        'key': key,
+        'score': score
+    }, 200
+
+
+def queued_response(entry_id, score, unix_timestamp, human_readable):
+    """202 of a save taken over by the write-behind worker"""
+    return {
+        'message': 'Assessment queued',
+        'id': entry_id,
+        'timestamp': human_readable,
+        'unix_timestamp': unix_timestamp,
+        'score': score
+    }, 202
+
+
+def assessment_response(assessment):
+    if assessment:
+        return stored_fields(assessment), 200
+    return {'message': 'Assessment not found'}, 404
+
+
+def parse_page_request(args):
+    """parse_page_args for a route, a malformed parameter is a 400"""
+    try:
+        return parse_page_args(args)
+    except ValueError as e:
+        raise invalid_input(e, 'Invalid pagination parameters')
+
+
+def assessments_response(keys, hashes, next_cursor):
+    """One page of /api/<patient_id>/assessments from the keys and their hashes"""
+    assessments = {key: stored_fields(data) for key, data in zip(keys, hashes) if data}
+    return paged_response(assessments, next_cursor, 'No assessments found')
+
+
+def all_data_response(keys, hashes, next_cursor):
+    """One page of /api/<identifier>/all from the keys and their hashes"""
+    all_data = {key: all_data_entry(key, stored_fields(data)) for key, data in zip(keys, hashes)}
+    return paged_response(all_data, next_cursor, 'No data found for this ID')
+
+
+def latest_response(latest_key, raw_data, decode_json=True, label=None):
+    """
+    Response of the /latest routes from the result of latest_assessment.
+
+    Args:
+        latest_key (str): The key of the latest assessment, None if there is none.
+        raw_data (dict): The stored fields of the latest assessment.
+        decode_json (bool): Parse JSON encoded fields back into objects.
+        label (str): Name of the assessment used in messages.
+    """
+    if latest_key is None:
+        return {'message': f'No {label} assessments found'}, 404
+    if not raw_data:
+        return {'message': 'Latest assessment is empty'}, 404
+
+    if decode_json:
+        # Blob records are passed through without a decode/encode cycle
+        body = latest_payload_json(latest_key, raw_data)
+        if body is not None:
+            return body, 200, {'Content-Type': 'application/json'}
+    return latest_payload(latest_key, raw_data, decode_json), 200
+
+
+def parse_snapshot(method, payload, args):
+    """parse_snapshot_request for a route, a rejected request is a 400"""
+    try:
+        return parse_snapshot_request(method, payload, args)
+    except ValueError as e:
+        raise ApiError(400, {'error': str(e)})
+
+
+def snapshot_response(matrix, args, headers):
+    """The ward snapshot as JSON, or streamed as NDJSON if the client asked for it"""
+    if wants_ndjson(args, headers):
+        return snapshot_ndjson(matrix), 200, {'Content-Type': 'application/x-ndjson'}
+    return {
+        'patients': {patient_id: snapshot_row(row) for patient_id, row in matrix.items()}
+    }, 200
+
+
+# Lab values
+
+def parse_lab(lab):
+    if lab not in LAB_NAMES:
+        raise ApiError(404, {'error': 'Unknown lab value'})
+    return lab
+
+
+def parse_lab_samples(payload):
+    """parse_samples for a route, malformed samples are a 400"""
+    try:
+        return parse_samples(payload)
+    except ValueError as e:
+        raise invalid_input(e)
+
+
+def lab_write_commands(patient_id, lab, samples, new_series):
+    """The commands appending samples, preceded by the series setup for a new series"""
+    commands = list(series_setup_commands(patient_id, lab)) if new_series else []
+    commands.append(madd_command(patient_id, lab, samples))
+    return commands
+
+
+def lab_samples_response(results):
+    """
+    Response of an append from the pipeline results of lab_write_commands.
+
+    Raises:
+        ApiError: 503 if RedisTimeSeries is not loaded.
+        redis.ResponseError: If the series setup failed.
+    """
+    missing = [result for result in results if is_timeseries_missing_error(result)]
+    if missing:
+        raise module_unavailable('RedisTimeSeries', missing[0])
+    check_setup_results(results[:-1])
+
+    timestamps = results[-1]
+    if isinstance(timestamps, Exception):
+        timestamps = [timestamps]
+    errors = [str(result) for result in timestamps if isinstance(result, Exception)]
+    if errors:
+        return {'error': 'Samples rejected', 'details': errors}, 400
+    return {'message': 'Samples added', 'timestamps': timestamps}, 200
+
+
+def parse_lab_range(args):
+    """parse_range_args for a route, malformed parameters are a 400"""
+    try:
+        return parse_range_args(args)
+    except ValueError as e:
+        raise invalid_input(e, 'Invalid range parameters')
+
+
+def parse_ward_lab_request(args):
+    """
+    The patients and time window of /api/ward-labs/<lab>.
+
+    Returns:
+        tuple: (patient_ids, range_args), no patient IDs for all patients.
+    """
+    patient_ids = [p for p in args.get('patients', '').split(',') if p]
+    if not all(p.isalnum() for p in patient_ids):
+        raise invalid_input()
+    return patient_ids, parse_lab_range(args)
+
+
+def lab_series_response(patient_id, lab, range_args, reply):
+    """Response of /api/<patient_id>/labs/<lab> from the TS.RANGE reply"""
+    return {
+        'patient_id': patient_id,
+        'lab': lab,
+        'aggregation': range_args['aggregation'] if range_args['bucket_ms'] else None,
+        'bucket_ms': range_args['bucket_ms'],
+        'points': parse_points(reply),
+    }, 200
+
+
+def lab_range_error(error):
+    """Response of a failed TS.RANGE, which on a missing key means no samples were stored"""
+    if is_timeseries_missing_error(error):
+        return module_unavailable('RedisTimeSeries', error).response()
+    return {'message': 'No lab values found', 'details': str(error)}, 404
+
+
+def ward_labs_response(lab, range_args, reply):
+    """Response of /api/ward-labs/<lab> from the TS.MRANGE reply"""
+    return {
+        'lab': lab,
+        'aggregation': range_args['aggregation'] if range_args['bucket_ms'] else None,
+        'bucket_ms': range_args['bucket_ms'],
+        'patients': parse_mrange(reply),
+    }, 200
+
+
+# Medications
+
+def parse_slot_filter(args):
+    """The optional slot query parameter, None for all slots"""
+    slot = args.get('slot')
+    try:
+        if slot is not None:
+            validate_slot(slot)
+    except ValueError as e:
+        raise ApiError(400, {'error': str(e)})
+    return slot
+
+
+def medications_response(patient_id, result):
+    return {
+        'patient_id': patient_id,
+        'medications': parse_search_result(result),
+    }, 200
+
+
+def parse_medication_plan(slot, payload):
+    """The medication names of a slot to replace"""
+    try:
+        validate_slot(slot)
+        return parse_medication_names(payload)
+    except ValueError as e:
+        raise invalid_input(e)
+
+
+def medications_saved_response(names):
+    return {'message': 'Medications saved', 'count': len(names)}, 200
+
+
+def parse_medication_search(args):
+    """The search query of /api/medication-search, see medications.search_query"""
+    patient_id = args.get('patient')
+    slot = args.get('slot')
+    limit = args.get('limit', 20, type=int)
+    try:
+        if patient_id is not None and not patient_id.isalnum():
+            raise ValueError('patient must be alphanumeric')
+        if slot is not None:
+            validate_slot(slot)
+        if limit is None or not 0 < limit <= 1000:
+            raise ValueError('limit must be between 1 and 1000')
+        return search_query(
+            args.get('q', ''), fuzzy=args.get('fuzzy') == '1',
+            patient_id=patient_id, slot=slot, limit=limit
+        )
+    except ValueError as e:
+        raise invalid_input(e, 'Invalid search parameters')
+
+
+def medication_search_response(result):
+    return {'total': result.total, 'medications': parse_search_result(result)}, 200
+
+
+# Bulk import
+
+def parse_import_batch_size(args):
+    """The optional batch_size query parameter of the bulk import"""
+    batch_size = args.get('batch_size', type=int)
+    if batch_size is not None and batch_size <= 0:
+        raise ApiError(400, {'error': 'batch_size must be positive'})
+    return batch_size
+
+
+def import_failed_response(report):
+    """500 of a bulk import stopped by Redis, with the report of the rows written up to then"""
+    failed = report['failed']
+    print(f"Bulk import failed at line {failed['line']}: {failed['error']}")
+    return {'error': 'Bulk import failed', **report}, 500
+
+
+# Risk scores and aggregates
+
+def require_risk_model(risk_model):
+    if risk_model is None:
+        raise ApiError(503, {'error': 'No risk model configured'})
+
+
+def risk_response(patient_id, score):
+    if score is None:
+        raise patient_not_found()
+    return {'patient_id': patient_id, **score}, 200
+
+
+def parse_risk_patients(method, payload, args):
+    """parse_risk_request for a route, a rejected request is a 400"""
+    try:
+        return parse_risk_request(method, payload, args)
+    except ValueError as e:
+        raise ApiError(400, {'error': str(e)})
+
+
+def risk_stats_response(risk_model, risk_latency, risk_cache):
+    """The loaded risk model, p50/p99 scoring latency and the score cache counters"""
+    return {
+        'model': risk_model.info() if risk_model is not None else None,
+        'latency': risk_latency.stats(),
+        'cache': risk_cache.stats(),
+    }, 200
+
+
+def parse_aggregate_request(args):
+    """parse_aggregate_args for a route, a malformed threshold is a 400"""
+    try:
+        return parse_aggregate_args(args)
+    except ValueError as e:
+        raise ApiError(400, {'error': str(e)})
@@ -3,13 +3,121 @@ Flask REST API for patient assessment management using Redis
 This application provides endpoints for creating, reading, and managing patient assessments
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import redis
+import io
 import os
-from datetime import datetime
 import time
-import json  # Make sure this is at the top with other imports
+import click
+
+from api_common import (
+    READ_CACHE_MAXSIZE,
+    READ_CACHE_PUBSUB,
+    READ_CACHE_TTL,
+    ApiError,
+    all_data_response,
+    assessment_response,
+    assessments_response,
+    create_timestamp,
+    discharged_response,
+    failure_response,
+    import_failed_response,
+    lab_range_error,
+    lab_samples_response,
+    lab_series_response,
+    lab_write_commands,
+    latest_response,
+    medication_search_response,
+    medications_response,
+    medications_saved_response,
+    parse_aggregate_request,
+    parse_assessment,
+    parse_discharge_request,
+    parse_export_args,
+    parse_import_batch_size,
+    parse_lab,
+    parse_lab_range,
+    parse_lab_samples,
+    parse_medication_plan,
+    parse_medication_search,
+    parse_new_patient,
+    parse_page_request,
+    parse_risk_patients,
+    parse_slot_filter,
+    parse_snapshot,
+    parse_ward_lab_request,
+    patient_created_response,
+    patient_exists_error,
+    patient_not_found,
+    patient_response,
+    queued_response,
+    readmitted_response,
+    redis_error_response,
+    require_risk_model,
+    risk_response,
+    risk_stats_response,
+    saved_response,
+    snapshot_response,
+    ward_labs_response,
+)
+from assessment_format import encode_for_storage
+from assessment_index import REDIS_CLUSTER, assessment_page, build_index
+from assessment_scores import (
+    aggregate_score,
+    rebuild_scores,
+    score_aggregates,
+    score_assessment,
+)
+from assessment_store import (
+    latest_assessment,
+    latest_assessment_matrix,
+    save_assessment_record,
+)
+from bulk_import import BulkImportError, import_rows, import_source, upload_format
+from export import FORMATS, LAYOUTS, export_stream, export_window, read_watermark, write_watermark
+from lab_series import mrange_command, range_command
+import metrics
+from key_migration import legacy_key_count, migrate_keys
+from medications import (
+    MEDICATION_INDEX,
+    ensure_medication_index,
+    is_search_missing_error,
+    list_query,
+    queue_replace_slot,
+    slot_keys_query,
+)
+from metrics import timed
+from read_cache import INVALIDATION_CHANNEL, ReadCache, start_invalidation_listener
+from risk_model import (
+    RISK_CACHE_MAXSIZE,
+    RISK_CACHE_TTL,
+    LatencyWindow,
+    cache_scores,
+    cached_scores,
+    load_risk_model,
+)
+from redis_batch import fetch_hashes
+from retention import (
+    DISCHARGED_FIELD,
+    RETENTION_MAX_AGE_DAYS,
+    RETENTION_TARGET,
+    TARGETS,
+    archive_assessments,
+)
+from write_behind import (
+    FAILED_STREAM,
+    WRITE_BATCH_SIZE,
+    WRITE_BEHIND,
+    WRITE_CLAIM_IDLE,
+    WRITE_FLUSH_INTERVAL,
+    WRITE_STREAM,
+    announce_patients,
+    queue_status,
+    run_worker,
+    write_entry,
+)
+from redis_tracking import TrackedConnection, request_counts
 
 # Initialize Flask application with CORS support
 app = Flask(__name__)
@@ -18,24 +126,139 @@ CORS(app)
 # Redis configuration
 redis_host = os.getenv('REDIS_HOST', 'localhost')
 redis_port = int(os.getenv('REDIS_PORT', 6379))
-redis_client = redis.StrictRedis(
-    host=redis_host, 
-    port=redis_port, 
-    decode_responses=True
+# Round trips are only counted where they are reported: /metrics and the
+# debug headers; otherwise the plain connection keeps the hot path untouched
+redis_connection_class = (
+    TrackedConnection if metrics.METRICS_ENABLED or app.debug else redis.Connection
 )
+if REDIS_CLUSTER:
+    # REDIS_HOST/REDIS_PORT name any node, the others are discovered
+    redis_client = redis.RedisCluster(
+        host=redis_host,
+        port=redis_port,
+        decode_responses=True,
+        connection_class=redis_connection_class
+    )
+else:
+    redis_client = redis.StrictRedis(
+        connection_pool=redis.ConnectionPool(
+            host=redis_host,
+            port=redis_port,
+            decode_responses=True,
+            connection_class=redis_connection_class
+        )
+    )
+
+# In-process cache for patient existence, patient hashes and latest assessments
+read_cache = ReadCache(maxsize=READ_CACHE_MAXSIZE, ttl=READ_CACHE_TTL)
+
+# Risk model from RISK_MODEL_PATH, loaded once; scores are cached until the next save
+risk_model = load_risk_model()
+risk_cache = ReadCache(maxsize=RISK_CACHE_MAXSIZE, ttl=RISK_CACHE_TTL)
+risk_latency = LatencyWindow()
+
+if READ_CACHE_PUBSUB and (read_cache.enabled or risk_cache.enabled):
+    start_invalidation_listener(redis_client, read_cache, risk_cache)
+
+# Lab series known to exist with their compaction rules
+created_lab_series = set()
+
+# The medication index is checked once per process, on first use
+medication_index_ready = False
+
+# Prometheus metrics on /metrics, only active with METRICS_ENABLED=1
+metrics.init_app(app, read_cache)
+
+@app.after_request
+def report_round_trips(response):
+    """In debug mode, report the Redis traffic caused by each request"""
+    if app.debug:
+        round_trips, commands = request_counts()
+        response.headers['X-Redis-Round-Trips'] = str(round_trips)
+        response.headers['X-Redis-Commands'] = str(commands)
+        app.logger.debug(
+            f"{request.method} {request.path}: "
+            f"{round_trips} Redis round trips, {commands} commands"
+        )
+    return response
+
+@app.errorhandler(ApiError)
+def api_error(error):
+    """Requests rejected by the shared parsing of api_common"""
+    return error.response()
+
+@app.errorhandler(redis.ResponseError)
+def redis_error(error):
+    """503 for the routes of a Redis module that is not loaded"""
+    return redis_error_response(error)
 
 # Helper functions
 def validate_patient_exists(patient_id):
     """Check if a patient exists in the database"""
-    if not redis_client.exists(patient_id):
-        return False
-    return True
+    hit, exists = read_cache.get(patient_id, 'exists')
+    if hit:
+        return exists
+    generation = read_cache.generation(patient_id)
+    exists = bool(redis_client.exists(patient_id))
+    read_cache.set(patient_id, 'exists', exists, generation=generation)
+    return exists
+
+def invalidate_patient(patient_id):
+    """Drop the cached reads of a patient after it was written to"""
+    read_cache.invalidate_patient(patient_id)
+    risk_cache.invalidate_patient(patient_id)
+    if READ_CACHE_PUBSUB and (read_cache.enabled or risk_cache.enabled):
+        redis_client.publish(INVALIDATION_CHANNEL, patient_id)
+
+def cached_latest_assessment(patient_id, assessment_name):
+    """latest_assessment, served from the read cache when possible"""
+    hit, latest = read_cache.get(patient_id, 'latest', assessment_name)
+    if hit:
+        return latest
+    generation = read_cache.generation(patient_id)
+    latest = latest_assessment(redis_client, patient_id, assessment_name)
+    read_cache.set(patient_id, 'latest', latest, name=assessment_name, generation=generation)
+    return latest
+
+def risk_scores(patient_ids, kind):
+    """
+    Risk scores of many patients, the uncached ones with one predict_proba call.
 
-def create_timestamp():
-    """Generate both Unix and human-readable timestamps"""
-    unix_ts = int(time.time())
-    human_ts = datetime.fromtimestamp(unix_ts).strftime('%Y-%m-%d %H:%M:%S')
-    return unix_ts, human_ts
+    Returns:
+        dict: patient_id -> {'risk', 'missing_features'}, None for unknown patients.
+    """
+    scores, missing, generations = cached_scores(risk_cache, patient_ids)
+    if missing:
+        started = time.perf_counter()
+        matrix = latest_assessment_matrix(redis_client, missing, risk_model.assessment_names)
+        with timed('risk_predict'):
+            computed = risk_model.score_matrix(matrix)
+        risk_latency.observe(kind, time.perf_counter() - started)
+        cache_scores(risk_cache, computed, generations)
+        scores.update(computed)
+    return scores
+
+def medication_index():
+    """The search interface of the medication index, created if needed"""
+    global medication_index_ready
+    if not medication_index_ready:
+        ensure_medication_index(redis_client)
+        medication_index_ready = True
+    return redis_client.ft(MEDICATION_INDEX)
+
+def page_of_assessment_keys(patient_id):
+    """
+    Resolve the page of assessment keys selected by the query string.
+
+    Returns:
+        tuple: (keys, next_cursor)
+
+    Raises:
+        ApiError: If one of the parameters is malformed.
+    """
+    page_args = parse_page_request(request.args)
+    with timed('index_lookup'):
+        return assessment_page(redis_client, patient_id, **page_args)
 
 # Route handlers
 @app.route('/api', methods=['POST'])
@@ -45,57 +268,108 @@ def create():
     Required JSON payload: {"identifier": "patient_id"}
     Returns: Success message or error
     """
-    data = request.json
-    identifier = data.get('identifier')
-    
-    # Input validation
-    if not identifier or not identifier.isalnum():
-        return jsonify({'error': 'Invalid input'}), 400
+    identifier = parse_new_patient(request.get_json(silent=True))
     if redis_client.exists(identifier):
-        return jsonify({'error': 'Patient with this ID already exists'}), 400
+        raise patient_exists_error()
 
     redis_client.hset(identifier, mapping={'created': 'true'})
-    return jsonify({'message': 'Patient created successfully'}), 201
+    invalidate_patient(identifier)
+    return patient_created_response()
 
 # READ: to get the hashmap from Redis
+def cached_patient_hash(patient_id):
+    hit, hashmap = read_cache.get(patient_id, 'hash')
+    if not hit:
+        generation = read_cache.generation(patient_id)
+        hashmap = redis_client.hgetall(patient_id)
+        read_cache.set(patient_id, 'hash', hashmap, generation=generation)
+    return hashmap
+
 @app.route('/api/<identifier>', methods=['GET'])
 def get(identifier):
-    hashmap = redis_client.hgetall(identifier)
-    if hashmap:
-        return jsonify(hashmap), 200
-    return jsonify({'message': 'Hashmap not found'}), 404
+    return patient_response(cached_patient_hash(identifier))
+
+@app.route('/api/<patient_id>/discharge', methods=['PUT'])
+def discharge_patient(patient_id):
+    """
+Mark a patient as discharged, so the next retention run (flask --app app archive)
+moves all assessments of the patient out of Redis.
+Optional JSON payload: {"date": "YYYY-MM-DD"}, defaults to today.
+Returns:
+    Response: The stored discharge date.
+              - 400: Malformed date.
+              - 404: Unknown patient.
+"""
+    if not validate_patient_exists(patient_id):
+        raise patient_not_found()
+    discharge_date = parse_discharge_request(request.get_json(silent=True))
+
+    redis_client.hset(patient_id, DISCHARGED_FIELD, discharge_date)
+    invalidate_patient(patient_id)
+    return discharged_response(discharge_date)
+
+@app.route('/api/<patient_id>/discharge', methods=['DELETE'])
+def readmit_patient(patient_id):
+    """
+Remove the discharge mark of a readmitted patient. Assessments archived in the
+meantime stay archived and are rehydrated on read.
+Returns:
+    Response: A message, 404 for an unknown patient.
+"""
+    if not validate_patient_exists(patient_id):
+        raise patient_not_found()
+    redis_client.hdel(patient_id, DISCHARGED_FIELD)
+    invalidate_patient(patient_id)
+    return readmitted_response()
 
 
 # UPDATE: to update the hashmap in Redis
 @app.route('/api/<patient_id>/<assessment_name>', methods=['POST'])
 def save_assessment(patient_id, assessment_name):
     """Saves an assessment for a given patient."""
+    if WRITE_BEHIND:
+        return queue_assessment(patient_id, assessment_name)
     if not validate_patient_exists(patient_id):
-        return jsonify({'error': 'Patient ID does not exist'}), 404
+        raise patient_not_found()
+    data = parse_assessment(request.get_json(silent=True))
 
-    data = request.json
-    if not data:
-        return jsonify({'error': 'Invalid input'}), 400
-
-    # Convert all values to strings, including nested dictionaries
-    processed_data = {}
-    for key, value in data.items():
-        if isinstance(value, (dict, list)):
-            processed_data[key] = json.dumps(value)
-        else:
-            processed_data[key] = str(value) if value is not None else ''
+    with timed('score'):
+        score = score_assessment(assessment_name, data)
+    with timed('json_encode'):
+        processed_data = encode_for_storage(data, score=score)
 
     unix_timestamp, human_readable = create_timestamp()
-    key = f"{patient_id}:{assessment_name}:{unix_timestamp}:{human_readable}"
-    
-    redis_client.hset(key, mapping=processed_data)
+    # Hash, index entries and latest pointer are written atomically
+    with timed('redis_write'):
+        key = save_assessment_record(
+            redis_client, patient_id, assessment_name,
+            processed_data, unix_timestamp, human_readable
+        )
+        if score is not None and score['total'] is not None:
+            aggregate_score(
+                redis_client, patient_id, cached_patient_hash(patient_id),
+                assessment_name, score['total'], unix_timestamp
+            )
+    invalidate_patient(patient_id)
+    return saved_response(key, score, unix_timestamp, human_readable)
+
+def queue_assessment(patient_id, assessment_name):
+    """
+    Write-behind variant of save_assessment, see write_behind.
+    The patient check comes from the read cache, the only round trip is the XADD.
+    """
+    if not cached_patient_hash(patient_id):
+        raise patient_not_found()
+    data = parse_assessment(request.get_json(silent=True))
 
-    return jsonify({
-        'message': 'Assessment saved successfully',
-        'timestamp': human_readable,
-        'unix_timestamp': unix_timestamp,
-        'key': key
-    }), 200
+    score = score_assessment(assessment_name, data)
+    unix_timestamp, human_readable = create_timestamp()
+    with timed('redis_write'):
+        entry_id = redis_client.xadd(WRITE_STREAM, write_entry(
+            patient_id, assessment_name, encode_for_storage(data, score=score),
+            unix_timestamp, human_readable, score
+        ))
+    return queued_response(entry_id, score, unix_timestamp, human_readable)
 
 # READ: to get an assessment from Redis
 @app.route('/api/<patient_id>/<assessment_name>', methods=['GET'])
@@ -114,46 +388,36 @@ Returns:
               - 404: Patient ID does not exist or assessment not found.
 """
     # Check if the patient ID exists
-    if not redis_client.exists(patient_id):
-        return jsonify({'error': 'Patient ID does not exist or might need to be created'}), 404
-
-    assessment = redis_client.hgetall(f"{patient_id}:{assessment_name}")
-    if assessment:
-        return jsonify(assessment), 200
-    return jsonify({'message': 'Assessment not found'}), 404
+    if not validate_patient_exists(patient_id):
+        raise patient_not_found('Patient ID does not exist or might need to be created')
+    return assessment_response(redis_client.hgetall(f"{patient_id}:{assessment_name}"))
 
 # READ: to get all assessments for a given patient from Redis
 @app.route('/api/<patient_id>/assessments', methods=['GET'])
 def get_assessments(patient_id):
     """
 Retrieve assessments for a given patient.
-This endpoint retrieves all assessments for a specified patient ID from the Redis database.
+This endpoint retrieves one page of assessments for a specified patient ID from the Redis database.
 The assessments are sorted by timestamp in descending order.
 Args:
     patient_id (str): The ID of the patient whose assessments are to be retrieved.
+Query parameters:
+    limit (int): Page size, defaults to ASSESSMENT_PAGE_SIZE.
+    cursor (str): Value of the X-Next-Cursor header of the previous page.
+    since, until (int): Unix timestamp window, both inclusive.
+    assessment_name (str): Only return assessments of this type.
 Returns:
     Response: A JSON response containing the assessments if found, or an error message if the patient ID does not exist or no assessments are found.
+              If more assessments are available, the X-Next-Cursor header holds the cursor of the next page.
 """
     if not validate_patient_exists(patient_id):
-        return jsonify({'error': 'Patient ID does not exist'}), 404
-
-    keys = redis_client.keys(f"{patient_id}:*")
-    assessments = {}
-    
-    # Sort keys by timestamp in descending order
-    sorted_keys = sorted(
-        keys, 
-        key=lambda x: x.split(':')[-1] if len(x.split(':')) > 2 else '', 
-        reverse=True
-    )
-    
-    for key in sorted_keys:
-        if data := redis_client.hgetall(key):
-            assessments[key] = data
-            
-    return (jsonify(assessments), 200) if assessments else (
-        jsonify({'message': 'No assessments found'}), 404
-    )
+        raise patient_not_found()
+
+    # The index already returns the keys in descending timestamp order
+    sorted_keys, next_cursor = page_of_assessment_keys(patient_id)
+    with timed('hash_fetch'):
+        hashes = fetch_hashes(redis_client, sorted_keys)
+    return assessments_response(sorted_keys, hashes, next_cursor)
 
 # READ: to get all data associated with a given ID from Redis
 @app.route('/api/<identifier>/all', methods=['GET'])
@@ -170,30 +434,41 @@ Returns:
 The data is retrieved from a Redis database. Each key associated with the identifier
 is checked for timestamp information. If timestamp information is present, it is included
 in the response along with the data.
+The same limit, cursor, since, until and assessment_name query parameters as for
+/api/<patient_id>/assessments select the page that is returned.
 """
     # Check if the patient ID exists
-    if not redis_client.exists(identifier):
-        return jsonify({'error': 'Patient ID does not exist or might need to be created'}), 404
-
-    keys = redis_client.keys(f"{identifier}:*")
-    all_data = {}
-    for key in keys:
-        data = redis_client.hgetall(key)
-        key_parts = key.split(':')
-        if len(key_parts) >= 4:  # If key contains timestamp information
-            unix_timestamp = key_parts[2]
-            human_timestamp = key_parts[3]
-            all_data[key] = {
-                'data': data,
-                'timestamp': human_timestamp,
-                'unix_timestamp': unix_timestamp
-            }
-        else:
-            all_data[key] = data
-            
-    if all_data:
-        return jsonify(all_data), 200
-    return jsonify({'message': 'No data found for this ID'}), 404
+    if not validate_patient_exists(identifier):
+        raise patient_not_found('Patient ID does not exist or might need to be created')
+
+    keys, next_cursor = page_of_assessment_keys(identifier)
+    with timed('hash_fetch'):
+        hashes = fetch_hashes(redis_client, keys)
+    return all_data_response(keys, hashes, next_cursor)
+
+def latest_assessment_response(patient_id, assessment_name, decode_json=True, label=None):
+    """
+    Shared implementation of the /latest routes.
+
+    Args:
+        patient_id (str): The ID of the patient.
+        assessment_name (str): The name of the assessment.
+        decode_json (bool): Parse JSON encoded fields back into objects.
+        label (str): Name used in messages, defaults to assessment_name.
+    Returns:
+        tuple: The JSON response and the HTTP status code.
+    """
+    label = label or assessment_name
+    if not validate_patient_exists(patient_id):
+        raise patient_not_found('Patient not found')
+
+    try:
+        with timed('latest_lookup'):
+            latest_key, raw_data = cached_latest_assessment(patient_id, assessment_name)
+        with timed('json_decode'):
+            return latest_response(latest_key, raw_data, decode_json, label)
+    except Exception as e:
+        return failure_response(f'Failed to retrieve latest {label} assessment', e)
 
 @app.route('/api/<patient_id>/barthel/latest', methods=['GET'])
 def get_latest_barthel(patient_id):
@@ -209,102 +484,15 @@ Returns:
               If the latest assessment is empty, returns a 404 error with a message.
               If an error occurs during retrieval, returns a 500 error with details.
 """
-    if not validate_patient_exists(patient_id):
-        return jsonify({'error': 'Patient not found'}), 404
-
-    pattern = f"{patient_id}:Barthel Index:*"
-    assessment_keys = redis_client.keys(pattern)
-    
-    if not assessment_keys:
-        return jsonify({'message': 'No Barthel assessments found'}), 404
-
-    try:
-        # Get the latest assessment based on timestamp
-        latest_key = max(
-            assessment_keys,
-            key=lambda k: int(k.split(':')[2]) if len(k.split(':')) > 2 else 0
-        )
-        
-        if not (assessment_data := redis_client.hgetall(latest_key)):
-            return jsonify({'message': 'Latest assessment is empty'}), 404
-
-        # Parse timestamps from key more safely
-        key_parts = latest_key.split(':')
-        # Default values
-        unix_timestamp = "0"
-        human_readable = "Unknown"
-        
-        # Extract timestamps if they exist in the key
-        if len(key_parts) >= 4:  # Ensure we have enough parts
-            unix_timestamp = key_parts[2]
-            human_readable = ':'.join(key_parts[3:])  # Join remaining parts in case timestamp contains colons
-        
-        return jsonify({
-            'timestamp': human_readable,
-            'unix_timestamp': int(unix_timestamp),
-            'data': assessment_data,
-            'key': latest_key
-        }), 200
-
-    except Exception as e:
-        print(f"Error retrieving latest Barthel assessment: {e}")
-        return jsonify({
-            'error': 'Failed to retrieve latest assessment',
-            'details': str(e)
-        }), 500
+    return latest_assessment_response(
+        patient_id, 'Barthel Index', decode_json=False, label='Barthel'
+    )
 
 # Update get_assessment to parse JSON strings back to dictionaries
 @app.route('/api/<patient_id>/<assessment_name>/latest', methods=['GET'])
 def get_latest_assessment(patient_id, assessment_name):
     """Retrieve the latest assessment for a given patient."""
-    if not validate_patient_exists(patient_id):
-        return jsonify({'error': 'Patient not found'}), 404
-
-    pattern = f"{patient_id}:{assessment_name}:*"
-    assessment_keys = redis_client.keys(pattern)
-    
-    if not assessment_keys:
-        return jsonify({'message': f'No {assessment_name} assessments found'}), 404
-
-    try:
-        latest_key = max(
-            assessment_keys,
-            key=lambda k: int(k.split(':')[2]) if len(k.split(':')) > 2 else 0
-        )
-        
-        raw_data = redis_client.hgetall(latest_key)
-        if not raw_data:
-            return jsonify({'message': 'Latest assessment is empty'}), 404
-
-        # Parse any JSON strings back to dictionaries
-        processed_data = {}
-        for key, value in raw_data.items():
-            try:
-                processed_data[key] = json.loads(value)
-            except (json.JSONDecodeError, TypeError):
-                processed_data[key] = value
-
-        key_parts = latest_key.split(':')
-        if len(key_parts) >= 4:
-            unix_timestamp = key_parts[2]
-            human_readable = ':'.join(key_parts[3:])
-        else:
-            unix_timestamp = "0"
-            human_readable = "Unknown"
-        
-        return jsonify({
-            'timestamp': human_readable,
-            'unix_timestamp': int(unix_timestamp),
-            'data': processed_data,
-            'key': latest_key
-        }), 200
-
-    except Exception as e:
-        print(f"Error retrieving latest {assessment_name} assessment: {e}")
-        return jsonify({
-            'error': f'Failed to retrieve latest {assessment_name} assessment',
-            'details': str(e)
-        }), 500
+    return latest_assessment_response(patient_id, assessment_name)
 
 @app.route('/api/<patient_id>/moca5min/latest', methods=['GET'])
 def get_latest_moca5min(patient_id):
@@ -320,47 +508,493 @@ def get_latest_moca5min(patient_id):
                   If the latest assessment is empty, returns a 404 error with a message.
                   If an error occurs during retrieval, returns a 500 error with details.
     """
+    return latest_assessment_response(patient_id, 'MoCA 5min', decode_json=False)
+
+@app.route('/api/ward-snapshot', methods=['GET', 'POST'])
+def get_ward_snapshot():
+    """
+Retrieve the latest assessments of many patients in one request.
+The patients and assessment names are given either as JSON payload
+{"patients": [...], "assessments": [...]} (POST) or as comma separated
+query parameters ?patients=...&assessments=... (GET).
+All lookups are served by one pipelined Redis round trip.
+Returns:
+    Response: A JSON object {"patients": {patient_id: {assessment_name: latest or null}}}
+              where unknown patients map to null. With ?format=ndjson (or an
+              Accept header of application/x-ndjson) one JSON line per patient is streamed instead.
+              - 400: The patient or assessment list is missing or too large.
+"""
+    patient_ids, assessment_names = parse_snapshot(
+        request.method, request.get_json(silent=True), request.args
+    )
+    try:
+        matrix = latest_assessment_matrix(redis_client, patient_ids, assessment_names)
+    except Exception as e:
+        return failure_response('Failed to retrieve ward snapshot', e)
+    return snapshot_response(matrix, request.args, request.headers)
+
+@app.route('/api/<patient_id>/labs/<lab>', methods=['POST'])
+def add_lab_samples(patient_id, lab):
+    """
+Append lab values of a patient.
+The series and its compactions (see lab_series.COMPACTIONS) are created with the first sample.
+Required JSON payload: {"timestamp": ms, "value": x}, a list of such objects or
+{"samples": [...]}; without a timestamp the sample is taken at the current time.
+Returns:
+    Response: The timestamps of the stored samples.
+              - 400: Malformed samples or samples rejected by Redis.
+              - 404: Unknown patient or lab value.
+              - 503: RedisTimeSeries is not loaded.
+"""
+    parse_lab(lab)
+    if not validate_patient_exists(patient_id):
+        raise patient_not_found()
+    samples = parse_lab_samples(request.get_json(silent=True))
+
+    pipe = redis_client.pipeline(transaction=False)
+    new_series = (patient_id, lab) not in created_lab_series
+    for command in lab_write_commands(patient_id, lab, samples, new_series):
+        pipe.execute_command(*command)
+    response = lab_samples_response(pipe.execute(raise_on_error=False))
+    created_lab_series.add((patient_id, lab))
+    return response
+
+@app.route('/api/<patient_id>/labs/<lab>', methods=['GET'])
+def get_lab_series(patient_id, lab):
+    """
+Retrieve the values of one lab series, optionally downsampled.
+Query parameters:
+    from, to (int): Time window in ms, defaults to the whole series.
+    aggregation (str): avg (default), min, max or last.
+    bucket (str): Bucket size in ms or with a unit (1h, 1d); omitted for raw samples.
+Returns:
+    Response: {"patient_id", "lab", "aggregation", "bucket_ms", "points": [[ms, value], ...]}
+              Buckets with a compaction rule (1h avg, 1d avg/min/max/last) are read
+              from the precomputed series.
+              - 400: Malformed query parameters.
+              - 404: Unknown patient, lab value or no samples stored.
+              - 503: RedisTimeSeries is not loaded.
+"""
+    parse_lab(lab)
+    if not validate_patient_exists(patient_id):
+        raise patient_not_found()
+    range_args = parse_lab_range(request.args)
+
+    try:
+        reply = redis_client.execute_command(*range_command(patient_id, lab, **range_args))
+    except redis.ResponseError as e:
+        return lab_range_error(e)
+    return lab_series_response(patient_id, lab, range_args, reply)
+
+@app.route('/api/ward-labs/<lab>', methods=['GET'])
+def get_ward_lab_series(lab):
+    """
+Retrieve one lab value for many patients with a single TS.MRANGE.
+Takes the query parameters of /api/<patient_id>/labs/<lab> and additionally
+patients (comma separated IDs, default all patients).
+Returns:
+    Response: {"lab", "aggregation", "bucket_ms", "patients": {patient_id: [[ms, value], ...]}}
+              - 503: RedisTimeSeries is not loaded.
+"""
+    parse_lab(lab)
+    patient_ids, range_args = parse_ward_lab_request(request.args)
+    reply = redis_client.execute_command(*mrange_command(lab, patient_ids, **range_args))
+    return ward_labs_response(lab, range_args, reply)
+
+@app.route('/api/<patient_id>/medications', methods=['GET'])
+def get_medications(patient_id):
+    """
+Retrieve the medication plan of a patient, ordered by position.
+Query parameters:
+    slot (str): Only return this slot, e.g. preop or latest.
+Returns:
+    Response: {"patient_id", "medications": [{"key", "patient", "slot", "position", "name"}, ...]}
+              - 400: Malformed slot.
+              - 404: Unknown patient.
+              - 503: RediSearch is not loaded.
+"""
+    if not validate_patient_exists(patient_id):
+        raise patient_not_found()
+    slot = parse_slot_filter(request.args)
+    result = medication_index().search(list_query(patient_id, slot))
+    return medications_response(patient_id, result)
+
+@app.route('/api/<patient_id>/medications/<slot>', methods=['PUT'])
+def put_medications(patient_id, slot):
+    """
+Replace the medication plan of one slot of a patient.
+Required JSON payload: {"medications": ["name", ...]} in the order of their positions.
+Returns:
+    Response: The number of medications stored.
+              - 400: Malformed slot or payload.
+              - 404: Unknown patient.
+              - 503: RediSearch is not loaded.
+"""
     if not validate_patient_exists(patient_id):
-        return jsonify({'error': 'Patient not found'}), 404
+        raise patient_not_found()
+    names = parse_medication_plan(slot, request.get_json(silent=True))
 
-    pattern = f"{patient_id}:MoCA 5min:*"
-    assessment_keys = redis_client.keys(pattern)
-    
-    if not assessment_keys:
-        return jsonify({'message': 'No MoCA 5min assessments found'}), 404
+    old_keys = [doc.id for doc in medication_index().search(slot_keys_query(patient_id, slot)).docs]
+    pipe = redis_client.pipeline(transaction=True)
+    queue_replace_slot(pipe, patient_id, slot, names, old_keys)
+    pipe.execute()
+    return medications_saved_response(names)
 
+@app.route('/api/medication-search', methods=['GET'])
+def search_medications():
+    """
+Search medications by name.
+Query parameters:
+    q (str): Words to search, each matching as a prefix.
+    fuzzy (int): 1 to match words within one typo instead.
+    patient, slot (str): Restrict the search to a patient and/or slot.
+    limit (int): Maximum number of results (default 20).
+Returns:
+    Response: {"total", "medications": [...]} ordered by relevance.
+              - 503: RediSearch is not loaded.
+"""
+    query = parse_medication_search(request.args)
+    return medication_search_response(medication_index().search(query))
+
+@app.route('/api/export', methods=['GET'])
+def export_assessments():
+    """
+Stream the assessment history of all patients as a table.
+Query parameters:
+    format (str): csv (default) or parquet (requires pyarrow).
+    layout (str): long (default, one row per assessment field) or wide
+                  (one row per patient with the latest value of every assessment field).
+    since (int): Watermark of the previous export, only newer assessments are exported.
+    chunk_size (int): Patients per chunk, defaults to EXPORT_CHUNK_SIZE.
+Returns:
+    Response: The streamed file. The X-Export-Watermark header holds the value to
+              pass as since for the next incremental export.
+              - 400: Unknown format or layout, malformed since or chunk_size, or pyarrow missing.
+"""
+    export_format = request.args.get('format', 'csv')
+    layout = request.args.get('layout', 'long')
     try:
-        # Get the latest assessment based on timestamp
-        latest_key = max(
-            assessment_keys,
-            key=lambda k: int(k.split(':')[2]) if len(k.split(':')) > 2 else 0
+        since, chunk_size = parse_export_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    since, until = export_window(since)
+    try:
+        stream = export_stream(redis_client, export_format, layout, since, until, chunk_size)
+    except (ValueError, RuntimeError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/vnd.apache.parquet'
+    response = Response(stream, mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename=assessments_{layout}_{until}.{export_format}'
+    response.headers['X-Export-Watermark'] = str(until)
+    return response
+
+@app.route('/api/bulk-import', methods=['POST'])
+def bulk_import():
+    """
+Import many patients and assessments from one upload.
+The request body is streamed and written in batched transactions, missing
+patients are created on the fly.
+Query parameters:
+    format (str): ndjson (default) or csv, otherwise taken from the Content-Type.
+    batch_size (int): Rows per transaction, defaults to IMPORT_BATCH_SIZE.
+    assessment_name (str): Assessment name of CSV rows (default OKIE).
+    id_column (str): CSV column holding the patient ID (default id).
+Rows already stored with identical data at the same unix_timestamp are
+counted as duplicates instead of being written again, so a failed import can
+simply be repeated.
+Returns:
+    Response: A JSON report with the number of rows, imported, duplicate and
+              rejected rows, the first rejected lines with their errors and rows_per_second.
+              - 400: Unknown format or batch size.
+              - 500: Redis failed to write a row; the report covers the rows
+                     written up to then and the row under "failed".
+"""
+    batch_size = parse_import_batch_size(request.args)
+    try:
+        rows, parse = import_source(
+            upload_format(request.args, request.content_type),
+            io.TextIOWrapper(request.stream, encoding='utf-8', newline=''),
+            id_column=request.args.get('id_column', 'id'),
+            assessment_name=request.args.get('assessment_name', 'OKIE'),
         )
-        
-        if not (assessment_data := redis_client.hgetall(latest_key)):
-            return jsonify({'message': 'Latest assessment is empty'}), 404
-
-        # Parse timestamps from key more safely
-        key_parts = latest_key.split(':')
-        unix_timestamp = "0"
-        human_readable = "Unknown"
-        
-        if len(key_parts) >= 4:
-            unix_timestamp = key_parts[2]
-            human_readable = ':'.join(key_parts[3:])
-        
-        return jsonify({
-            'timestamp': human_readable,
-            'unix_timestamp': int(unix_timestamp),
-            'data': assessment_data,
-            'key': latest_key
-        }), 200
+    except ValueError as e:
+        raise ApiError(400, {'error': str(e)})
 
+    def invalidate_batch(report, patient_ids):
+        for patient_id in patient_ids:
+            invalidate_patient(patient_id)
+
+    try:
+        report = import_rows(redis_client, rows, parse, batch_size, on_batch=invalidate_batch)
+    except BulkImportError as e:
+        return import_failed_response(e.report)
     except Exception as e:
-        print(f"Error retrieving latest MoCA 5min assessment: {e}")
-        return jsonify({
-            'error': 'Failed to retrieve latest assessment',
-            'details': str(e)
-        }), 500
+        return failure_response('Bulk import failed', e)
+    return report, 200
+
+@app.route('/api/<patient_id>/risk', methods=['GET'])
+def get_risk(patient_id):
+    """
+Score the risk of a patient from the latest assessments with the model of RISK_MODEL_PATH.
+The score is cached until the next assessment of the patient is saved.
+Returns:
+    Response: {"patient_id", "risk", "missing_features"} where risk is the
+              predicted probability of the positive class.
+              - 404: Unknown patient.
+              - 503: No risk model configured.
+"""
+    require_risk_model(risk_model)
+    return risk_response(patient_id, risk_scores([patient_id], 'single')[patient_id])
+
+@app.route('/api/risk-scores', methods=['GET', 'POST'])
+def get_risk_scores():
+    """
+Score many patients at once.
+The patients are given as JSON payload {"patients": [...]} (POST) or as comma
+separated query parameter ?patients=... (GET). Their latest assessments are
+fetched in one pipelined round trip and scored with a single predict_proba call.
+Returns:
+    Response: {"patients": {patient_id: {"risk", "missing_features"} or null}}
+              - 400: The patient list is missing, too large or malformed.
+              - 503: No risk model configured.
+"""
+    require_risk_model(risk_model)
+    patient_ids = parse_risk_patients(request.method, request.get_json(silent=True), request.args)
+    return {'patients': risk_scores(patient_ids, 'batch')}, 200
+
+@app.route('/api/risk-stats', methods=['GET'])
+def get_risk_stats():
+    """The loaded risk model, p50/p99 scoring latency and the score cache counters"""
+    return risk_stats_response(risk_model, risk_latency, risk_cache)
+
+@app.route('/api/score-aggregates', methods=['GET'])
+def get_score_aggregates():
+    """
+Retrieve the score aggregates of the wards, maintained on every scored save
+(see assessment_scores).
+Optional query parameters: ?ward=a,b to select wards, ?assessment_name=...
+to select assessments and ?threshold=x to override SCORE_THRESHOLDS.
+Returns:
+    Response: {"wards": {ward: {assessment_name: {"scorer", "count", "mean",
+              "buckets", "threshold", "below_threshold": {patient_id: total}}}}}
+              - 400: The threshold is not a number.
+"""
+    wards, assessment_names, threshold = parse_aggregate_request(request.args)
+    try:
+        aggregates = score_aggregates(redis_client, wards, assessment_names, threshold)
+    except Exception as e:
+        return failure_response('Failed to retrieve score aggregates', e)
+    return {'wards': aggregates}, 200
+
+@app.route('/api/write-queue', methods=['GET'])
+def get_write_queue():
+    """Saves queued in write-behind mode and not yet applied, see write_behind"""
+    return jsonify(queue_status(redis_client)), 200
+
+@app.route('/api/cache-stats', methods=['GET'])
+def get_cache_stats():
+    """Hit, miss and eviction counters of the read cache"""
+    return jsonify(read_cache.stats()), 200
+
+@app.cli.command('build-index')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Keys per SCAN step and per pipeline flush.')
+def build_index_command(batch_size):
+    """
+    One-shot migration that indexes the existing assessment keys.
+    Run once after upgrading: flask --app app build-index
+    """
+    indexed = build_index(redis_client, batch_size=batch_size)
+    click.echo(f"Indexed {indexed} assessments")
+
+@app.cli.command('migrate-keys')
+@click.option('--pause', default=0.0, show_default=True,
+              help='Seconds to wait after every patient, to limit the load on Redis.')
+@click.option('--check', is_flag=True, help='Only count the patients left to migrate.')
+def migrate_keys_command(pause, check):
+    """
+    Move version 1 keys to the hash-tagged key schema while the API keeps running.
+    Run against the standalone Redis: flask --app app migrate-keys
+    Afterwards set LEGACY_KEY_FALLBACK=0 (and REDIS_CLUSTER=1 after moving the data).
+    """
+    if check:
+        click.echo(f"{legacy_key_count(redis_client)} patients left to migrate")
+        return
+
+    def progress(report, patient_id):
+        invalidate_patient(patient_id)
+        if report['patients'] % 100 == 0:
+            click.echo(f"{report['patients']} patients migrated", err=True)
+
+    report = migrate_keys(redis_client, pause=pause, on_patient=progress)
+    click.echo(
+        f"Migrated {report['assessments']} assessments of {report['patients']} patients "
+        f"and {report['medications']} medications in {report['seconds']}s"
+    )
+
+@app.cli.command('rebuild-scores')
+@click.option('--chunk-size', default=500, show_default=True,
+              help='Patients per pipeline.')
+def rebuild_scores_command(chunk_size):
+    """
+    Recompute the score aggregates from the latest assessments, e.g. after a bulk import.
+    flask --app app rebuild-scores
+    """
+    report = rebuild_scores(redis_client, chunk_size=chunk_size)
+    click.echo(f"Aggregated {report['scores']} scores of {report['patients']} patients")
+
+@app.cli.command('write-worker')
+@click.option('--consumer', default=lambda: f'worker-{os.getpid()}',
+              help='Name in the consumer group, keep it stable so a restart replays its entries.')
+@click.option('--batch-size', default=WRITE_BATCH_SIZE, show_default=True,
+              help='Entries written per pipeline.')
+@click.option('--flush-interval', default=WRITE_FLUSH_INTERVAL, show_default=True,
+              help='Seconds to wait for a batch to fill.')
+@click.option('--claim-idle', default=WRITE_CLAIM_IDLE, show_default=True,
+              help='Seconds after which entries of another worker are taken over.')
+def write_worker_command(consumer, batch_size, flush_interval, claim_idle):
+    """
+    Apply the saves queued in write-behind mode (WRITE_BEHIND=1).
+    flask --app app write-worker --consumer worker-1
+    """
+    def written(report):
+        # This process serves no reads, the API processes hold the caches
+        announce_patients(redis_client, report['patients'])
+        if report['failed']:
+            click.echo(f"{report['failed']} entries failed, see {FAILED_STREAM}", err=True)
+
+    click.echo(f"Consumer {consumer} applying {WRITE_STREAM}", err=True)
+    try:
+        run_worker(redis_client, consumer, batch_size, flush_interval, claim_idle, on_batch=written)
+    except KeyboardInterrupt:
+        pass
+
+@app.cli.command('archive')
+@click.option('--max-age-days', default=RETENTION_MAX_AGE_DAYS, show_default=True,
+              help='Also archive older assessments of patients not discharged, 0 disables it.')
+@click.option('--target', type=click.Choice(TARGETS), default=RETENTION_TARGET, show_default=True,
+              help='Archive files on disk or compressed blobs in Redis.')
+@click.option('--patient', 'patient_ids', multiple=True,
+              help='Archive all assessments of this patient, may be repeated.')
+@click.option('--dry-run', is_flag=True, help='Only count what would be archived.')
+def archive_command(max_age_days, target, patient_ids, dry_run):
+    """
+    Move assessments of discharged patients (and old ones) out of Redis memory.
+    The GET endpoints rehydrate them on demand: flask --app app archive
+    """
+    report = archive_assessments(
+        redis_client, max_age_days=max_age_days, target=target,
+        patient_ids=list(patient_ids), dry_run=dry_run,
+    )
+    if dry_run:
+        click.echo(f"Would archive {report['assessments']} assessments of {report['patients']} patients")
+        return
+    measured = 'measured' if report['measured'] else 'estimated'
+    click.echo(
+        f"Archived {report['assessments']} assessments of {report['patients']} patients "
+        f"({report['archive_bytes']} bytes compressed) in {report['seconds']}s, "
+        f"reclaimed {report['reclaimed_bytes']} of {report['memory_before']} bytes ({measured})"
+    )
+
+@app.cli.command('create-medication-index')
+def create_medication_index_command():
+    """
+    Create the medication search index, replacing one with the old TEXT schema.
+    flask --app app create-medication-index
+    """
+    try:
+        created = ensure_medication_index(redis_client)
+    except redis.ResponseError as e:
+        if is_search_missing_error(e):
+            raise click.ClickException(
+                'RediSearch is not loaded, run Redis Stack (redis/redis-stack-server)'
+            )
+        raise
+    if created:
+        click.echo(f"Created index {MEDICATION_INDEX}")
+    else:
+        click.echo(f"Index {MEDICATION_INDEX} is up to date")
+
+@app.cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'export_format', type=click.Choice(FORMATS),
+              help='Output format, guessed from the file extension if omitted.')
+@click.option('--layout', type=click.Choice(LAYOUTS), default='long', show_default=True,
+              help='One row per assessment field (long) or per patient (wide).')
+@click.option('--state', type=click.Path(dir_okay=False),
+              help='JSON file keeping the watermark for incremental exports.')
+@click.option('--since', type=int, help='Only export assessments after this unix timestamp.')
+@click.option('--chunk-size', default=None, type=click.IntRange(min=1),
+              help='Patients per chunk, defaults to EXPORT_CHUNK_SIZE.')
+def export_command(path, export_format, layout, state, since, chunk_size):
+    """
+    Export the assessment history to CSV or Parquet, e.g. nightly with
+    flask --app app export ward.parquet --state export_state.json
+    """
+    if export_format is None:
+        export_format = 'parquet' if path.lower().endswith('.parquet') else 'csv'
+    if since is None and state:
+        since = read_watermark(state)
+    since, until = export_window(since)
+    try:
+        stream = export_stream(redis_client, export_format, layout, since, until, chunk_size)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    started = time.perf_counter()
+    with open(path, 'w' if export_format == 'csv' else 'wb',
+              **({'encoding': 'utf-8', 'newline': ''} if export_format == 'csv' else {})) as f:
+        for piece in stream:
+            f.write(piece)
+    if state:
+        write_watermark(state, until)
+    click.echo(
+        f"Exported assessments after {since or 'the beginning'} up to {until} "
+        f"to {path} in {time.perf_counter() - started:.1f}s"
+    )
+
+@app.cli.command('bulk-import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(['ndjson', 'csv']),
+              help='Input format, guessed from the file extension if omitted.')
+@click.option('--batch-size', default=None, type=click.IntRange(min=1),
+              help='Rows per transaction, defaults to IMPORT_BATCH_SIZE.')
+@click.option('--assessment-name', default='OKIE', show_default=True,
+              help='Assessment name of CSV rows.')
+@click.option('--id-column', default='id', show_default=True,
+              help='CSV column holding the patient ID.')
+def bulk_import_command(path, import_format, batch_size, assessment_name, id_column):
+    """
+    Import an NDJSON or per-patient CSV file, e.g. an OKIE export:
+    flask --app app bulk-import ../surge_ahead/OKIE_data_20250306.csv
+    """
+    if import_format is None:
+        import_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+    def progress(report, patient_ids):
+        click.echo(f"{report['rows']} rows read, {report['imported']} imported", err=True)
+
+    with open(path, encoding='utf-8', newline='') as f:
+        rows, parse = import_source(import_format, f, id_column, assessment_name)
+        try:
+            report = import_rows(redis_client, rows, parse, batch_size, on_batch=progress)
+        except BulkImportError as e:
+            report = e.report
+
+    click.echo(
+        f"Imported {report['imported']} of {report['rows']} rows "
+        f"({report['duplicates']} already stored, {report['rejected']} rejected) "
+        f"in {report['seconds']}s, {report['rows_per_second']} rows/s"
+    )
+    for error in report['errors']:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    if 'failed' in report:
+        raise click.ClickException(
+            f"Stopped at line {report['failed']['line']}: {report['failed']['error']}; "
+            f"run the import again to continue"
+        )
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
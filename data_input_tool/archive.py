@@ -0,0 +1,164 @@
+"""
+Archived assessments and their stubs
+
+The retention run (see retention) moves assessments out of Redis into
+compressed archive members: one gzip member of JSON lines
+``{"key": ..., "fields": {...}}`` per patient and run, holding the stored
+hashes unchanged (whatever their assessment_format). A member is appended to
+the patient's archive file ``ARCHIVE_DIR/<patient_id>.jsonl.gz`` or, with
+RETENTION_TARGET=redis, kept as a base64 string in Redis.
+
+Each archived hash is replaced by a stub with the single field ARCHIVED_FIELD
+pointing to its member:
+
+    file:<patient_id>.jsonl.gz:<offset>:<length>
+    redis:<key of the member>
+
+The key, its index entries and the latest pointer stay, so pagination, exports
+and the latest lookups keep finding archived assessments. Readers pass the
+fetched hashes through rehydrate, which replaces the stubs by the archived
+hashes, reading every member once per call.
+"""
+
+import base64
+import gzip
+import json
+import os
+import zlib
+from pathlib import Path
+
+ARCHIVE_DIR = Path(os.getenv('ARCHIVE_DIR', Path(__file__).resolve().parent / 'archive'))
+ARCHIVED_FIELD = '_archived'
+ARCHIVE_PREFIX = 'archive'
+
+
+def is_archived(raw_data):
+    return bool(raw_data) and ARCHIVED_FIELD in raw_data
+
+
+def plain_key(key):
+    """The key without the hash tag, so key_migration does not orphan archived records"""
+    if key.startswith('{'):
+        return key[1:].replace('}', '', 1)
+    return key
+
+
+def encode_member(records):
+    """gzip member of the (key, stored hash) pairs of one patient"""
+    lines = '\n'.join(
+        json.dumps({'key': plain_key(key), 'fields': fields}, separators=(',', ':'), ensure_ascii=False)
+        for key, fields in records
+    )
+    return gzip.compress(lines.encode('utf-8'), compresslevel=6)
+
+
+def decode_member(member):
+    """plain key -> stored hash of an archive member"""
+    text = zlib.decompressobj(wbits=31).decompress(member).decode('utf-8')
+    records = {}
+    for line in text.splitlines():
+        record = json.loads(line)
+        records[record['key']] = record['fields']
+    return records
+
+
+def archive_file(patient_id, archive_dir=None):
+    return Path(archive_dir or ARCHIVE_DIR) / f'{patient_id}.jsonl.gz'
+
+
+def append_member(patient_id, member, archive_dir=None):
+    """
+    Append a member to the patient's archive file, synced to disk.
+
+    Returns:
+        str: The reference stored in the stubs.
+    """
+    path = archive_file(patient_id, archive_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'ab') as f:
+        offset = f.tell()
+        f.write(member)
+        f.flush()
+        os.fsync(f.fileno())
+    return f'file:{path.name}:{offset}:{len(member)}'
+
+
+def read_file_member(location, archive_dir=None):
+    """Read a member referenced as <file name>:<offset>:<length>"""
+    name, offset, length = location.rsplit(':', 2)
+    with open(Path(archive_dir or ARCHIVE_DIR) / name, 'rb') as f:
+        f.seek(int(offset))
+        return f.read(int(length))
+
+
+def member_blob(member):
+    """Redis representation of a member, base64 as the client decodes replies as text"""
+    return base64.b64encode(member).decode('ascii')
+
+
+def parse_ref(ref):
+    """
+    (kind, location) of a stub reference.
+
+    Raises:
+        ValueError: If the reference has an unknown kind.
+    """
+    kind, _, location = ref.partition(':')
+    if kind not in ('file', 'redis') or not location:
+        raise ValueError(f'Unknown archive reference {ref!r}')
+    return kind, location
+
+
+def load_member(client, ref):
+    kind, location = parse_ref(ref)
+    if kind == 'redis':
+        blob = client.get(location)
+        if blob is None:
+            raise LookupError(f'Archive member {location} is missing')
+        return decode_member(base64.b64decode(blob))
+    return decode_member(read_file_member(location))
+
+
+def archived_positions(hashes):
+    """reference -> positions of the stubs pointing to it"""
+    positions = {}
+    for i, raw_data in enumerate(hashes):
+        if is_archived(raw_data):
+            positions.setdefault(raw_data[ARCHIVED_FIELD], []).append(i)
+    return positions
+
+
+def apply_members(keys, hashes, positions, members):
+    """
+    Replace the stubs by the records of the loaded members.
+
+    Raises:
+        LookupError: If a member lacks the record of a stub pointing to it.
+    """
+    hashes = list(hashes)
+    for ref, indexes in positions.items():
+        for i in indexes:
+            try:
+                hashes[i] = members[ref][plain_key(keys[i])]
+            except KeyError:
+                raise LookupError(f'Archive member {ref} has no record of {keys[i]}')
+    return hashes
+
+
+def rehydrate(client, keys, hashes):
+    """
+    Replace archive stubs among fetched hashes by the archived hashes.
+
+    Args:
+        client: The Redis client, for members kept in Redis.
+        keys (list): The keys the hashes were fetched from.
+        hashes (list): The fetched hashes, in the order of keys.
+
+    Returns:
+        list: The hashes, unchanged if none of them is a stub.
+    """
+    positions = archived_positions(hashes)
+    if not positions:
+        return hashes
+    members = {ref: load_member(client, ref) for ref in positions}
+    return apply_members(keys, hashes, positions, members)
@@ -0,0 +1,576 @@
+"""
+Async (ASGI) variant of the patient assessment API
+
+Serves the same routes as app.py, but on Quart and redis.asyncio, so a slow
+Redis call no longer blocks a worker while other tablets wait. All requests
+share one bounded connection pool. The long-running /api/export is only served
+by app.py (or its export command).
+
+Run it with an ASGI server, for example:
+    pip install -r requirements-asgi.txt
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+
+Pool configuration (environment variables):
+    REDIS_MAX_CONNECTIONS    Size of the connection pool (default 50)
+    REDIS_POOL_TIMEOUT       Seconds to wait for a free connection (default 5)
+    REDIS_SOCKET_TIMEOUT     Seconds to wait for a Redis reply (default 5)
+    REDIS_CONNECT_TIMEOUT    Seconds to wait for a new connection (default 2)
+
+Uploads to /api/bulk-import are limited to MAX_UPLOAD_BYTES (default 256 MiB).
+"""
+
+import asyncio
+import io
+import os
+import tempfile
+import time
+
+import redis.asyncio as aioredis
+from quart import Quart, jsonify, request
+from quart_cors import cors
+
+from api_common import (
+    READ_CACHE_MAXSIZE,
+    READ_CACHE_PUBSUB,
+    READ_CACHE_TTL,
+    ApiError,
+    all_data_response,
+    assessment_response,
+    assessments_response,
+    create_timestamp,
+    discharged_response,
+    failure_response,
+    import_failed_response,
+    lab_range_error,
+    lab_samples_response,
+    lab_series_response,
+    lab_write_commands,
+    latest_response,
+    medication_search_response,
+    medications_response,
+    medications_saved_response,
+    parse_aggregate_request,
+    parse_assessment,
+    parse_discharge_request,
+    parse_import_batch_size,
+    parse_lab,
+    parse_lab_range,
+    parse_lab_samples,
+    parse_medication_plan,
+    parse_medication_search,
+    parse_new_patient,
+    parse_page_request,
+    parse_risk_patients,
+    parse_slot_filter,
+    parse_snapshot,
+    parse_ward_lab_request,
+    patient_created_response,
+    patient_exists_error,
+    patient_not_found,
+    patient_response,
+    queued_response,
+    readmitted_response,
+    redis_error_response,
+    require_risk_model,
+    risk_response,
+    risk_stats_response,
+    saved_response,
+    snapshot_response,
+    ward_labs_response,
+)
+from assessment_format import encode_for_storage
+from assessment_index import REDIS_CLUSTER
+from assessment_scores import score_assessment
+from bulk_import import BulkImportError, import_source, upload_format
+from lab_series import mrange_command, range_command
+from medications import MEDICATION_INDEX, list_query, queue_replace_slot, slot_keys_query
+from read_cache import INVALIDATION_CHANNEL, ReadCache, listen_for_invalidations
+from risk_model import (
+    RISK_CACHE_MAXSIZE,
+    RISK_CACHE_TTL,
+    LatencyWindow,
+    cache_scores,
+    cached_scores,
+    load_risk_model,
+)
+from retention import DISCHARGED_FIELD
+from async_store import (
+    aggregate_score,
+    assessment_page,
+    ensure_medication_index,
+    fetch_hashes,
+    import_rows,
+    latest_assessment,
+    latest_assessment_matrix,
+    save_assessment_record,
+    score_aggregates,
+)
+from write_behind import (
+    FAILED_STREAM,
+    WRITE_BEHIND,
+    WRITE_GROUP,
+    WRITE_STREAM,
+    status_entry,
+    write_entry,
+)
+
+app = cors(Quart(__name__))
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_BYTES', 256 * 1024 * 1024))
+
+# Redis configuration
+redis_host = os.getenv('REDIS_HOST', 'localhost')
+redis_port = int(os.getenv('REDIS_PORT', 6379))
+redis_max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+redis_pool_timeout = float(os.getenv('REDIS_POOL_TIMEOUT', 5))
+redis_socket_timeout = float(os.getenv('REDIS_SOCKET_TIMEOUT', 5))
+redis_connect_timeout = float(os.getenv('REDIS_CONNECT_TIMEOUT', 2))
+# Uploads larger than this are buffered on disk instead of in memory
+upload_spool_bytes = 1024 * 1024
+
+redis_client = None
+invalidation_listener = None
+
+# Lab series known to exist with their compaction rules
+created_lab_series = set()
+
+# The medication index is checked once per process, on first use
+medication_index_ready = False
+
+# In-process cache for patient existence, patient hashes and latest assessments
+read_cache = ReadCache(maxsize=READ_CACHE_MAXSIZE, ttl=READ_CACHE_TTL)
+
+# Risk model from RISK_MODEL_PATH, loaded once; scores are cached until the next save
+risk_model = load_risk_model()
+risk_cache = ReadCache(maxsize=RISK_CACHE_MAXSIZE, ttl=RISK_CACHE_TTL)
+risk_latency = LatencyWindow()
+
+
+@app.before_serving
+async def connect_redis():
+    """Create the pooled client inside the event loop of the server"""
+    global redis_client, invalidation_listener
+    if REDIS_CLUSTER:
+        # REDIS_HOST/REDIS_PORT name any node, the others are discovered
+        redis_client = aioredis.RedisCluster(
+            host=redis_host,
+            port=redis_port,
+            decode_responses=True,
+            max_connections=redis_max_connections,
+            socket_timeout=redis_socket_timeout,
+            socket_connect_timeout=redis_connect_timeout,
+        )
+        await redis_client.initialize()
+    else:
+        redis_client = aioredis.StrictRedis(
+            connection_pool=aioredis.BlockingConnectionPool(
+                host=redis_host,
+                port=redis_port,
+                decode_responses=True,
+                max_connections=redis_max_connections,
+                timeout=redis_pool_timeout,
+                socket_timeout=redis_socket_timeout,
+                socket_connect_timeout=redis_connect_timeout,
+            )
+        )
+    if READ_CACHE_PUBSUB and (read_cache.enabled or risk_cache.enabled):
+        invalidation_listener = asyncio.create_task(
+            listen_for_invalidations(redis_client, read_cache, risk_cache)
+        )
+
+
+@app.after_serving
+async def disconnect_redis():
+    if invalidation_listener is not None:
+        invalidation_listener.cancel()
+    await redis_client.aclose()
+
+
+@app.errorhandler(ApiError)
+async def api_error(error):
+    """Requests rejected by the shared parsing of api_common"""
+    return error.response()
+
+
+@app.errorhandler(aioredis.ResponseError)
+async def redis_error(error):
+    """503 for the routes of a Redis module that is not loaded"""
+    return redis_error_response(error)
+
+
+async def validate_patient_exists(patient_id):
+    """Check if a patient exists in the database"""
+    hit, exists = read_cache.get(patient_id, 'exists')
+    if hit:
+        return exists
+    generation = read_cache.generation(patient_id)
+    exists = bool(await redis_client.exists(patient_id))
+    read_cache.set(patient_id, 'exists', exists, generation=generation)
+    return exists
+
+
+async def invalidate_patient(patient_id):
+    """Drop the cached reads of a patient after it was written to"""
+    read_cache.invalidate_patient(patient_id)
+    risk_cache.invalidate_patient(patient_id)
+    if READ_CACHE_PUBSUB and (read_cache.enabled or risk_cache.enabled):
+        await redis_client.publish(INVALIDATION_CHANNEL, patient_id)
+
+
+async def cached_latest_assessment(patient_id, assessment_name):
+    """latest_assessment, served from the read cache when possible"""
+    hit, latest = read_cache.get(patient_id, 'latest', assessment_name)
+    if hit:
+        return latest
+    generation = read_cache.generation(patient_id)
+    latest = await latest_assessment(redis_client, patient_id, assessment_name)
+    read_cache.set(patient_id, 'latest', latest, name=assessment_name, generation=generation)
+    return latest
+
+
+async def risk_scores(patient_ids, kind):
+    """See app.risk_scores, the prediction runs in a thread to keep the loop free"""
+    scores, missing, generations = cached_scores(risk_cache, patient_ids)
+    if missing:
+        started = time.perf_counter()
+        matrix = await latest_assessment_matrix(redis_client, missing, risk_model.assessment_names)
+        computed = await asyncio.to_thread(risk_model.score_matrix, matrix)
+        risk_latency.observe(kind, time.perf_counter() - started)
+        cache_scores(risk_cache, computed, generations)
+        scores.update(computed)
+    return scores
+
+
+async def medication_index():
+    """The search interface of the medication index, created if needed"""
+    global medication_index_ready
+    if not medication_index_ready:
+        await ensure_medication_index(redis_client)
+        medication_index_ready = True
+    return redis_client.ft(MEDICATION_INDEX)
+
+
+@app.route('/api', methods=['POST'])
+async def create():
+    """Create a new patient record, see app.create"""
+    identifier = parse_new_patient(await request.get_json(silent=True))
+    if await redis_client.exists(identifier):
+        raise patient_exists_error()
+
+    await redis_client.hset(identifier, mapping={'created': 'true'})
+    await invalidate_patient(identifier)
+    return patient_created_response()
+
+
+async def cached_patient_hash(patient_id):
+    hit, hashmap = read_cache.get(patient_id, 'hash')
+    if not hit:
+        generation = read_cache.generation(patient_id)
+        hashmap = await redis_client.hgetall(patient_id)
+        read_cache.set(patient_id, 'hash', hashmap, generation=generation)
+    return hashmap
+
+
+@app.route('/api/<identifier>', methods=['GET'])
+async def get(identifier):
+    return patient_response(await cached_patient_hash(identifier))
+
+
+@app.route('/api/<patient_id>/discharge', methods=['PUT'])
+async def discharge_patient(patient_id):
+    """Mark a patient as discharged for the retention, see app.discharge_patient"""
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found()
+    discharge_date = parse_discharge_request(await request.get_json(silent=True))
+
+    await redis_client.hset(patient_id, DISCHARGED_FIELD, discharge_date)
+    await invalidate_patient(patient_id)
+    return discharged_response(discharge_date)
+
+
+@app.route('/api/<patient_id>/discharge', methods=['DELETE'])
+async def readmit_patient(patient_id):
+    """Remove the discharge mark of a readmitted patient, see app.readmit_patient"""
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found()
+    await redis_client.hdel(patient_id, DISCHARGED_FIELD)
+    await invalidate_patient(patient_id)
+    return readmitted_response()
+
+
+@app.route('/api/<patient_id>/<assessment_name>', methods=['POST'])
+async def save_assessment(patient_id, assessment_name):
+    """Saves an assessment for a given patient, see app.save_assessment"""
+    if WRITE_BEHIND:
+        return await queue_assessment(patient_id, assessment_name)
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found()
+    data = parse_assessment(await request.get_json(silent=True))
+
+    score = score_assessment(assessment_name, data)
+    unix_timestamp, human_readable = create_timestamp()
+    key = await save_assessment_record(
+        redis_client, patient_id, assessment_name,
+        encode_for_storage(data, score=score), unix_timestamp, human_readable
+    )
+    if score is not None and score['total'] is not None:
+        await aggregate_score(
+            redis_client, patient_id, await cached_patient_hash(patient_id),
+            assessment_name, score['total'], unix_timestamp
+        )
+    await invalidate_patient(patient_id)
+    return saved_response(key, score, unix_timestamp, human_readable)
+
+
+async def queue_assessment(patient_id, assessment_name):
+    """Write-behind variant of save_assessment, see app.queue_assessment"""
+    if not await cached_patient_hash(patient_id):
+        raise patient_not_found()
+    data = parse_assessment(await request.get_json(silent=True))
+
+    score = score_assessment(assessment_name, data)
+    unix_timestamp, human_readable = create_timestamp()
+    entry_id = await redis_client.xadd(WRITE_STREAM, write_entry(
+        patient_id, assessment_name, encode_for_storage(data, score=score),
+        unix_timestamp, human_readable, score
+    ))
+    return queued_response(entry_id, score, unix_timestamp, human_readable)
+
+
+@app.route('/api/<patient_id>/<assessment_name>', methods=['GET'])
+async def get_assessment(patient_id, assessment_name):
+    """Endpoint to retrieve an assessment for a given patient, see app.get_assessment"""
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found('Patient ID does not exist or might need to be created')
+    return assessment_response(await redis_client.hgetall(f"{patient_id}:{assessment_name}"))
+
+
+@app.route('/api/<patient_id>/assessments', methods=['GET'])
+async def get_assessments(patient_id):
+    """Retrieve one page of assessments for a given patient, see app.get_assessments"""
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found()
+
+    sorted_keys, next_cursor = await assessment_page(
+        redis_client, patient_id, **parse_page_request(request.args)
+    )
+    hashes = await fetch_hashes(redis_client, sorted_keys)
+    return assessments_response(sorted_keys, hashes, next_cursor)
+
+
+@app.route('/api/<identifier>/all', methods=['GET'])
+async def get_all_data(identifier):
+    """Endpoint to retrieve all data associated with a given identifier, see app.get_all_data"""
+    if not await validate_patient_exists(identifier):
+        raise patient_not_found('Patient ID does not exist or might need to be created')
+
+    keys, next_cursor = await assessment_page(
+        redis_client, identifier, **parse_page_request(request.args)
+    )
+    return all_data_response(keys, await fetch_hashes(redis_client, keys), next_cursor)
+
+
+async def latest_assessment_response(patient_id, assessment_name, decode_json=True, label=None):
+    """Shared implementation of the /latest routes, see app.latest_assessment_response"""
+    label = label or assessment_name
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found('Patient not found')
+
+    try:
+        latest_key, raw_data = await cached_latest_assessment(patient_id, assessment_name)
+        return latest_response(latest_key, raw_data, decode_json, label)
+    except Exception as e:
+        return failure_response(f'Failed to retrieve latest {label} assessment', e)
+
+
+@app.route('/api/<patient_id>/barthel/latest', methods=['GET'])
+async def get_latest_barthel(patient_id):
+    return await latest_assessment_response(
+        patient_id, 'Barthel Index', decode_json=False, label='Barthel'
+    )
+
+
+@app.route('/api/<patient_id>/<assessment_name>/latest', methods=['GET'])
+async def get_latest_assessment(patient_id, assessment_name):
+    return await latest_assessment_response(patient_id, assessment_name)
+
+
+@app.route('/api/<patient_id>/moca5min/latest', methods=['GET'])
+async def get_latest_moca5min(patient_id):
+    return await latest_assessment_response(patient_id, 'MoCA 5min', decode_json=False)
+
+
+@app.route('/api/ward-snapshot', methods=['GET', 'POST'])
+async def get_ward_snapshot():
+    """Latest assessments of many patients in one request, see app.get_ward_snapshot"""
+    patient_ids, assessment_names = parse_snapshot(
+        request.method, await request.get_json(silent=True), request.args
+    )
+    try:
+        matrix = await latest_assessment_matrix(redis_client, patient_ids, assessment_names)
+    except Exception as e:
+        return failure_response('Failed to retrieve ward snapshot', e)
+    return snapshot_response(matrix, request.args, request.headers)
+
+
+@app.route('/api/<patient_id>/labs/<lab>', methods=['POST'])
+async def add_lab_samples(patient_id, lab):
+    """Append lab values of a patient, see app.add_lab_samples"""
+    parse_lab(lab)
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found()
+    samples = parse_lab_samples(await request.get_json(silent=True))
+
+    pipe = redis_client.pipeline(transaction=False)
+    new_series = (patient_id, lab) not in created_lab_series
+    for command in lab_write_commands(patient_id, lab, samples, new_series):
+        pipe.execute_command(*command)
+    response = lab_samples_response(await pipe.execute(raise_on_error=False))
+    created_lab_series.add((patient_id, lab))
+    return response
+
+
+@app.route('/api/<patient_id>/labs/<lab>', methods=['GET'])
+async def get_lab_series(patient_id, lab):
+    """Retrieve the values of one lab series, see app.get_lab_series"""
+    parse_lab(lab)
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found()
+    range_args = parse_lab_range(request.args)
+
+    try:
+        reply = await redis_client.execute_command(*range_command(patient_id, lab, **range_args))
+    except aioredis.ResponseError as e:
+        return lab_range_error(e)
+    return lab_series_response(patient_id, lab, range_args, reply)
+
+
+@app.route('/api/ward-labs/<lab>', methods=['GET'])
+async def get_ward_lab_series(lab):
+    """One lab value for many patients with a single TS.MRANGE, see app.get_ward_lab_series"""
+    parse_lab(lab)
+    patient_ids, range_args = parse_ward_lab_request(request.args)
+    reply = await redis_client.execute_command(*mrange_command(lab, patient_ids, **range_args))
+    return ward_labs_response(lab, range_args, reply)
+
+
+@app.route('/api/<patient_id>/medications', methods=['GET'])
+async def get_medications(patient_id):
+    """Medication plan of a patient ordered by position, see app.get_medications"""
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found()
+    slot = parse_slot_filter(request.args)
+    result = await (await medication_index()).search(list_query(patient_id, slot))
+    return medications_response(patient_id, result)
+
+
+@app.route('/api/<patient_id>/medications/<slot>', methods=['PUT'])
+async def put_medications(patient_id, slot):
+    """Replace the medication plan of one slot, see app.put_medications"""
+    if not await validate_patient_exists(patient_id):
+        raise patient_not_found()
+    names = parse_medication_plan(slot, await request.get_json(silent=True))
+
+    index = await medication_index()
+    old_keys = [doc.id for doc in (await index.search(slot_keys_query(patient_id, slot))).docs]
+    pipe = redis_client.pipeline(transaction=True)
+    queue_replace_slot(pipe, patient_id, slot, names, old_keys)
+    await pipe.execute()
+    return medications_saved_response(names)
+
+
+@app.route('/api/medication-search', methods=['GET'])
+async def search_medications():
+    """Search medications by name, see app.search_medications"""
+    query = parse_medication_search(request.args)
+    return medication_search_response(await (await medication_index()).search(query))
+
+
+@app.route('/api/bulk-import', methods=['POST'])
+async def bulk_import():
+    """
+    Import many patients and assessments from one upload, see app.bulk_import.
+    The body is spooled to a temporary file while it arrives, so memory stays
+    bounded for large uploads.
+    """
+    batch_size = parse_import_batch_size(request.args)
+
+    with tempfile.SpooledTemporaryFile(max_size=upload_spool_bytes) as spool:
+        async for chunk in request.body:
+            spool.write(chunk)
+        spool.seek(0)
+        try:
+            rows, parse = import_source(
+                upload_format(request.args, request.content_type),
+                io.TextIOWrapper(spool, encoding='utf-8', newline=''),
+                id_column=request.args.get('id_column', 'id'),
+                assessment_name=request.args.get('assessment_name', 'OKIE'),
+            )
+        except ValueError as e:
+            raise ApiError(400, {'error': str(e)})
+
+        async def invalidate_batch(report, patient_ids):
+            for patient_id in patient_ids:
+                await invalidate_patient(patient_id)
+
+        try:
+            report = await import_rows(
+                redis_client, rows, parse, batch_size, on_batch=invalidate_batch
+            )
+        except BulkImportError as e:
+            return import_failed_response(e.report)
+        except Exception as e:
+            return failure_response('Bulk import failed', e)
+    return report, 200
+
+
+@app.route('/api/<patient_id>/risk', methods=['GET'])
+async def get_risk(patient_id):
+    """Score the risk of a patient, see app.get_risk"""
+    require_risk_model(risk_model)
+    return risk_response(patient_id, (await risk_scores([patient_id], 'single'))[patient_id])
+
+
+@app.route('/api/risk-scores', methods=['GET', 'POST'])
+async def get_risk_scores():
+    """Score many patients at once, see app.get_risk_scores"""
+    require_risk_model(risk_model)
+    patient_ids = parse_risk_patients(
+        request.method, await request.get_json(silent=True), request.args
+    )
+    return {'patients': await risk_scores(patient_ids, 'batch')}, 200
+
+
+@app.route('/api/risk-stats', methods=['GET'])
+async def get_risk_stats():
+    """The loaded risk model, p50/p99 scoring latency and the score cache counters"""
+    return risk_stats_response(risk_model, risk_latency, risk_cache)
+
+
+@app.route('/api/score-aggregates', methods=['GET'])
+async def get_score_aggregates():
+    """Score aggregates of the wards, see app.get_score_aggregates"""
+    wards, assessment_names, threshold = parse_aggregate_request(request.args)
+    try:
+        aggregates = await score_aggregates(redis_client, wards, assessment_names, threshold)
+    except Exception as e:
+        return failure_response('Failed to retrieve score aggregates', e)
+    return {'wards': aggregates}, 200
+
+
+@app.route('/api/write-queue', methods=['GET'])
+async def get_write_queue():
+    """Saves queued in write-behind mode, see app.get_write_queue"""
+    try:
+        pending = await redis_client.xpending(WRITE_STREAM, WRITE_GROUP)
+    except aioredis.ResponseError:
+        # No worker has created the group yet
+        pending = {'pending': 0}
+    length = await redis_client.xlen(WRITE_STREAM)
+    failed = await redis_client.xlen(FAILED_STREAM)
+    return jsonify(status_entry(length, pending, failed)), 200
+
+
+@app.route('/api/cache-stats', methods=['GET'])
+async def get_cache_stats():
+    """Hit, miss and eviction counters of the read cache"""
+    return jsonify(read_cache.stats()), 200
@@ -0,0 +1,125 @@
+"""
+Storage formats of assessment hashes
+
+Two formats can be read side by side:
+
+- hash (legacy): one hash field per answer, every value stringified and nested
+  dicts/lists JSON encoded per field.
+- blob: the whole assessment as one compact JSON document in the field
+  ``BLOB_FIELD``, tagged with a format version in ``FORMAT_FIELD``. Documents
+  larger than ASSESSMENT_BLOB_COMPRESS_MIN bytes are zlib compressed (and
+  base64 encoded, as the API client decodes replies as text).
+
+The blob is still kept in a Redis hash, so the index, the Lua scripts and all
+readers keep working on the same key type. New assessments are written in the
+format selected with ASSESSMENT_STORAGE (``hash`` or ``blob``).
+
+In both formats the score of a scored assessment (see assessment_scores) is
+stored next to the answers as a JSON document in ``SCORE_FIELD``. It is not
+part of the assessment: the decoders below leave it out, stored_score reads it.
+"""
+
+import base64
+import json
+import os
+import zlib
+
+ASSESSMENT_STORAGE = os.getenv('ASSESSMENT_STORAGE', 'hash')
+# Compress blobs above this size in bytes, 0 never compresses
+BLOB_COMPRESS_MIN = int(os.getenv('ASSESSMENT_BLOB_COMPRESS_MIN', 2048))
+
+FORMAT_FIELD = '__format__'
+BLOB_FIELD = '__blob__'
+FORMAT_JSON = 'json/1'
+FORMAT_JSON_ZLIB = 'json+zlib/1'
+SCORE_FIELD = '__score__'
+
+
+def encode_assessment(data):
+    """Convert all values to strings, including nested dictionaries"""
+    processed_data = {}
+    for key, value in data.items():
+        if isinstance(value, (dict, list)):
+            processed_data[key] = json.dumps(value)
+        else:
+            processed_data[key] = str(value) if value is not None else ''
+    return processed_data
+
+
+def encode_blob(data):
+    """Serialize a whole assessment into the blob format"""
+    document = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    if BLOB_COMPRESS_MIN and len(document) >= BLOB_COMPRESS_MIN:
+        compressed = zlib.compress(document.encode('utf-8'), 6)
+        return {
+            FORMAT_FIELD: FORMAT_JSON_ZLIB,
+            BLOB_FIELD: base64.b64encode(compressed).decode('ascii'),
+        }
+    return {FORMAT_FIELD: FORMAT_JSON, BLOB_FIELD: document}
+
+
+def encode_for_storage(data, storage=None, score=None):
+    """Encode an assessment in the configured storage format, with its score if given"""
+    if (storage or ASSESSMENT_STORAGE) == 'blob':
+        encoded = encode_blob(data)
+    else:
+        encoded = encode_assessment(data)
+    if score is not None:
+        encoded[SCORE_FIELD] = json.dumps(score, separators=(',', ':'))
+    return encoded
+
+
+def is_blob(raw_data):
+    return FORMAT_FIELD in raw_data
+
+
+def blob_json(raw_data):
+    """
+    Return the JSON document of a blob record without parsing it.
+
+    Raises:
+        ValueError: If the record carries an unknown format version.
+    """
+    storage_format = raw_data[FORMAT_FIELD]
+    if storage_format == FORMAT_JSON:
+        return raw_data[BLOB_FIELD]
+    if storage_format == FORMAT_JSON_ZLIB:
+        return zlib.decompress(base64.b64decode(raw_data[BLOB_FIELD])).decode('utf-8')
+    raise ValueError(f'Unknown assessment storage format {storage_format!r}')
+
+
+def decode_assessment(raw_data):
+    """Parse a stored assessment back into JSON values, whatever its format"""
+    if is_blob(raw_data):
+        return json.loads(blob_json(raw_data))
+    # Parse any JSON strings back to dictionaries
+    processed_data = {}
+    for key, value in raw_data.items():
+        if key == SCORE_FIELD:
+            continue
+        try:
+            processed_data[key] = json.loads(value)
+        except (json.JSONDecodeError, TypeError):
+            processed_data[key] = value
+    return processed_data
+
+
+def stored_fields(raw_data):
+    """
+    Return a stored assessment in the legacy string-per-field shape.
+
+    Hash records are returned untouched apart from the score; blob records are
+    decoded only here, for the endpoints whose clients expect the legacy shape.
+    """
+    if is_blob(raw_data):
+        return encode_assessment(json.loads(blob_json(raw_data)))
+    if SCORE_FIELD in raw_data:
+        return {key: value for key, value in raw_data.items() if key != SCORE_FIELD}
+    return raw_data
+
+
+def stored_score(raw_data):
+    """The score stored with an assessment, None if it was not scored"""
+    if not raw_data.get(SCORE_FIELD):
+        return None
+    return json.loads(raw_data[SCORE_FIELD])
@@ -0,0 +1,224 @@
+"""
+Secondary index for patient assessments stored in Redis
+
+Every assessment hash is written under a key of the form
+``patient_id:assessment_name:unix_timestamp:human_readable``. Instead of
+scanning the keyspace with KEYS to find them again, the keys are also added to
+two sorted sets scored by their unix timestamp:
+
+- ``idx:<patient_id>`` holds every assessment of a patient
+- ``idx:<patient_id>:<assessment_name>`` holds the assessments of one type
+
+Lookups then cost O(log n) in the size of one patient's history instead of
+O(n) in the size of the whole database. In addition ``latest:<patient_id>:<assessment_name>``
+is a small hash pointing at the newest assessment of that type.
+
+Key schema versions (KEY_SCHEMA_VERSION):
+
+1. The layout above.
+2. The patient ID inside these keys is a hash tag, e.g. ``{p1}:Barthel Index:...``
+   and ``idx:{p1}``, so Redis Cluster puts all keys of a patient into one hash
+   slot and the save script, the latest lookup and per-patient pipelines stay
+   on one shard. The patient hash itself keeps the key ``<patient_id>``: a key
+   without braces is hashed as a whole, which is the same slot as ``{<patient_id>}``.
+
+Keys written with version 1 are moved by key_migration. Until that has run,
+LEGACY_KEY_FALLBACK makes reads (and saves of patients not migrated yet) use
+the version 1 keys of a patient whose version 2 keys do not exist. Version 1
+keys of a patient are spread over several slots, so the fallback is off with
+REDIS_CLUSTER=1; migrate before switching to a cluster.
+"""
+
+import os
+
+INDEX_PREFIX = 'idx'
+LATEST_PREFIX = 'latest'
+
+KEY_SCHEMA_VERSION = int(os.getenv('KEY_SCHEMA_VERSION', 2))
+REDIS_CLUSTER = os.getenv('REDIS_CLUSTER', '0') == '1'
+LEGACY_KEY_FALLBACK = (
+    KEY_SCHEMA_VERSION >= 2
+    and os.getenv('LEGACY_KEY_FALLBACK', '0' if REDIS_CLUSTER else '1') == '1'
+)
+
+
+def patient_tag(patient_id, schema=None):
+    """The patient ID as it appears in keys of the given (default: current) schema"""
+    if (schema or KEY_SCHEMA_VERSION) >= 2:
+        return f"{{{patient_id}}}"
+    return patient_id
+
+
+def assessment_key(patient_id, assessment_name, unix_timestamp, human_readable, schema=None):
+    """Key of an assessment hash"""
+    return f"{patient_tag(patient_id, schema)}:{assessment_name}:{unix_timestamp}:{human_readable}"
+
+
+def patient_index_key(patient_id, schema=None):
+    """Sorted set holding all assessment keys of a patient"""
+    return f"{INDEX_PREFIX}:{patient_tag(patient_id, schema)}"
+
+
+def assessment_index_key(patient_id, assessment_name, schema=None):
+    """Sorted set holding the assessment keys of one type for a patient"""
+    return f"{INDEX_PREFIX}:{patient_tag(patient_id, schema)}:{assessment_name}"
+
+
+def latest_pointer_key(patient_id, assessment_name, schema=None):
+    """Hash pointing at the newest assessment of one type for a patient"""
+    return f"{LATEST_PREFIX}:{patient_tag(patient_id, schema)}:{assessment_name}"
+
+
+def key_schema(key):
+    """Schema version an assessment key was written with"""
+    return 2 if key.startswith('{') else 1
+
+
+def parse_assessment_key(key):
+    """
+    Split an assessment key into its parts.
+
+    Returns:
+        tuple: (patient_id, assessment_name, unix_timestamp, human_readable)
+               or None if the key does not follow the assessment key layout.
+    """
+    key_parts = key.split(':')
+    if len(key_parts) < 4 or not key_parts[2].isdigit():
+        return None
+    # The human readable timestamp itself contains colons, saves within the
+    # same second carry an additional #n suffix
+    human_readable = ':'.join(key_parts[3:]).split('#')[0]
+    patient_id = key_parts[0]
+    if patient_id.startswith('{') and patient_id.endswith('}'):
+        patient_id = patient_id[1:-1]
+    return patient_id, key_parts[1], int(key_parts[2]), human_readable
+
+
+def index_assessment(pipe, patient_id, assessment_name, key, unix_timestamp):
+    """Queue the index updates for a freshly written assessment on a pipeline"""
+    schema = key_schema(key)
+    pipe.zadd(patient_index_key(patient_id, schema), {key: unix_timestamp})
+    pipe.zadd(assessment_index_key(patient_id, assessment_name, schema), {key: unix_timestamp})
+    return pipe
+
+
+def index_key_for(patient_id, assessment_name=None, schema=None):
+    """The patient index, or the index of one assessment type"""
+    if assessment_name is None:
+        return patient_index_key(patient_id, schema)
+    return assessment_index_key(patient_id, assessment_name, schema)
+
+
+def assessment_keys(client, patient_id, assessment_name=None):
+    """Return the assessment keys of a patient, newest first"""
+    keys = client.zrevrange(index_key_for(patient_id, assessment_name), 0, -1)
+    if not keys and LEGACY_KEY_FALLBACK:
+        keys = client.zrevrange(index_key_for(patient_id, assessment_name, schema=1), 0, -1)
+    return keys
+
+
+def page_query(patient_id, assessment_name=None, cursor=None, since=None, until=None):
+    """
+    Translate the page parameters into a ZREVRANGEBYSCORE window.
+
+    Returns:
+        tuple: (index_key, max_score, min_score, skip)
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    index_key = index_key_for(patient_id, assessment_name)
+
+    max_score = '+inf' if until is None else until
+    min_score = '-inf' if since is None else since
+    skip = 0
+    if cursor:
+        # The cursor is "<score>-<n>": continue below that timestamp, skipping
+        # the n keys with exactly that score that were already returned
+        cursor_score, cursor_skip = (int(part) for part in cursor.split('-'))
+        max_score, skip = cursor_score, cursor_skip
+    return index_key, max_score, min_score, skip
+
+
+def page_result(entries, limit, max_score, skip):
+    """
+    Cut the (key, score) entries read with limit + 1 down to one page.
+
+    Returns:
+        tuple: (keys, next_cursor), next_cursor is None on the last page.
+    """
+    page = entries[:limit]
+    if len(entries) <= limit:
+        return [key for key, _ in page], None
+
+    last_score = int(page[-1][1])
+    seen = sum(1 for _, score in page if int(score) == last_score)
+    if skip and last_score == max_score:
+        seen += skip
+    return [key for key, _ in page], f"{last_score}-{seen}"
+
+
+def assessment_page(client, patient_id, assessment_name=None, limit=100,
+                    cursor=None, since=None, until=None):
+    """
+    Return one page of a patient's assessment keys, newest first.
+
+    Only the requested window is read from Redis (ZREVRANGEBYSCORE with
+    LIMIT), so the cost is bounded by the page size and not by the length of
+    the history. With LEGACY_KEY_FALLBACK an empty window is read again from
+    the version 1 index, for patients that have not been migrated yet.
+
+    Args:
+        client: The Redis client to read from.
+        patient_id (str): The ID of the patient.
+        assessment_name (str): Restrict the page to one assessment type.
+        limit (int): The maximum number of keys to return.
+        cursor (str): The cursor returned with the previous page.
+        since (int): Only include assessments at or after this unix timestamp.
+        until (int): Only include assessments at or before this unix timestamp.
+
+    Returns:
+        tuple: (keys, next_cursor), next_cursor is None on the last page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    index_key, max_score, min_score, skip = page_query(
+        patient_id, assessment_name, cursor, since, until
+    )
+    entries = client.zrevrangebyscore(
+        index_key, max_score, min_score, start=skip, num=limit + 1, withscores=True
+    )
+    if not entries and LEGACY_KEY_FALLBACK:
+        entries = client.zrevrangebyscore(
+            index_key_for(patient_id, assessment_name, schema=1),
+            max_score, min_score, start=skip, num=limit + 1, withscores=True
+        )
+    return page_result(entries, limit, max_score, skip)
+
+
+def build_index(client, batch_size=500):
+    """
+    Build the index from the assessment keys already stored in Redis.
+
+    Walks the keyspace with SCAN so Redis is never blocked for long and adds
+    every ``patient:assessment:unix:human`` key to the sorted sets of its own
+    key schema. Running it again is harmless, ZADD simply overwrites the
+    existing scores.
+
+    Returns:
+        int: The number of assessment keys that were indexed.
+    """
+    indexed = 0
+    pipe = client.pipeline(transaction=False)
+    for key in client.scan_iter(match='*:*:*:*', count=batch_size, _type='hash'):
+        parsed = parse_assessment_key(key)
+        if parsed is None or parsed[0] in (INDEX_PREFIX, LATEST_PREFIX):
+            continue
+        patient_id, assessment_name, unix_timestamp, _ = parsed
+        index_assessment(pipe, patient_id, assessment_name, key, unix_timestamp)
+        indexed += 1
+        if indexed % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+    return indexed
@@ -0,0 +1,496 @@
+"""
+Scores of Barthel Index and MoCA 5min assessments, computed when they are saved
+
+The Flutter app stores the item answers of these assessments; the totals were
+recomputed by every consumer. save_assessment now scores an assessment whose
+name starts with one of the prefixes in SCORERS, returns the result and stores
+it in the assessment hash next to the answers (assessment_format.SCORE_FIELD,
+read back with stored_score), so it does not show up in the assessment data
+the GET endpoints, the export and the risk model see:
+
+    {"scorer": "barthel", "version": 1, "total": 85,
+     "subscores": {"self_care": 40, "mobility": 35, "continence": 10}}
+
+``total`` is null when an item is missing (or, for the MoCA, when it was not
+answered by the patient), such an assessment is not aggregated.
+
+Per ward and assessment name the latest total of every patient is aggregated
+under keys hash-tagged with the ward, so one script updates them atomically:
+
+- ``scores:{<ward>}:<assessment_name>`` sorted set patient -> latest total,
+  queried with ZRANGEBYSCORE for the patients below a threshold
+- ``scores:{<ward>}:<assessment_name>:stats`` hash with count, sum, the
+  bucket size and one ``bucket:<lower bound>`` counter per distribution bucket
+- ``scores:{<ward>}:<assessment_name>:updated`` hash patient -> unix timestamp
+  of the aggregated assessment, so an older assessment saved later (e.g. by an
+  import) does not replace a newer score
+- ``scores:{<ward>}:assessments`` and ``scores:wards`` list what exists
+
+The ward is the field ``station`` (or ``ward``) of the patient hash, patients
+without one are aggregated as DEFAULT_WARD. The ward a patient was aggregated
+in is remembered in ``scores:ward:{<patient_id>}``, next to the patient hash in
+its hash slot but not part of it; when it changes, all scores of the patient
+are moved to the new ward on the next scored save.
+
+Assessments written by bulk import are not scored, ``flask --app app
+rebuild-scores`` recomputes the aggregates from the latest assessments.
+
+Scoring, keys, scripts and reply parsing are shared with the ASGI app, the
+Redis I/O has its asyncio counterpart in async_store.
+"""
+
+import json
+import math
+import os
+
+from assessment_format import decode_assessment, stored_score
+from assessment_index import parse_assessment_key
+from assessment_store import run_script
+from export import latest_keys, patient_chunks, window_keys
+from redis_batch import fetch_hashes
+
+SCORE_VERSION = 1
+SCORE_PREFIX = 'scores'
+WARDS_KEY = f'{SCORE_PREFIX}:wards'
+WARD_FIELDS = ('station', 'ward')
+DEFAULT_WARD = 'unassigned'
+
+# Items of the Barthel Index (points as entered) by subscore
+BARTHEL_SUBSCORES = {
+    'self_care': ('essen', 'waschen', 'toilette', 'baden', 'kleiden'),
+    'mobility': ('aufstehen', 'aufstehengehen', 'treppensteigen'),
+    'continence': ('stuhlkontrollen', 'harnkontrollen'),
+}
+# Answers of "anamnese" for which the app does not compute a MoCA score
+MOCA_NOT_SCORED = (1, 2)
+# Subscores of the MoCA 5-Min form that asks for them directly
+MOCA_ITEM_SCORES = ('memory_score', 'attention_score', 'fluency_score', 'orientation_score')
+
+
+def _number(value):
+    """An answer as a number, None if it is missing"""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        number = float(str(value).strip())
+    except ValueError:
+        return None
+    if math.isnan(number):
+        return None
+    return int(number) if number.is_integer() else number
+
+
+def _answered(value):
+    return value is True or str(value).strip().lower() in ('true', '1')
+
+
+def _list(value):
+    """A list answer, also when it arrives JSON encoded"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            return None
+    return value if isinstance(value, list) else None
+
+
+def score_barthel(data):
+    """Total and subscores of a Barthel Index, the total is None if an item is missing"""
+    subscores = {}
+    for subscore, items in BARTHEL_SUBSCORES.items():
+        points = [_number(data.get(item)) for item in items]
+        subscores[subscore] = None if None in points else sum(points)
+    if None in subscores.values():
+        return None, subscores
+    return sum(subscores.values()), subscores
+
+
+def score_moca5min(data):
+    """
+    Score a MoCA 5min the way the app does (moca_5min_assessment_buttons_recode).
+
+    Word recognition and orientation count one point per answer, the language
+    task half a point per word and the delayed recall two points for a word
+    recalled freely and one for a word recalled with a cue. The total is
+    truncated to an integer.
+    """
+    if _number(data.get('anamnese')) in MOCA_NOT_SCORED:
+        return None, {}
+    word_recognition = _list(data.get('word_recognition'))
+    orientation = _list(data.get('orientation'))
+    memory_recall = _list(data.get('memory_recall'))
+    words = _number(data.get('counter_stopwatch'))
+    if word_recognition is None or orientation is None or memory_recall is None:
+        return None, {}
+    subscores = {
+        'attention': sum(1 for answer in word_recognition if _answered(answer)),
+        'language': (words or 0) * 0.5,
+        'orientation': sum(1 for answer in orientation if _answered(answer)),
+        'memory': sum(
+            (2 if _answered(tries[0]) else 0) + (1 if len(tries) > 1 and _answered(tries[1]) else 0)
+            for tries in memory_recall if isinstance(tries, list) and tries
+        ),
+    }
+    return int(sum(subscores.values())), subscores
+
+
+def score_moca5min_items(data):
+    """Score the MoCA 5-Min form whose subscores are entered directly"""
+    subscores = {item.replace('_score', ''): _number(data.get(item)) for item in MOCA_ITEM_SCORES}
+    if None in subscores.values():
+        return None, subscores
+    return sum(subscores.values()), subscores
+
+
+# (assessment name prefix, scorer, scoring function, bucket size); the first
+# matching prefix wins
+SCORERS = (
+    ('Barthel Index', 'barthel', score_barthel, 10),
+    ('MoCA 5min', 'moca5min', score_moca5min, 5),
+    ('MoCA 5-Min', 'moca5min', score_moca5min_items, 5),
+)
+
+# Totals below these count as "below threshold" unless the request passes one
+SCORE_THRESHOLDS = {
+    'barthel': float(os.getenv('SCORE_THRESHOLD_BARTHEL', 60)),
+    'moca5min': float(os.getenv('SCORE_THRESHOLD_MOCA5MIN', 19)),
+}
+
+
+def scorer_for(assessment_name):
+    """(scorer, scoring function, bucket size) of an assessment, None if it is not scored"""
+    for prefix, scorer, function, bucket_size in SCORERS:
+        if assessment_name.startswith(prefix):
+            return scorer, function, bucket_size
+    return None
+
+
+def score_assessment(assessment_name, data):
+    """
+    Score an assessment before it is stored.
+
+    Returns:
+        dict: The score stored with the assessment, None if the assessment type is not scored.
+    """
+    found = scorer_for(assessment_name)
+    if found is None:
+        return None
+    scorer, function, _ = found
+    total, subscores = function(data)
+    return {'scorer': scorer, 'version': SCORE_VERSION, 'total': total, 'subscores': subscores}
+
+
+def patient_ward(patient_hash):
+    for field in WARD_FIELDS:
+        if patient_hash.get(field):
+            return patient_hash[field]
+    return DEFAULT_WARD
+
+
+def ward_marker_key(patient_id):
+    """The key remembering the ward a patient's scores are aggregated in"""
+    return f'{SCORE_PREFIX}:ward:{{{patient_id}}}'
+
+
+def ward_names_key(ward):
+    return f'{SCORE_PREFIX}:{{{ward}}}:assessments'
+
+
+def aggregate_keys(ward, assessment_name):
+    """KEYS of UPDATE_AGGREGATE_SCRIPT: scores, stats, updated, assessment names"""
+    base = f'{SCORE_PREFIX}:{{{ward}}}:{assessment_name}'
+    return [base, f'{base}:stats', f'{base}:updated', ward_names_key(ward)]
+
+
+def aggregate_args(patient_id, assessment_name, total, unix_timestamp):
+    _, _, bucket_size = scorer_for(assessment_name)
+    return [patient_id, total, unix_timestamp, bucket_size, assessment_name]
+
+
+# KEYS: see aggregate_keys
+# ARGV: patient ID, total, unix timestamp, bucket size, assessment name
+# Returns 1 if the score replaced the previous one of the patient, 0 if it is older
+UPDATE_AGGREGATE_SCRIPT = """
+local patient_id, total, unix_timestamp = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket_size = tonumber(ARGV[4])
+local updated = tonumber(redis.call('HGET', KEYS[3], patient_id) or '-1')
+if unix_timestamp < updated then
+    return 0
+end
+local previous = redis.call('ZSCORE', KEYS[1], patient_id)
+if previous then
+    previous = tonumber(previous)
+    redis.call('HINCRBY', KEYS[2], 'count', -1)
+    redis.call('HINCRBYFLOAT', KEYS[2], 'sum', -previous)
+    redis.call('HINCRBY', KEYS[2], 'bucket:' .. math.floor(previous / bucket_size) * bucket_size, -1)
+end
+redis.call('ZADD', KEYS[1], total, patient_id)
+redis.call('HSET', KEYS[3], patient_id, unix_timestamp)
+redis.call('HINCRBY', KEYS[2], 'count', 1)
+redis.call('HINCRBYFLOAT', KEYS[2], 'sum', total)
+redis.call('HINCRBY', KEYS[2], 'bucket:' .. math.floor(total / bucket_size) * bucket_size, 1)
+redis.call('HSET', KEYS[2], 'bucket_size', bucket_size)
+redis.call('SADD', KEYS[4], ARGV[5])
+return 1
+"""
+
+# KEYS: assessment names of the ward (ward_names_key)
+# ARGV: patient ID, key prefix of the ward ("scores:{<ward>}:")
+# The keys of the ward's aggregates are derived from the names, they share its hash tag.
+# Returns name, total, unix timestamp of every score removed
+REMOVE_PATIENT_SCRIPT = """
+local patient_id, prefix = ARGV[1], ARGV[2]
+local removed = {}
+for _, name in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local base = prefix .. name
+    local total = redis.call('ZSCORE', base, patient_id)
+    if total then
+        local bucket_size = tonumber(redis.call('HGET', base .. ':stats', 'bucket_size'))
+        local unix_timestamp = redis.call('HGET', base .. ':updated', patient_id)
+        total = tonumber(total)
+        redis.call('ZREM', base, patient_id)
+        redis.call('HDEL', base .. ':updated', patient_id)
+        redis.call('HINCRBY', base .. ':stats', 'count', -1)
+        redis.call('HINCRBYFLOAT', base .. ':stats', 'sum', -total)
+        redis.call('HINCRBY', base .. ':stats', 'bucket:' .. math.floor(total / bucket_size) * bucket_size, -1)
+        table.insert(removed, name)
+        table.insert(removed, tostring(total))
+        table.insert(removed, unix_timestamp or '0')
+    end
+end
+return removed
+"""
+
+
+def remove_patient_args(patient_id, ward):
+    return [patient_id, f'{SCORE_PREFIX}:{{{ward}}}:']
+
+
+def parse_removed(result):
+    """(assessment name, total, unix timestamp) of REMOVE_PATIENT_SCRIPT's reply"""
+    return [
+        (result[i], _number(result[i + 1]), int(result[i + 2]))
+        for i in range(0, len(result), 3)
+    ]
+
+
+def parse_aggregate_args(args):
+    """
+    Read the query string of the aggregates endpoint.
+
+    Returns:
+        tuple: (wards or None for all, assessment names or None for all,
+                threshold or None for the defaults of SCORE_THRESHOLDS)
+
+    Raises:
+        ValueError: If the threshold is not a number.
+    """
+    wards = [ward for ward in args.get('ward', '').split(',') if ward] or None
+    names = [name for name in args.get('assessment_name', '').split(',') if name] or None
+    threshold = args.get('threshold')
+    if threshold is not None:
+        try:
+            threshold = float(threshold)
+        except ValueError:
+            raise ValueError('threshold must be a number')
+    return wards, names, threshold
+
+
+def threshold_for(assessment_name, threshold=None):
+    if threshold is not None:
+        return threshold
+    return SCORE_THRESHOLDS.get(scorer_for(assessment_name)[0])
+
+
+def queue_aggregate_read(pipe, ward, assessment_name, threshold=None):
+    scores_key, stats_key, _, _ = aggregate_keys(ward, assessment_name)
+    pipe.hgetall(stats_key)
+    pipe.zrangebyscore(scores_key, '-inf', f'({threshold_for(assessment_name, threshold)}',
+                       withscores=True)
+
+
+def aggregate_entry(assessment_name, stats, below, threshold=None):
+    """Shape the stats hash and the patients below the threshold of one aggregate"""
+    count = int(stats.get('count', 0))
+    total = float(stats.get('sum', 0))
+    buckets = {
+        field.split(':', 1)[1]: int(value)
+        for field, value in stats.items()
+        if field.startswith('bucket:') and int(value)
+    }
+    return {
+        'scorer': scorer_for(assessment_name)[0],
+        'count': count,
+        'mean': round(total / count, 2) if count else None,
+        'buckets': dict(sorted(buckets.items(), key=lambda item: float(item[0]))),
+        'threshold': threshold_for(assessment_name, threshold),
+        'below_threshold': {patient_id: _number(score) for patient_id, score in below},
+    }
+
+
+def scored_names(names, wanted=None):
+    """The assessment names of a ward that are still scored, optionally filtered"""
+    return sorted(
+        name for name in names
+        if scorer_for(name) is not None and (wanted is None or name in wanted)
+    )
+
+
+def queue_score_update(pipe, patient_id, ward, assessment_name, total, unix_timestamp):
+    run_script(
+        pipe, UPDATE_AGGREGATE_SCRIPT,
+        keys=aggregate_keys(ward, assessment_name),
+        args=aggregate_args(patient_id, assessment_name, total, unix_timestamp),
+    )
+
+
+def queue_aggregate_score(pipe, patient_id, patient_hash, assessment_name, total, unix_timestamp):
+    """
+    Queue the aggregation of a score in the ward of the patient hash.
+
+    The ward marker of the patient is swapped in the same pipeline, its reply
+    is the ward the patient was aggregated in before (see moved_from).
+
+    Returns:
+        tuple: (ward, position of the marker's reply in the results)
+    """
+    ward = patient_ward(patient_hash)
+    queue_score_update(pipe, patient_id, ward, assessment_name, total, unix_timestamp)
+    pipe.sadd(WARDS_KEY, ward)
+    marker = len(pipe)
+    pipe.set(ward_marker_key(patient_id), ward, get=True)
+    return ward, marker
+
+
+def moved_from(previous_ward, ward):
+    """The ward whose scores of the patient have to move to ward, None if there is none"""
+    if previous_ward and previous_ward != ward:
+        return previous_ward
+    return None
+
+
+def queue_ward_removal(pipe, patient_id, previous_ward):
+    """Queue the removal of a patient's scores from a ward, replying with them"""
+    run_script(pipe, REMOVE_PATIENT_SCRIPT, keys=[ward_names_key(previous_ward)],
+               args=remove_patient_args(patient_id, previous_ward))
+
+
+def queue_moved_scores(pipe, patient_id, ward, removed):
+    """Queue the scores removed from the previous ward for the new one"""
+    for name, previous_total, previous_timestamp in parse_removed(removed):
+        queue_score_update(pipe, patient_id, ward, name, previous_total, previous_timestamp)
+
+
+def move_scores(client, moves):
+    """
+    Move the scores of patients that changed wards, in two round trips.
+
+    Args:
+        moves: (patient_id, previous ward, ward) per patient.
+    """
+    if not moves:
+        return
+    pipe = client.pipeline(transaction=False)
+    for patient_id, previous_ward, _ in moves:
+        queue_ward_removal(pipe, patient_id, previous_ward)
+    removed = pipe.execute()
+
+    pipe = client.pipeline(transaction=False)
+    for (patient_id, _, ward), result in zip(moves, removed):
+        queue_moved_scores(pipe, patient_id, ward, result)
+    pipe.execute()
+
+
+def aggregate_score(client, patient_id, patient_hash, assessment_name, total, unix_timestamp):
+    """
+    Add the score of a freshly saved assessment to the aggregates of the patient's ward.
+
+    If the patient was aggregated in another ward before, all its scores are
+    moved: removed there in one script and added to the new ward.
+    """
+    pipe = client.pipeline(transaction=False)
+    ward, marker = queue_aggregate_score(
+        pipe, patient_id, patient_hash, assessment_name, total, unix_timestamp
+    )
+    previous_ward = moved_from(pipe.execute()[marker], ward)
+    if previous_ward is not None:
+        move_scores(client, [(patient_id, previous_ward, ward)])
+
+
+def score_aggregates(client, wards=None, assessment_names=None, threshold=None):
+    """
+    Read the aggregates of some or all wards in two round trips.
+
+    Returns:
+        dict: ward -> assessment name -> aggregate_entry
+    """
+    if wards is None:
+        wards = sorted(client.smembers(WARDS_KEY))
+    pipe = client.pipeline(transaction=False)
+    for ward in wards:
+        pipe.smembers(ward_names_key(ward))
+    names = {ward: scored_names(ward_names, assessment_names)
+             for ward, ward_names in zip(wards, pipe.execute())}
+
+    pipe = client.pipeline(transaction=False)
+    for ward in wards:
+        for name in names[ward]:
+            queue_aggregate_read(pipe, ward, name, threshold)
+    results = iter(pipe.execute())
+    return {
+        ward: {name: aggregate_entry(name, next(results), next(results), threshold)
+               for name in names[ward]}
+        for ward in wards
+    }
+
+
+def rebuild_scores(client, chunk_size=500):
+    """
+    Recompute all aggregates from the latest assessment of every patient.
+
+    Stored scores of the current SCORE_VERSION are reused, other assessments
+    (e.g. from bulk import) are scored.
+
+    Existing aggregates are deleted first, so the numbers are incomplete until
+    the rebuild has finished.
+
+    Returns:
+        dict: patients and scores aggregated.
+    """
+    stale = list(client.scan_iter(match=f'{SCORE_PREFIX}:*', count=chunk_size))
+    # One DEL per key: the aggregates of different wards are in different
+    # hash slots, a multi-key DEL would fail on Redis Cluster
+    for start in range(0, len(stale), chunk_size):
+        pipe = client.pipeline(transaction=False)
+        for key in stale[start:start + chunk_size]:
+            pipe.delete(key)
+        pipe.execute()
+
+    report = {'patients': 0, 'scores': 0}
+    for patient_ids in patient_chunks(client, chunk_size):
+        patient_hashes = dict(zip(patient_ids, fetch_hashes(client, patient_ids)))
+        keys = [
+            key for key in latest_keys(window_keys(client, patient_ids, None, '+inf'))
+            if scorer_for(parse_assessment_key(key)[1]) is not None
+        ]
+        pipe = client.pipeline(transaction=False)
+        for key, raw in zip(keys, fetch_hashes(client, keys)):
+            if not raw:
+                continue
+            patient_id, name, unix_timestamp, _ = parse_assessment_key(key)
+            score = stored_score(raw)
+            if score is None or score.get('version') != SCORE_VERSION:
+                score = score_assessment(name, decode_assessment(raw))
+            total = score['total']
+            if total is None:
+                continue
+            ward = patient_ward(patient_hashes[patient_id])
+            queue_score_update(pipe, patient_id, ward, name, total, unix_timestamp)
+            pipe.sadd(WARDS_KEY, ward)
+            pipe.set(ward_marker_key(patient_id), ward)
+            report['scores'] += 1
+        pipe.execute()
+        report['patients'] += len(patient_ids)
+    return report
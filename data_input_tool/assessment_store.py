@@ -0,0 +1,277 @@
+"""
+Writing assessments and resolving the latest assessment of a type
+
+Saving runs as one Lua script, so the assessment hash, its index entries and
+the "latest" pointer of ``(patient, assessment_name)`` are updated atomically.
+Reading the latest assessment is a single round trip as well: the pointer is
+followed to the assessment hash inside Redis.
+
+All keys of one call belong to one patient, with key schema 2 (see
+assessment_index) they share a hash slot. With LEGACY_KEY_FALLBACK the keys of
+the version 1 layout are passed as well and the scripts use them for patients
+that still only have version 1 keys.
+"""
+
+from redis.exceptions import NoScriptError
+
+from archive import is_archived, rehydrate
+
+from assessment_index import (
+    LEGACY_KEY_FALLBACK,
+    assessment_index_key,
+    assessment_key,
+    latest_pointer_key,
+    patient_index_key,
+)
+
+# KEYS: assessment key, patient index, assessment type index, latest pointer,
+#       optionally followed by the same four keys in the version 1 layout,
+#       optionally followed by a marker key making a replayed save a no-op
+# ARGV: unix timestamp, field1, value1, field2, value2, ..., optionally followed
+#       by "dedupe": an identical hash at the same timestamp is kept and the
+#       script returns false instead of the key
+SAVE_ASSESSMENT_SCRIPT = """
+local fields = #ARGV
+local dedupe = fields % 2 == 0
+if dedupe then
+    fields = fields - 1
+end
+local function identical(key)
+    if redis.call('HLEN', key) * 2 ~= fields - 1 then
+        return false
+    end
+    for i = 2, fields, 2 do
+        if redis.call('HGET', key, ARGV[i]) ~= ARGV[i + 1] then
+            return false
+        end
+    end
+    return true
+end
+local marker = nil
+if #KEYS % 4 == 1 then
+    marker = KEYS[#KEYS]
+    local applied = redis.call('GET', marker)
+    if applied then
+        return applied
+    end
+end
+local k = 0
+-- A patient keeps the version 1 layout until it is migrated
+if #KEYS >= 8 and redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[6]) == 1 then
+    k = 4
+end
+local key = KEYS[1 + k]
+local n = 1
+-- Several saves within the same second get a #n suffix instead of
+-- being merged into one hash
+while redis.call('EXISTS', key) == 1 do
+    if dedupe and identical(key) then
+        return false
+    end
+    n = n + 1
+    key = KEYS[1 + k] .. '#' .. n
+end
+for i = 2, fields, 2 do
+    redis.call('HSET', key, ARGV[i], ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[2 + k], ARGV[1], key)
+redis.call('ZADD', KEYS[3 + k], ARGV[1], key)
+local current = tonumber(redis.call('HGET', KEYS[4 + k], 'unix_timestamp') or '-1')
+if tonumber(ARGV[1]) >= current then
+    redis.call('HSET', KEYS[4 + k], 'key', key, 'unix_timestamp', ARGV[1])
+end
+if marker then
+    -- Dropped by the caller once the save can no longer be replayed,
+    -- the week is only a safety net
+    redis.call('SET', marker, key, 'EX', 604800)
+end
+return key
+"""
+
+# KEYS: latest pointer, assessment type index, optionally followed by both in
+#       the version 1 layout
+# Falls back to the index for assessments saved before the pointer existed
+LATEST_ASSESSMENT_SCRIPT = """
+local key = nil
+for k = 0, #KEYS - 2, 2 do
+    key = redis.call('HGET', KEYS[1 + k], 'key')
+    if not key then
+        key = redis.call('ZREVRANGE', KEYS[2 + k], 0, 0)[1]
+    end
+    if key then
+        break
+    end
+end
+if not key then
+    return nil
+end
+return {key, redis.call('HGETALL', key)}
+"""
+
+_scripts = {}
+
+
+def _script(client, source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = client.register_script(source)
+    return script
+
+
+def run_script(client, source, keys, args=()):
+    """Run a Lua script via EVALSHA, the client may also be a pipeline"""
+    return _script(client, source)(keys=keys, args=args, client=client)
+
+
+def save_script_arguments(patient_id, assessment_name, mapping,
+                          unix_timestamp, human_readable, marker=None, dedupe=False):
+    """Build the KEYS and ARGV of SAVE_ASSESSMENT_SCRIPT"""
+    args = [unix_timestamp]
+    for field, value in mapping.items():
+        args.extend((field, value))
+    if dedupe:
+        args.append('dedupe')
+    keys = []
+    for schema in ((None, 1) if LEGACY_KEY_FALLBACK else (None,)):
+        keys.extend((
+            assessment_key(patient_id, assessment_name, unix_timestamp, human_readable, schema),
+            patient_index_key(patient_id, schema),
+            assessment_index_key(patient_id, assessment_name, schema),
+            latest_pointer_key(patient_id, assessment_name, schema),
+        ))
+    if marker is not None:
+        keys.append(marker)
+    return keys, args
+
+
+def latest_script_keys(patient_id, assessment_name):
+    """Build the KEYS of LATEST_ASSESSMENT_SCRIPT"""
+    keys = []
+    for schema in ((None, 1) if LEGACY_KEY_FALLBACK else (None,)):
+        keys.extend((
+            latest_pointer_key(patient_id, assessment_name, schema),
+            assessment_index_key(patient_id, assessment_name, schema),
+        ))
+    return keys
+
+
+def save_assessment_record(client, patient_id, assessment_name, mapping,
+                           unix_timestamp, human_readable):
+    """
+    Store an assessment hash together with its index entries.
+
+    Args:
+        client: The Redis client, or a pipeline to queue the script on.
+        patient_id (str): The ID of the patient.
+        assessment_name (str): The name of the assessment.
+        mapping (dict): The hash fields, already converted to strings.
+        unix_timestamp (int): The time of the assessment.
+        human_readable (str): The same time formatted for humans.
+
+    Returns:
+        str: The key the assessment was stored under (or the pipeline).
+    """
+    keys, args = save_script_arguments(
+        patient_id, assessment_name, mapping, unix_timestamp, human_readable
+    )
+    return run_script(client, SAVE_ASSESSMENT_SCRIPT, keys=keys, args=args)
+
+
+def queue_latest_assessment(client, patient_id, assessment_name):
+    """Run (or queue on a pipeline) the lookup of the latest assessment"""
+    return run_script(
+        client,
+        LATEST_ASSESSMENT_SCRIPT,
+        keys=latest_script_keys(patient_id, assessment_name),
+    )
+
+
+def parse_latest_result(result):
+    """
+    Turn the reply of the latest assessment script into (key, data).
+
+    Returns:
+        tuple: (None, None) if there is no assessment of that type, otherwise
+               the assessment key and its hash as a dictionary.
+    """
+    if not result:
+        return None, None
+    key, flat_hash = result
+    return key, dict(zip(flat_hash[::2], flat_hash[1::2]))
+
+
+def latest_assessment(client, patient_id, assessment_name):
+    """Return (key, data) of the newest assessment of one type"""
+    key, data = parse_latest_result(
+        queue_latest_assessment(client, patient_id, assessment_name)
+    )
+    if key is not None:
+        data = rehydrate(client, [key], [data])[0]
+    return key, data
+
+
+def latest_assessment_matrix(client, patient_ids, assessment_names):
+    """
+    Resolve the latest assessments for many patients in one round trip.
+
+    The existence checks and one latest lookup per (patient, assessment) pair
+    are sent as a single pipeline. EVALSHA is queued directly instead of via
+    the Script object, which would cost an extra SCRIPT EXISTS round trip; if
+    Redis does not know the script yet it is loaded and the pipeline is sent
+    once more.
+
+    Returns:
+        dict: patient_id -> None for unknown patients, otherwise a dictionary
+              assessment_name -> (key, data), with (None, None) for
+              assessment types the patient does not have.
+    """
+    script = _script(client, LATEST_ASSESSMENT_SCRIPT)
+    for _ in range(2):
+        pipe = client.pipeline(transaction=False)
+        for patient_id in patient_ids:
+            pipe.exists(patient_id)
+        for patient_id in patient_ids:
+            for assessment_name in assessment_names:
+                keys = latest_script_keys(patient_id, assessment_name)
+                pipe.evalsha(script.sha, len(keys), *keys)
+        results = pipe.execute(raise_on_error=False)
+        if not any(isinstance(result, NoScriptError) for result in results):
+            break
+        client.script_load(LATEST_ASSESSMENT_SCRIPT)
+    matrix = matrix_from_results(patient_ids, assessment_names, results)
+    cells, keys, hashes = archived_cells(matrix)
+    if cells:
+        replace_cells(matrix, cells, keys, rehydrate(client, keys, hashes))
+    return matrix
+
+
+def archived_cells(matrix):
+    """(patient, assessment name) pairs of a matrix whose latest assessment is archived"""
+    cells, keys, hashes = [], [], []
+    for patient_id, row in matrix.items():
+        for name, (key, data) in (row or {}).items():
+            if key is not None and is_archived(data):
+                cells.append((patient_id, name))
+                keys.append(key)
+                hashes.append(data)
+    return cells, keys, hashes
+
+
+def replace_cells(matrix, cells, keys, hashes):
+    for (patient_id, name), key, data in zip(cells, keys, hashes):
+        matrix[patient_id][name] = (key, data)
+
+
+def matrix_from_results(patient_ids, assessment_names, results):
+    """Arrange the pipeline replies of a latest assessment matrix"""
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+    exists = results[:len(patient_ids)]
+    latest = iter(results[len(patient_ids):])
+    matrix = {}
+    for patient_id, patient_exists in zip(patient_ids, exists):
+        row = {name: parse_latest_result(next(latest)) for name in assessment_names}
+        matrix[patient_id] = row if patient_exists else None
+    return matrix
@@ -0,0 +1,267 @@
+"""
+redis.asyncio counterparts of the storage helpers used by app.py
+
+The key layout, Lua scripts and result parsing are shared with
+assessment_index, assessment_store and redis_batch; only the I/O is awaited.
+"""
+
+import asyncio
+import base64
+import time
+
+from redis.exceptions import NoScriptError, RedisError, ResponseError
+
+from archive import (
+    apply_members,
+    archived_positions,
+    decode_member,
+    parse_ref,
+    read_file_member,
+)
+from assessment_index import LEGACY_KEY_FALLBACK, index_key_for, page_query, page_result
+from assessment_scores import (
+    REMOVE_PATIENT_SCRIPT,
+    UPDATE_AGGREGATE_SCRIPT,
+    WARDS_KEY,
+    aggregate_args,
+    aggregate_entry,
+    aggregate_keys,
+    moved_from,
+    parse_removed,
+    patient_ward,
+    queue_aggregate_read,
+    remove_patient_args,
+    scored_names,
+    ward_marker_key,
+    ward_names_key,
+)
+from assessment_store import (
+    LATEST_ASSESSMENT_SCRIPT,
+    SAVE_ASSESSMENT_SCRIPT,
+    archived_cells,
+    latest_script_keys,
+    matrix_from_results,
+    parse_latest_result,
+    replace_cells,
+    save_script_arguments,
+)
+from bulk_import import (
+    IMPORT_BATCH_SIZE,
+    count_batch_results,
+    finish_report,
+    import_batches,
+    import_failure,
+    new_report,
+    queue_import_batch,
+)
+from medications import (
+    MEDICATION_INDEX,
+    create_index_command,
+    index_is_current,
+    is_index_exists_error,
+)
+from redis_batch import PIPELINE_CHUNK_SIZE, chunked, is_cluster
+
+_scripts = {}
+
+
+def _script(client, source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = client.register_script(source)
+    return script
+
+
+async def run_script(client, source, keys, args=()):
+    """Run a Lua script via EVALSHA on an asyncio client"""
+    return await _script(client, source)(keys=keys, args=args, client=client)
+
+
+async def save_assessment_record(client, patient_id, assessment_name, mapping,
+                                 unix_timestamp, human_readable):
+    """Store an assessment hash together with its index entries"""
+    keys, args = save_script_arguments(
+        patient_id, assessment_name, mapping, unix_timestamp, human_readable
+    )
+    return await run_script(client, SAVE_ASSESSMENT_SCRIPT, keys=keys, args=args)
+
+
+async def load_member(client, ref):
+    """See archive.load_member, archive files are read in a thread"""
+    kind, location = parse_ref(ref)
+    if kind == 'redis':
+        blob = await client.get(location)
+        if blob is None:
+            raise LookupError(f'Archive member {location} is missing')
+        return decode_member(base64.b64decode(blob))
+    return decode_member(await asyncio.to_thread(read_file_member, location))
+
+
+async def rehydrate(client, keys, hashes):
+    """Replace archive stubs among fetched hashes, see archive.rehydrate"""
+    positions = archived_positions(hashes)
+    if not positions:
+        return hashes
+    members = {ref: await load_member(client, ref) for ref in positions}
+    return apply_members(keys, hashes, positions, members)
+
+
+async def latest_assessment(client, patient_id, assessment_name):
+    """Return (key, data) of the newest assessment of one type"""
+    key, data = parse_latest_result(await run_script(
+        client,
+        LATEST_ASSESSMENT_SCRIPT,
+        keys=latest_script_keys(patient_id, assessment_name),
+    ))
+    if key is not None:
+        data = (await rehydrate(client, [key], [data]))[0]
+    return key, data
+
+
+async def latest_assessment_matrix(client, patient_ids, assessment_names):
+    """Resolve the latest assessments for many patients in one round trip"""
+    script = _script(client, LATEST_ASSESSMENT_SCRIPT)
+    for _ in range(2):
+        pipe = client.pipeline(transaction=False)
+        for patient_id in patient_ids:
+            pipe.exists(patient_id)
+        for patient_id in patient_ids:
+            for assessment_name in assessment_names:
+                keys = latest_script_keys(patient_id, assessment_name)
+                pipe.evalsha(script.sha, len(keys), *keys)
+        results = await pipe.execute(raise_on_error=False)
+        if not any(isinstance(result, NoScriptError) for result in results):
+            break
+        await client.script_load(LATEST_ASSESSMENT_SCRIPT)
+    matrix = matrix_from_results(patient_ids, assessment_names, results)
+    cells, keys, hashes = archived_cells(matrix)
+    if cells:
+        replace_cells(matrix, cells, keys, await rehydrate(client, keys, hashes))
+    return matrix
+
+
+async def assessment_page(client, patient_id, assessment_name=None, limit=100,
+                          cursor=None, since=None, until=None):
+    """Return one page of a patient's assessment keys, newest first"""
+    index_key, max_score, min_score, skip = page_query(
+        patient_id, assessment_name, cursor, since, until
+    )
+    entries = await client.zrevrangebyscore(
+        index_key, max_score, min_score, start=skip, num=limit + 1, withscores=True
+    )
+    if not entries and LEGACY_KEY_FALLBACK:
+        entries = await client.zrevrangebyscore(
+            index_key_for(patient_id, assessment_name, schema=1),
+            max_score, min_score, start=skip, num=limit + 1, withscores=True
+        )
+    return page_result(entries, limit, max_score, skip)
+
+
+async def fetch_hashes(client, keys, chunk_size=None):
+    """Fetch the hashes stored under the given keys in pipelined chunks"""
+    if chunk_size is None:
+        chunk_size = PIPELINE_CHUNK_SIZE
+
+    hashes = []
+    for chunk in chunked(list(keys), chunk_size):
+        pipe = client.pipeline(transaction=False)
+        for key in chunk:
+            pipe.hgetall(key)
+        hashes.extend(await rehydrate(client, chunk, await pipe.execute()))
+    return hashes
+
+
+async def import_rows(client, rows, parse=None, batch_size=None, on_batch=None):
+    """
+    Import validated rows in pipelined MULTI/EXEC batches, see
+    bulk_import.import_rows; on_batch is awaited.
+    """
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    report = new_report()
+    started = time.perf_counter()
+    sha = await client.script_load(SAVE_ASSESSMENT_SCRIPT)
+
+    for batch in import_batches(rows, batch_size, report, parse):
+        try:
+            for _ in range(2):
+                pipe = client.pipeline(transaction=not is_cluster(client))
+                queue_import_batch(pipe, sha, batch)
+                results = await pipe.execute(raise_on_error=False)
+                if not any(isinstance(result, NoScriptError) for result in results):
+                    break
+                sha = await client.script_load(SAVE_ASSESSMENT_SCRIPT)
+        except RedisError as e:
+            raise import_failure(report, batch[0], e, started)
+        failure = count_batch_results(report, batch, results)
+        if on_batch is not None:
+            await on_batch(report, {record['patient_id'] for record in batch})
+        if failure is not None:
+            raise import_failure(report, *failure, started)
+
+    return finish_report(report, started)
+
+
+async def _queue_score_update(pipe, patient_id, ward, assessment_name, total, unix_timestamp):
+    await run_script(
+        pipe, UPDATE_AGGREGATE_SCRIPT,
+        keys=aggregate_keys(ward, assessment_name),
+        args=aggregate_args(patient_id, assessment_name, total, unix_timestamp),
+    )
+
+
+async def aggregate_score(client, patient_id, patient_hash, assessment_name, total, unix_timestamp):
+    """Add a score to the aggregates of the patient's ward, see assessment_scores.aggregate_score"""
+    ward = patient_ward(patient_hash)
+    pipe = client.pipeline(transaction=False)
+    await _queue_score_update(pipe, patient_id, ward, assessment_name, total, unix_timestamp)
+    pipe.sadd(WARDS_KEY, ward)
+    pipe.set(ward_marker_key(patient_id), ward, get=True)
+    previous_ward = moved_from((await pipe.execute())[-1], ward)
+    if previous_ward is None:
+        return
+
+    pipe = client.pipeline(transaction=False)
+    await run_script(pipe, REMOVE_PATIENT_SCRIPT, keys=[ward_names_key(previous_ward)],
+                     args=remove_patient_args(patient_id, previous_ward))
+    removed = (await pipe.execute())[0]
+    pipe = client.pipeline(transaction=False)
+    for name, previous_total, previous_timestamp in parse_removed(removed):
+        await _queue_score_update(pipe, patient_id, ward, name, previous_total, previous_timestamp)
+    await pipe.execute()
+
+
+async def score_aggregates(client, wards=None, assessment_names=None, threshold=None):
+    """The aggregates of some or all wards, see assessment_scores.score_aggregates"""
+    if wards is None:
+        wards = sorted(await client.smembers(WARDS_KEY))
+    pipe = client.pipeline(transaction=False)
+    for ward in wards:
+        pipe.smembers(ward_names_key(ward))
+    names = {ward: scored_names(ward_names, assessment_names)
+             for ward, ward_names in zip(wards, await pipe.execute())}
+
+    pipe = client.pipeline(transaction=False)
+    for ward in wards:
+        for name in names[ward]:
+            queue_aggregate_read(pipe, ward, name, threshold)
+    results = iter(await pipe.execute())
+    return {
+        ward: {name: aggregate_entry(name, next(results), next(results), threshold)
+               for name in names[ward]}
+        for ward in wards
+    }
+
+
+async def ensure_medication_index(client):
+    """Create the medication index or replace an outdated one, see medications"""
+    try:
+        await client.execute_command(*create_index_command())
+        return True
+    except ResponseError as e:
+        if not is_index_exists_error(e):
+            raise
+    if index_is_current(await client.ft(MEDICATION_INDEX).info()):
+        return False
+    await client.ft(MEDICATION_INDEX).dropindex(delete_documents=False)
+    await client.execute_command(*create_index_command())
+    return True
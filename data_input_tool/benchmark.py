@@ -0,0 +1,475 @@
+"""
+Reproducible benchmark of the assessment API
+
+Unlike loadtest.py, which drives API instances that are already running, the
+benchmark owns the whole setup, so two runs on the same machine are comparable:
+
+- Redis is an in-process fakeredis server (default), a redis-server started
+  on a free port for the duration of the run (--redis-server), or an existing,
+  empty database (--redis-url).
+- The Flask app of app.py is served in-process by a threaded werkzeug server
+  on a free port, against that Redis.
+- The keyspace is seeded with bulk_import.import_rows, then grown step by step
+  to each of the --patients sizes. After every step all routes are driven
+  concurrently for --duration seconds by the workers of loadtest.py.
+
+For every step and route the report lists throughput, p50/p95/p99 latency,
+errors and the Redis commands and round trips per request (counted with
+redis_tracking, also for fakeredis), together with the size of the keyspace.
+Results are written as JSON; --baseline compares them with an earlier run.
+
+The in-process read cache (READ_CACHE_MAXSIZE, READ_CACHE_TTL) stays as
+configured, set READ_CACHE_MAXSIZE=0 to benchmark Redis alone.
+
+With --write-behind saves are queued to a Redis Stream (see write_behind) and
+applied by a worker thread of the benchmark; every step then also reports how
+many queued saves the worker applied per second and how long it took to drain
+the queue after the clients stopped. Compare with a run of direct writes via
+--baseline.
+
+Usage:
+    python benchmark.py --patients 100 1000 10000 --json before.json
+    python benchmark.py --patients 100 1000 10000 --json after.json --baseline before.json
+    python benchmark.py --redis-server redis-server --concurrency 32
+    python benchmark.py --write-behind --json write_behind.json --baseline before.json
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from bulk_import import import_rows
+from loadtest import ASSESSMENT_NAMES, ApiConnection, summarize
+from redis_tracking import TrackedConnection, request_counts
+from write_behind import queue_status, run_worker
+
+# Relative frequency of the routes in the workload, by Flask endpoint name
+ROUTE_WEIGHTS = {
+    'create': 2,
+    'save_assessment': 18,
+    'get_assessments': 15,
+    'get_all_data': 10,
+    'get_latest_assessment': 30,
+    'get_latest_barthel': 15,
+    'get_latest_moca5min': 10,
+}
+SEED_TIMESTAMP = 1700000000
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def fake_client():
+    """
+    An in-process fakeredis server whose commands are counted like real ones.
+
+    Raises:
+        RuntimeError: If fakeredis is not installed.
+    """
+    try:
+        import fakeredis
+    except ImportError:
+        raise RuntimeError('The in-process Redis requires fakeredis: pip install fakeredis '
+                           '(or pass --redis-server / --redis-url)')
+
+    class TrackedFakeConnection(TrackedConnection, fakeredis.FakeRedisConnection):
+        pass
+
+    return fakeredis.FakeStrictRedis(
+        server=fakeredis.FakeServer(), decode_responses=True,
+        connection_class=TrackedFakeConnection,
+    )
+
+
+def url_client(url):
+    return redis.StrictRedis(connection_pool=redis.ConnectionPool.from_url(
+        url, decode_responses=True, connection_class=TrackedConnection
+    ))
+
+
+def start_redis_server(executable):
+    """
+    Start a throwaway redis-server without persistence.
+
+    Returns:
+        tuple: (process, client)
+
+    Raises:
+        RuntimeError: If the executable is not found or Redis does not come up.
+    """
+    path = shutil.which(executable)
+    if path is None:
+        raise RuntimeError(f'{executable} not found')
+    port = free_port()
+    process = subprocess.Popen(
+        [path, '--port', str(port), '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    client = url_client(f'redis://127.0.0.1:{port}/0')
+    for _ in range(100):
+        try:
+            client.ping()
+            return process, client
+        except redis.ConnectionError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError(f'redis-server did not start on port {port}')
+
+
+def keyspace_info(client):
+    """Number of keys and, where INFO is supported, the memory used by Redis"""
+    info = {'keys': client.dbsize()}
+    try:
+        info['used_memory'] = client.info('memory').get('used_memory')
+        info['redis_version'] = client.info('server').get('redis_version')
+    except redis.ResponseError:
+        # fakeredis does not implement INFO
+        pass
+    return info
+
+
+def seed_rows(first_patient, last_patient, assessments_per_patient):
+    """Bulk import rows of the patients first_patient..last_patient - 1"""
+    line = 0
+    for n in range(first_patient, last_patient):
+        for i in range(assessments_per_patient):
+            line += 1
+            yield line, {
+                'patient_id': f'bench{n}',
+                'assessment_name': ASSESSMENT_NAMES[i % len(ASSESSMENT_NAMES)],
+                'data': {'item_1': i % 4, 'item_2': {'answer': i}},
+                'unix_timestamp': SEED_TIMESTAMP + i * 60,
+            }
+
+
+class CommandCounter:
+    """Redis commands and round trips per request, by Flask endpoint"""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, response):
+        from flask import request
+
+        round_trips, commands = request_counts()
+        with self._lock:
+            counts = self._counts.setdefault(request.endpoint, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += round_trips
+            counts[2] += commands
+        return response
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+
+    def per_request(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    'round_trips_per_request': round(round_trips / requests, 2),
+                    'commands_per_request': round(commands / requests, 2),
+                }
+                for endpoint, (requests, round_trips, commands) in self._counts.items()
+            }
+
+
+def start_app(client, counter):
+    """Serve app.py against `client` on a free local port"""
+    from werkzeug.serving import make_server
+
+    import app as app_module
+
+    app_module.redis_client = client
+    app_module.app.after_request(counter.record)
+    # One access log line per request would dominate the measurement
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', free_port(), app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, app_module
+
+
+class WriteBehindWorker:
+    """A write_behind worker in a thread, counting the entries it applied"""
+
+    def __init__(self, client, app_module, batch_size, flush_interval):
+        self.applied = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        def applied(report):
+            for patient_id in report['patients']:
+                app_module.invalidate_patient(patient_id)
+            with self._lock:
+                self.applied += report['applied']
+
+        self._thread = threading.Thread(target=run_worker, daemon=True, kwargs={
+            'client': client, 'consumer': 'benchmark', 'batch_size': batch_size,
+            'flush_interval': flush_interval, 'on_batch': applied, 'stop': self._stop,
+        })
+        self._thread.start()
+
+    def reset(self):
+        with self._lock:
+            applied, self.applied = self.applied, 0
+        return applied
+
+    def drain(self, client, timeout=60.0):
+        """Seconds until every queued save was applied"""
+        started = time.perf_counter()
+        while time.perf_counter() - started < timeout:
+            status = queue_status(client)
+            if not status['queued'] and not status['pending']:
+                break
+            time.sleep(0.01)
+        return time.perf_counter() - started
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def next_request(route, patient_ids, rng, created):
+    """(method, path, payload) of one request to `route`"""
+    patient_id = rng.choice(patient_ids)
+    name = rng.choice(ASSESSMENT_NAMES)
+    if route == 'create':
+        return 'POST', '/api', {'identifier': f'new{next(created)}'}
+    if route == 'save_assessment':
+        return 'POST', f'/api/{patient_id}/{name}', {'item_1': rng.randint(0, 3)}
+    if route == 'get_assessments':
+        return 'GET', f'/api/{patient_id}/assessments?limit=50', None
+    if route == 'get_all_data':
+        return 'GET', f'/api/{patient_id}/all?limit=50', None
+    if route == 'get_latest_assessment':
+        return 'GET', f'/api/{patient_id}/{name}/latest', None
+    if route == 'get_latest_barthel':
+        return 'GET', f'/api/{patient_id}/barthel/latest', None
+    return 'GET', f'/api/{patient_id}/moca5min/latest', None
+
+
+def drive(base_url, patient_ids, concurrency, duration, seed_value, created):
+    """
+    Send the weighted mix of ROUTE_WEIGHTS from `concurrency` clients.
+
+    Returns:
+        tuple: (latencies by route, error counts by route, wall time)
+    """
+    routes = list(ROUTE_WEIGHTS)
+    weights = list(ROUTE_WEIGHTS.values())
+    latencies = {route: [] for route in routes}
+    errors = {route: 0 for route in routes}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(worker_id):
+        rng = random.Random(seed_value + worker_id)
+        connection = ApiConnection(base_url)
+        local = {route: [] for route in routes}
+        local_errors = {route: 0 for route in routes}
+        while time.perf_counter() < deadline:
+            route = rng.choices(routes, weights)[0]
+            method, path, payload = next_request(route, patient_ids, rng, created)
+            start = time.perf_counter()
+            try:
+                status = connection.request(method, path, payload)
+            except (http.client.HTTPException, OSError):
+                connection = ApiConnection(base_url)
+                status = 599
+            local[route].append(time.perf_counter() - start)
+            if status >= 500:
+                local_errors[route] += 1
+        with lock:
+            for route in routes:
+                latencies[route].extend(local[route])
+                errors[route] += local_errors[route]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def run_step(client, base_url, counter, patient_ids, args, created, worker=None):
+    """Drive all routes once and report them with the current keyspace"""
+    counter.reset()
+    if worker is not None:
+        worker.reset()
+    latencies, errors, wall_time = drive(
+        base_url, patient_ids, args.concurrency, args.duration, args.seed, created
+    )
+    write_behind = None
+    if worker is not None:
+        drain_seconds = worker.drain(client)
+        applied = worker.reset()
+        write_behind = {
+            'applied': applied,
+            'applied_per_second': round(applied / (wall_time + drain_seconds), 1),
+            'drain_seconds': round(drain_seconds, 3),
+        }
+    counts = counter.per_request()
+    routes = {}
+    all_latencies = []
+    for route, values in latencies.items():
+        values.sort()
+        all_latencies.extend(values)
+        routes[route] = summarize(values, wall_time)
+        routes[route]['errors'] = errors[route]
+        routes[route].update(counts.get(route, {}))
+    all_latencies.sort()
+    return {
+        'patients': len(patient_ids),
+        **keyspace_info(client),
+        'routes': routes,
+        'total': summarize(all_latencies, wall_time),
+        'write_behind': write_behind,
+    }
+
+
+def compare(results, baseline):
+    """
+    Relative change of throughput and p99 per step and route against a baseline run.
+
+    Steps are matched by their number of patients.
+    """
+    previous = {step['patients']: step for step in baseline.get('steps', [])}
+    changes = []
+    for step in results['steps']:
+        before_step = previous.get(step['patients'])
+        if before_step is None:
+            continue
+        for route, after in step['routes'].items():
+            before = before_step['routes'].get(route)
+            if not before or not before['throughput_rps'] or not before['p99_ms']:
+                continue
+            changes.append({
+                'patients': step['patients'],
+                'route': route,
+                'throughput_change': round(after['throughput_rps'] / before['throughput_rps'] - 1, 3),
+                'p99_change': round(after['p99_ms'] / before['p99_ms'] - 1, 3),
+            })
+    return changes
+
+
+def print_step(step):
+    memory = f", {step['used_memory'] / 2 ** 20:.1f} MB" if step.get('used_memory') else ''
+    print(f"\n{step['patients']} patients, {step['keys']} keys{memory}")
+    print(f"{'route':<24}{'requests':>10}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'cmds':>7}{'rtts':>7}{'errors':>8}")
+    for route, stats in list(step['routes'].items()) + [('TOTAL', step['total'])]:
+        print(f"{route:<24}{stats['requests']:>10}{stats['throughput_rps']:>10}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}"
+              f"{stats.get('commands_per_request', ''):>7}{stats.get('round_trips_per_request', ''):>7}"
+              f"{stats.get('errors', ''):>8}")
+    if step.get('write_behind'):
+        print(f"write-behind: {step['write_behind']['applied']} saves applied, "
+              f"{step['write_behind']['applied_per_second']}/s, "
+              f"queue drained {step['write_behind']['drain_seconds']}s after the clients stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the assessment API in-process')
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument('--redis-server', metavar='EXECUTABLE',
+                         help='Start this redis-server on a free port instead of using fakeredis')
+    backend.add_argument('--redis-url', help='Use an existing, empty Redis database')
+    parser.add_argument('--patients', type=int, nargs='+', default=[100, 1000, 5000],
+                        help='Keyspace sizes to benchmark, in patients (default 100 1000 5000)')
+    parser.add_argument('--assessments', type=int, default=20, help='Assessments seeded per patient')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per keyspace size')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Compare with the JSON of an earlier run')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='Queue saves to the write stream, applied by a worker thread')
+    parser.add_argument('--write-batch-size', type=int, default=200)
+    parser.add_argument('--write-flush-interval', type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    process = None
+    if args.redis_server:
+        process, client = start_redis_server(args.redis_server)
+        backend_name = 'redis-server'
+    elif args.redis_url:
+        client = url_client(args.redis_url)
+        backend_name = 'redis-url'
+        if client.dbsize():
+            parser.error('--redis-url must point to an empty database, the benchmark writes to it')
+    else:
+        client = fake_client()
+        backend_name = 'fakeredis'
+
+    counter = CommandCounter()
+    server, app_module = start_app(client, counter)
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    worker = None
+    if args.write_behind:
+        app_module.WRITE_BEHIND = True
+        worker = WriteBehindWorker(client, app_module, args.write_batch_size, args.write_flush_interval)
+    # IDs of the patients created during the runs, shared by all workers
+    created = iter(range(10 ** 9))
+    results = {
+        'config': vars(args),
+        'environment': {
+            'backend': backend_name,
+            'python': platform.python_version(),
+            'read_cache': app_module.read_cache.enabled,
+            'write_behind': args.write_behind,
+            'cpus': os.cpu_count(),
+        },
+        'steps': [],
+    }
+
+    try:
+        seeded = 0
+        for patients in sorted(args.patients):
+            started = time.perf_counter()
+            report = import_rows(client, seed_rows(seeded, patients, args.assessments))
+            seeded = max(seeded, patients)
+            print(f"Seeded {report['imported']} assessments in {time.perf_counter() - started:.1f}s, "
+                  f"running {args.duration:.0f}s with {args.concurrency} clients ...")
+            patient_ids = [f'bench{n}' for n in range(seeded)]
+            step = run_step(client, base_url, counter, patient_ids, args, created, worker)
+            results['steps'].append(step)
+            print_step(step)
+    finally:
+        if worker is not None:
+            worker.stop()
+        server.shutdown()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['baseline'] = {'path': args.baseline, 'changes': compare(results, json.load(f))}
+        print(f"\nChange against {args.baseline}:")
+        for change in results['baseline']['changes']:
+            print(f"{change['patients']:>8} {change['route']:<24}"
+                  f"throughput {change['throughput_change']:+.1%}  p99 {change['p99_change']:+.1%}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
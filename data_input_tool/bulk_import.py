@@ -0,0 +1,298 @@
+"""
+Streaming bulk import of patients and assessments
+
+Two input formats are supported:
+
+- NDJSON, one assessment per line:
+  {"patient_id": "...", "assessment_name": "...", "data": {...},
+   "unix_timestamp": 1700000000}
+  unix_timestamp is optional and defaults to the time of the import.
+- CSV with one row per patient, like the OKIE study export
+  (surge_ahead/OKIE_data_*.csv). Every row becomes one assessment of the
+  given name; the patient ID is read from ``id_column``, blank cells and
+  unnamed columns are dropped.
+
+Rows are read one at a time and written in batches of ``batch_size`` rows, each
+batch as one MULTI/EXEC pipeline that creates missing patients and runs the
+save script per row. Memory use therefore depends on the batch size, not on
+the size of the file. Invalid rows are counted and reported, they do not abort
+the import. On Redis Cluster a batch spans several hash slots and is sent as a
+plain pipeline instead; every row is still written atomically by the script.
+
+Re-running an import is safe: a row whose assessment is already stored with
+identical data at the same unix_timestamp is counted as a duplicate and not
+written again. Rows without a unix_timestamp get the time of the import and are
+therefore always new. If Redis fails a row, the import stops with a
+BulkImportError whose report covers the rows written up to then and the failed
+row, so the import can simply be repeated.
+"""
+
+import csv
+import json
+import os
+import time
+
+from redis.exceptions import NoScriptError, RedisError
+
+from api_common import human_timestamp
+from assessment_format import encode_for_storage
+from assessment_store import SAVE_ASSESSMENT_SCRIPT, save_script_arguments
+from redis_batch import is_cluster
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+# Number of rejected rows listed in the report
+MAX_REPORTED_ERRORS = 20
+
+
+class BulkImportError(Exception):
+    """
+    An import stopped by a row Redis failed to write.
+
+    Attributes:
+        report (dict): The import report up to the failure, with the failed
+                       row as 'failed': {'line', 'patient_id', 'assessment_name', 'error'}.
+    """
+
+    def __init__(self, report):
+        super().__init__(report['failed']['error'])
+        self.report = report
+
+
+def validate_record(record):
+    """
+    Check an import record and fill in the optional timestamp.
+
+    Returns:
+        dict: The record with an integer unix_timestamp.
+
+    Raises:
+        ValueError: If the record cannot be stored.
+    """
+    if not isinstance(record, dict):
+        raise ValueError('Row must be a JSON object')
+    patient_id = record.get('patient_id')
+    assessment_name = record.get('assessment_name')
+    data = record.get('data')
+    if not isinstance(patient_id, str) or not patient_id.isalnum():
+        raise ValueError('patient_id must be alphanumeric')
+    if not isinstance(assessment_name, str) or not assessment_name or ':' in assessment_name:
+        raise ValueError('assessment_name must be a non-empty string without ":"')
+    if not isinstance(data, dict) or not data:
+        raise ValueError('data must be a non-empty JSON object')
+
+    unix_timestamp = record.get('unix_timestamp')
+    if unix_timestamp is None:
+        unix_timestamp = int(time.time())
+    elif isinstance(unix_timestamp, bool) or not isinstance(unix_timestamp, (int, str)):
+        raise ValueError('unix_timestamp must be an integer')
+    else:
+        unix_timestamp = int(unix_timestamp)
+    if unix_timestamp < 0:
+        raise ValueError('unix_timestamp must not be negative')
+    return {
+        'patient_id': patient_id,
+        'assessment_name': assessment_name,
+        'data': data,
+        'unix_timestamp': unix_timestamp,
+    }
+
+
+def ndjson_rows(lines):
+    """Yield (line_number, line) for every non-blank line of an NDJSON stream"""
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if line.strip():
+            yield line_number, line
+
+
+def ndjson_record(line):
+    """Parse one NDJSON line into an import record"""
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f'Invalid JSON: {e}')
+
+
+def csv_rows(text_stream, id_column='id', assessment_name='OKIE'):
+    """
+    Yield (line_number, record) for every row of a per-patient CSV export.
+
+    Quoted cells spanning several lines are supported; the line number is the
+    one the row ends on.
+    """
+    reader = csv.DictReader(text_stream)
+    for row in reader:
+        patient_id = (row.pop(id_column, None) or '').strip()
+        data = {
+            column: value for column, value in row.items()
+            if column and column.strip() and value is not None and value.strip()
+        }
+        yield reader.line_num, {
+            'patient_id': patient_id,
+            'assessment_name': assessment_name,
+            'data': data,
+        }
+
+
+def import_source(import_format, text_stream, id_column='id', assessment_name='OKIE'):
+    """
+    Set up reading an upload or file in the given format.
+
+    Returns:
+        tuple: (rows, parse) for import_rows.
+
+    Raises:
+        ValueError: If the format is not supported.
+    """
+    if import_format == 'ndjson':
+        return ndjson_rows(text_stream), ndjson_record
+    if import_format == 'csv':
+        return csv_rows(text_stream, id_column, assessment_name), None
+    raise ValueError('format must be ndjson or csv')
+
+
+def upload_format(args, content_type):
+    """The format of an upload, from ?format= or else the Content-Type"""
+    import_format = args.get('format')
+    if import_format:
+        return import_format
+    if 'csv' in (content_type or ''):
+        return 'csv'
+    return 'ndjson'
+
+
+def queue_import_batch(pipe, sha, batch):
+    """Queue the patient creation and the save script of every record"""
+    for record in batch:
+        patient_id = record['patient_id']
+        unix_timestamp = record['unix_timestamp']
+        keys, args = save_script_arguments(
+            patient_id,
+            record['assessment_name'],
+            encode_for_storage(record['data']),
+            unix_timestamp,
+            human_timestamp(unix_timestamp),
+            dedupe=True,
+        )
+        pipe.hsetnx(patient_id, 'created', 'true')
+        pipe.evalsha(sha, len(keys), *keys, *args)
+
+
+def new_report():
+    return {'rows': 0, 'imported': 0, 'duplicates': 0, 'rejected': 0, 'errors': []}
+
+
+def import_batches(rows, batch_size, report, parse=None):
+    """
+    Validate the rows and group the valid records into batches.
+
+    Args:
+        rows: Iterable of (line_number, raw row).
+        batch_size (int): Records per batch.
+        report (dict): Updated with the row and rejection counts.
+        parse: Turns a raw row into a record, e.g. ndjson_record.
+
+    Yields:
+        list: Up to batch_size validated records, each with its line number.
+    """
+    batch = []
+    for line_number, raw in rows:
+        report['rows'] += 1
+        try:
+            batch.append({**validate_record(parse(raw) if parse else raw), 'line': line_number})
+        except ValueError as e:
+            report['rejected'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append({'line': line_number, 'error': str(e)})
+            continue
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def count_batch_results(report, batch, results):
+    """
+    Count the rows of an executed batch as imported or duplicate.
+
+    A failed row does not undo the other rows of its transaction, they are
+    counted as well.
+
+    Returns:
+        tuple: (record, error) of the first failed row, None if all rows were written.
+    """
+    failure = None
+    for record, created, key in zip(batch, results[::2], results[1::2]):
+        error = created if isinstance(created, Exception) else key
+        if isinstance(error, Exception):
+            failure = failure or (record, error)
+        elif key is None:
+            report['duplicates'] += 1
+        else:
+            report['imported'] += 1
+    return failure
+
+
+def import_failure(report, record, error, started):
+    """The BulkImportError of an import stopped at record"""
+    report['failed'] = {
+        'line': record['line'],
+        'patient_id': record['patient_id'],
+        'assessment_name': record['assessment_name'],
+        'error': str(error),
+    }
+    return BulkImportError(finish_report(report, started))
+
+
+def finish_report(report, started):
+    seconds = time.perf_counter() - started
+    report['seconds'] = round(seconds, 3)
+    report['rows_per_second'] = round(report['rows'] / seconds, 1) if seconds else None
+    return report
+
+
+def import_rows(client, rows, parse=None, batch_size=None, on_batch=None):
+    """
+    Import validated rows in pipelined MULTI/EXEC batches.
+
+    Args:
+        client: The Redis client to write to.
+        rows: Iterable of (line_number, raw row), see ndjson_rows and csv_rows.
+        parse: Turns a raw row into a record, e.g. ndjson_record.
+        batch_size (int): Rows per transaction, defaults to IMPORT_BATCH_SIZE.
+        on_batch: Called with the report and the patient IDs of every
+                  written batch, e.g. to invalidate caches.
+
+    Returns:
+        dict: rows, imported, duplicates (rows already stored), rejected, the
+              first rejected rows with their errors, seconds and rows_per_second.
+
+    Raises:
+        BulkImportError: If Redis failed to write a row.
+    """
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    report = new_report()
+    started = time.perf_counter()
+    sha = client.script_load(SAVE_ASSESSMENT_SCRIPT)
+
+    for batch in import_batches(rows, batch_size, report, parse):
+        try:
+            for _ in range(2):
+                pipe = client.pipeline(transaction=not is_cluster(client))
+                queue_import_batch(pipe, sha, batch)
+                results = pipe.execute(raise_on_error=False)
+                if not any(isinstance(result, NoScriptError) for result in results):
+                    break
+                # Redis was restarted or flushed its scripts during the import
+                sha = client.script_load(SAVE_ASSESSMENT_SCRIPT)
+        except RedisError as e:
+            raise import_failure(report, batch[0], e, started)
+        failure = count_batch_results(report, batch, results)
+        if on_batch is not None:
+            on_batch(report, {record['patient_id'] for record in batch})
+        if failure is not None:
+            raise import_failure(report, *failure, started)
+
+    return finish_report(report, started)
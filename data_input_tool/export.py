@@ -0,0 +1,294 @@
+"""
+Streaming export of the assessment history for analysis
+
+Patients are found with SCAN (patient hashes are the keys without a colon)
+and processed in chunks of ``chunk_size`` patients. Their assessment keys come
+from the sorted-set index (see assessment_index), restricted to the export
+window, and the hashes are fetched in pipelined chunks. Assessments are decoded
+whatever their storage format and nested objects are flattened into dotted
+column names ("answers.q1"), lists are kept as JSON strings.
+
+Two layouts are written:
+
+- long: one row per assessment field with the columns LONG_COLUMNS, so the
+  schema is known up front and every chunk can be written as it arrives.
+- wide: one row per patient with the latest value of every
+  "<assessment_name>.<field>" in the window. The column set is collected in a
+  first pass over the index and the latest hashes, the rows in a second one.
+
+Output is CSV or Parquet (requires pyarrow), produced chunk by chunk, so memory
+depends on the chunk size and the number of columns, not on the history size.
+
+Incremental exports pass the watermark returned by the previous export as
+``since``: only assessments with a unix timestamp after it are exported, and
+the new watermark is the upper bound of the current window. Assessments that
+are imported later with an older timestamp are not picked up again.
+"""
+
+import csv
+import io
+import json
+import os
+import time
+
+from assessment_format import decode_assessment
+from assessment_index import LEGACY_KEY_FALLBACK, parse_assessment_key, patient_index_key
+from redis_batch import PIPELINE_CHUNK_SIZE, chunked, fetch_hashes
+
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 500))
+LONG_COLUMNS = ['patient_id', 'assessment_name', 'key', 'unix_timestamp', 'timestamp', 'field', 'value']
+FORMATS = ('csv', 'parquet')
+LAYOUTS = ('long', 'wide')
+
+
+def export_window(since=None):
+    """
+    The (since, until) unix timestamps of an export starting now.
+
+    The current second is left out, so an assessment saved while the export
+    runs falls into the next window instead of being missed.
+    """
+    return since, int(time.time()) - 1
+
+
+def scan_patients(client, count=1000):
+    """Yield the IDs of all patients, via SCAN"""
+    for key in client.scan_iter(count=count, _type='hash'):
+        if key.isalnum():
+            yield key
+
+
+def patient_chunks(client, chunk_size):
+    chunk = []
+    for patient_id in scan_patients(client, count=chunk_size):
+        chunk.append(patient_id)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def window_keys(client, patient_ids, since, until):
+    """
+    Look up the assessment keys of many patients in the export window.
+
+    A patient has either version 1 or version 2 keys (see assessment_index),
+    with LEGACY_KEY_FALLBACK both indexes are read in the same pipeline.
+
+    Returns:
+        list: Assessment keys in ascending timestamp order per patient.
+    """
+    min_score = f'({since}' if since is not None else '-inf'
+    schemas = (None, 1) if LEGACY_KEY_FALLBACK else (None,)
+    pipe = client.pipeline(transaction=False)
+    for patient_id in patient_ids:
+        for schema in schemas:
+            pipe.zrangebyscore(patient_index_key(patient_id, schema), min_score, until)
+    return [key for keys in pipe.execute() for key in keys]
+
+
+def flatten(data, prefix=''):
+    """Flatten nested objects into dotted keys, lists become JSON strings"""
+    flat = {}
+    for field, value in data.items():
+        name = f'{prefix}{field}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{name}.'))
+        elif isinstance(value, list):
+            flat[name] = json.dumps(value)
+        elif value is None:
+            flat[name] = None
+        else:
+            flat[name] = str(value)
+    return flat
+
+
+def fetched_assessments(client, keys):
+    """Yield (parsed key, key, flattened data) for every assessment that still exists"""
+    for chunk in chunked(keys, PIPELINE_CHUNK_SIZE):
+        for key, raw in zip(chunk, fetch_hashes(client, chunk, chunk_size=0)):
+            parsed = parse_assessment_key(key)
+            if raw and parsed is not None:
+                yield parsed, key, flatten(decode_assessment(raw))
+
+
+def long_row_chunks(client, since, until, chunk_size):
+    """Yield lists of LONG_COLUMNS rows, one list per chunk of patients"""
+    for patient_ids in patient_chunks(client, chunk_size):
+        keys = window_keys(client, patient_ids, since, until)
+        for key_chunk in chunked(keys, PIPELINE_CHUNK_SIZE):
+            rows = []
+            for (patient_id, name, unix_timestamp, human), key, data in \
+                    fetched_assessments(client, key_chunk):
+                for field, value in data.items():
+                    rows.append([patient_id, name, key, unix_timestamp, human, field, value])
+            if rows:
+                yield rows
+
+
+def latest_keys(keys):
+    """Keep the newest key per (patient, assessment name) of ascending keys"""
+    latest = {}
+    for key in keys:
+        parsed = parse_assessment_key(key)
+        if parsed is not None:
+            latest[(parsed[0], parsed[1])] = key
+    return list(latest.values())
+
+
+def wide_records(client, since, until, chunk_size):
+    """Yield lists of {column: value} per patient, one list per chunk of patients"""
+    for patient_ids in patient_chunks(client, chunk_size):
+        keys = latest_keys(window_keys(client, patient_ids, since, until))
+        records = {}
+        for (patient_id, name, unix_timestamp, _), _key, data in fetched_assessments(client, keys):
+            record = records.setdefault(patient_id, {'patient_id': patient_id})
+            record[f'{name}.unix_timestamp'] = str(unix_timestamp)
+            for field, value in data.items():
+                record[f'{name}.{field}'] = value
+        if records:
+            yield list(records.values())
+
+
+def wide_columns(client, since, until, chunk_size):
+    """First pass of the wide layout: the sorted set of all columns"""
+    columns = set()
+    for records in wide_records(client, since, until, chunk_size):
+        for record in records:
+            columns.update(record)
+    columns.discard('patient_id')
+    return ['patient_id'] + sorted(columns)
+
+
+def wide_row_chunks(client, since, until, chunk_size, columns):
+    for records in wide_records(client, since, until, chunk_size):
+        yield [[record.get(column) for column in columns] for record in records]
+
+
+def csv_stream(columns, row_chunks):
+    """Yield CSV text, the header first and then one piece per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in row_chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _ChunkSink:
+    """Write-only file collecting what pyarrow writes until it is drained"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def parquet_stream(columns, row_chunks):
+    """
+    Produce a Parquet file piece by piece, one row group per chunk.
+
+    Raises:
+        RuntimeError: If pyarrow is not installed.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet export requires pyarrow: pip install pyarrow')
+
+    schema = pa.schema([
+        (column, pa.int64() if column == 'unix_timestamp' else pa.string())
+        for column in columns
+    ])
+    return _parquet_chunks(pa, pq, schema, row_chunks)
+
+
+def _parquet_chunks(pa, pq, schema, row_chunks):
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    for rows in row_chunks:
+        table = pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+            schema=schema,
+        )
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_stream(client, export_format='csv', layout='long', since=None, until=None,
+                  chunk_size=None):
+    """
+    Stream an export of the assessment history.
+
+    Args:
+        client: The Redis client to read from.
+        export_format (str): csv or parquet.
+        layout (str): long or wide, see the module documentation.
+        since (int): Only assessments after this unix timestamp (the watermark).
+        until (int): Only assessments up to this unix timestamp.
+        chunk_size (int): Patients per chunk, defaults to EXPORT_CHUNK_SIZE.
+
+    Returns:
+        iterator: str pieces for CSV, bytes for Parquet.
+
+    Raises:
+        ValueError: If the format or layout is not supported.
+    """
+    if export_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout must be one of {', '.join(LAYOUTS)}")
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+
+    if layout == 'long':
+        columns = LONG_COLUMNS
+        row_chunks = long_row_chunks(client, since, until, chunk_size)
+    else:
+        columns = wide_columns(client, since, until, chunk_size)
+        row_chunks = wide_row_chunks(client, since, until, chunk_size, columns)
+
+    if export_format == 'csv':
+        return csv_stream(columns, row_chunks)
+    return parquet_stream(columns, row_chunks)
+
+
+def read_watermark(path):
+    """The watermark stored by the previous export, None for a full export"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f).get('watermark')
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(path, watermark):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'watermark': watermark}, f)
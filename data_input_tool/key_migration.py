@@ -0,0 +1,155 @@
+"""
+Migration of version 1 keys to key schema 2 (hash-tagged patient IDs)
+
+See assessment_index for both layouts. Patients are found by their version 1
+patient index (``idx:<patient_id>``, walked with SCAN) and moved one at a time
+by MIGRATE_PATIENT_SCRIPT: the assessment hashes are renamed, the indexes and
+latest pointers rewritten under the new keys and the old ones deleted. The
+script is atomic, so a concurrent request sees a patient either completely in
+the old or completely in the new layout, and with LEGACY_KEY_FALLBACK the API
+serves both while the migration runs. A patient saved to in the meantime keeps
+the old layout until the migrator reaches it.
+
+Medication hashes are renamed one by one afterwards; RediSearch follows the
+rename. Only indexed assessments are found, run build-index first on data that
+predates the index.
+
+The script touches keys of several hash slots and has to run against the
+standalone Redis, before REDIS_CLUSTER is switched on. It is idempotent, an
+interrupted migration is simply started again.
+
+    flask --app app migrate-keys
+"""
+
+import time
+
+from redis.exceptions import ResponseError
+
+from assessment_index import INDEX_PREFIX, LATEST_PREFIX, patient_index_key, patient_tag
+from assessment_store import run_script
+from medications import MEDICATION_PREFIX
+
+# KEYS: version 1 patient index, version 2 patient index
+# ARGV: patient ID, INDEX_PREFIX, LATEST_PREFIX
+MIGRATE_PATIENT_SCRIPT = """
+local patient_id, index_prefix, latest_prefix = ARGV[1], ARGV[2], ARGV[3]
+local tag = '{' .. patient_id .. '}'
+local entries = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+local names = {}
+local moved = 0
+for i = 1, #entries, 2 do
+    local old_key, score = entries[i], entries[i + 1]
+    -- ':<assessment_name>:<unix>:<human>'
+    local rest = string.sub(old_key, #patient_id + 1)
+    local name = string.match(rest, '^:([^:]*):')
+    local new_key = tag .. rest
+    if redis.call('EXISTS', old_key) == 1 then
+        redis.call('RENAME', old_key, new_key)
+        moved = moved + 1
+    end
+    redis.call('ZADD', KEYS[2], score, new_key)
+    if name then
+        names[name] = true
+        redis.call('ZADD', index_prefix .. ':' .. tag .. ':' .. name, score, new_key)
+    end
+end
+for name in pairs(names) do
+    local old_pointer = latest_prefix .. ':' .. patient_id .. ':' .. name
+    local pointer = redis.call('HMGET', old_pointer, 'key', 'unix_timestamp')
+    if pointer[1] then
+        redis.call('HSET', latest_prefix .. ':' .. tag .. ':' .. name,
+                   'key', tag .. string.sub(pointer[1], #patient_id + 1),
+                   'unix_timestamp', pointer[2])
+    end
+    redis.call('DEL', old_pointer, index_prefix .. ':' .. patient_id .. ':' .. name)
+end
+redis.call('DEL', KEYS[1])
+return moved
+"""
+
+
+def legacy_patients(client, count=500):
+    """Yield the IDs of patients that still have a version 1 index"""
+    prefix = f'{INDEX_PREFIX}:'
+    for key in client.scan_iter(match=f'{prefix}*', count=count, _type='zset'):
+        patient_id = key[len(prefix):]
+        # Type indexes contain another colon, version 2 indexes braces
+        if patient_id.isalnum():
+            yield patient_id
+
+
+def migrate_patient(client, patient_id):
+    """
+    Move the assessments of one patient to key schema 2.
+
+    Returns:
+        int: The number of assessment hashes renamed.
+    """
+    return run_script(
+        client,
+        MIGRATE_PATIENT_SCRIPT,
+        keys=[patient_index_key(patient_id, schema=1), patient_index_key(patient_id, schema=2)],
+        args=[patient_id, INDEX_PREFIX, LATEST_PREFIX],
+    )
+
+
+def legacy_medication_key(key):
+    """The version 2 key of a version 1 medication key, None if it is not one"""
+    rest = key[len(MEDICATION_PREFIX):]
+    patient_id, _, slot_position = rest.partition(':')
+    if not patient_id.isalnum() or not slot_position:
+        return None
+    return f'{MEDICATION_PREFIX}{patient_tag(patient_id, schema=2)}:{slot_position}'
+
+
+def migrate_medications(client, count=500):
+    """
+    Rename the version 1 medication hashes.
+
+    Returns:
+        int: The number of hashes renamed.
+    """
+    renamed = 0
+    for key in client.scan_iter(match=f'{MEDICATION_PREFIX}*', count=count, _type='hash'):
+        new_key = legacy_medication_key(key)
+        if new_key is None:
+            continue
+        try:
+            if client.renamenx(key, new_key):
+                renamed += 1
+        except ResponseError:
+            # Deleted by a plan replaced since the scan started
+            pass
+    return renamed
+
+
+def migrate_keys(client, pause=0.0, count=500, on_patient=None):
+    """
+    Migrate all version 1 keys, patient by patient.
+
+    Args:
+        client: The Redis client, connected to a standalone Redis.
+        pause (float): Seconds to sleep after every patient, to limit the load.
+        count (int): SCAN batch size.
+        on_patient: Called with the report after every migrated patient.
+
+    Returns:
+        dict: patients, assessments and medications migrated, seconds.
+    """
+    report = {'patients': 0, 'assessments': 0, 'medications': 0}
+    started = time.perf_counter()
+    for patient_id in legacy_patients(client, count):
+        report['assessments'] += migrate_patient(client, patient_id)
+        report['patients'] += 1
+        if on_patient is not None:
+            on_patient(report, patient_id)
+        if pause:
+            time.sleep(pause)
+    report['medications'] = migrate_medications(client, count)
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def legacy_key_count(client, count=500):
+    """Version 1 patient indexes left, 0 once LEGACY_KEY_FALLBACK can be switched off"""
+    return sum(1 for _ in legacy_patients(client, count))
@@ -0,0 +1,251 @@
+"""
+Lab values stored as RedisTimeSeries
+
+Every lab value of a patient is one series ``patient:<patient_id>:<lab>``
+(the layout written by surge_ahead/okie_dashboard/dashboard/populate_redis.py
+and read by the dashboard). When a series is created, one compacted series per
+entry of COMPACTIONS is created next to it, together with the rule that keeps
+it up to date:
+
+    patient:<patient_id>:<lab>:<aggregation>:<bucket>
+
+Reads for a bucket size and aggregation that has a compaction are served from
+the compacted series, so a 30-day trend is a few dozen stored points instead of
+an aggregation over every raw sample. Other buckets are aggregated by Redis at
+query time. A compaction only holds closed buckets; the bucket that is still
+filling shows up once the first sample of the next bucket arrives.
+
+All series carry the labels ``patient`` and ``lab``; compacted ones also
+``aggregation`` and ``bucket``. TS.MRANGE uses them to select the series of a
+whole ward in one call.
+
+The module must be loaded into Redis (the redis/redis-stack-server image of
+docker-compose.yml ships it); without it the lab endpoints answer 503.
+
+The functions here only build the commands and parse the replies, so the Flask
+app and the ASGI app share them.
+"""
+
+import os
+import re
+
+LAB_NAMES = os.getenv('LAB_NAMES', 'hemoglobin,creatinin,egfr').split(',')
+AGGREGATIONS = ('avg', 'min', 'max', 'last')
+
+# Raw samples older than this are trimmed by Redis, 0 keeps them forever
+LAB_RAW_RETENTION_MS = int(os.getenv('LAB_RAW_RETENTION_MS', 0))
+
+HOUR_MS = 60 * 60 * 1000
+DAY_MS = 24 * HOUR_MS
+
+# (aggregation, bucket label, bucket size in ms) kept up to date by compaction rules
+COMPACTIONS = (
+    ('avg', '1h', HOUR_MS),
+    ('avg', '1d', DAY_MS),
+    ('min', '1d', DAY_MS),
+    ('max', '1d', DAY_MS),
+    ('last', '1d', DAY_MS),
+)
+
+_BUCKET_UNITS = {'s': 1000, 'm': 60 * 1000, 'h': HOUR_MS, 'd': DAY_MS}
+_BUCKET_PATTERN = re.compile(r'^(\d+)([smhd]?)$')
+
+
+def lab_series_key(patient_id, lab):
+    return f"patient:{patient_id}:{lab}"
+
+
+def compacted_series_key(patient_id, lab, aggregation, bucket_label):
+    return f"{lab_series_key(patient_id, lab)}:{aggregation}:{bucket_label}"
+
+
+def parse_bucket(value):
+    """
+    Parse a bucket size given in ms or with a unit (30s, 15m, 1h, 1d).
+
+    Raises:
+        ValueError: If the value is malformed or not positive.
+    """
+    match = _BUCKET_PATTERN.match(str(value).strip())
+    if not match or int(match.group(1)) <= 0:
+        raise ValueError('bucket must be a positive number of ms or end in s, m, h or d')
+    number, unit = match.groups()
+    return int(number) * _BUCKET_UNITS.get(unit, 1)
+
+
+def series_setup_commands(patient_id, lab):
+    """
+    Build the commands creating a lab series with its compactions.
+
+    Commands on series that already exist fail with "already exists" and can
+    be ignored, so the setup is safe to repeat.
+    """
+    key = lab_series_key(patient_id, lab)
+    labels = ('LABELS', 'patient', patient_id, 'lab', lab)
+    commands = [(
+        'TS.CREATE', key, 'RETENTION', LAB_RAW_RETENTION_MS,
+        'DUPLICATE_POLICY', 'LAST', *labels
+    )]
+    for aggregation, bucket_label, bucket_ms in COMPACTIONS:
+        compacted = compacted_series_key(patient_id, lab, aggregation, bucket_label)
+        commands.append((
+            'TS.CREATE', compacted, *labels,
+            'aggregation', aggregation, 'bucket', bucket_label
+        ))
+        commands.append((
+            'TS.CREATERULE', key, compacted, 'AGGREGATION', aggregation, bucket_ms
+        ))
+    return commands
+
+
+def is_existing_series_error(result):
+    """Whether a pipeline reply is the error of creating an existing series or rule"""
+    return isinstance(result, Exception) and (
+        'already exists' in str(result) or 'already has' in str(result)
+    )
+
+
+def is_timeseries_missing_error(result):
+    """Whether a reply is the error of a TS.* command on a Redis without RedisTimeSeries"""
+    message = str(result).lower()
+    return isinstance(result, Exception) and 'unknown command' in message and "'ts." in message
+
+
+def check_setup_results(results):
+    """Raise the first error of a series setup other than an existing series"""
+    for result in results:
+        if isinstance(result, Exception) and not is_existing_series_error(result):
+            raise result
+
+
+def parse_samples(payload):
+    """
+    Read the samples of an append request.
+
+    Accepts {"timestamp": ms, "value": x}, a list of such objects or
+    {"samples": [...]}. A missing timestamp means "now" and is left to Redis.
+
+    Returns:
+        list: (timestamp or '*', value) tuples.
+
+    Raises:
+        ValueError: If a sample is malformed.
+    """
+    if isinstance(payload, dict) and 'samples' in payload:
+        payload = payload['samples']
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list) or not payload:
+        raise ValueError('Expected one or more samples')
+
+    samples = []
+    for sample in payload:
+        if not isinstance(sample, dict):
+            raise ValueError('Samples must be objects with timestamp and value')
+        timestamp = sample.get('timestamp', '*')
+        value = sample.get('value')
+        if timestamp != '*' and (isinstance(timestamp, bool) or not isinstance(timestamp, int)):
+            raise ValueError('timestamp must be an integer in ms')
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError('value must be a number')
+        samples.append((timestamp, value))
+    return samples
+
+
+def madd_command(patient_id, lab, samples):
+    key = lab_series_key(patient_id, lab)
+    args = ['TS.MADD']
+    for timestamp, value in samples:
+        args.extend((key, timestamp, value))
+    return args
+
+
+def parse_range_args(args):
+    """
+    Read the query parameters of a range request.
+
+    Supported query parameters: from, to (ms, default the whole series),
+    aggregation (avg, min, max or last, default avg) and bucket (ms or with a
+    unit, e.g. 1h; without it the raw samples are returned).
+
+    Returns:
+        dict: from_ts, to_ts, aggregation and bucket_ms.
+
+    Raises:
+        ValueError: If one of the parameters is malformed.
+    """
+    from_ts = args.get('from', '-')
+    to_ts = args.get('to', '+')
+    for value in (from_ts, to_ts):
+        if value not in ('-', '+') and not value.isdigit():
+            raise ValueError('from and to must be timestamps in ms')
+    aggregation = args.get('aggregation', 'avg')
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"aggregation must be one of {', '.join(AGGREGATIONS)}")
+    bucket = args.get('bucket')
+    return {
+        'from_ts': from_ts,
+        'to_ts': to_ts,
+        'aggregation': aggregation,
+        'bucket_ms': parse_bucket(bucket) if bucket is not None else None,
+    }
+
+
+def compaction_for(aggregation, bucket_ms):
+    """The bucket label of a matching compaction, or None"""
+    for rule_aggregation, bucket_label, rule_bucket_ms in COMPACTIONS:
+        if rule_aggregation == aggregation and rule_bucket_ms == bucket_ms:
+            return bucket_label
+    return None
+
+
+def range_command(patient_id, lab, from_ts='-', to_ts='+', aggregation='avg', bucket_ms=None):
+    """Build the TS.RANGE of one series, reading a compaction when one matches"""
+    if bucket_ms is None:
+        return ['TS.RANGE', lab_series_key(patient_id, lab), from_ts, to_ts]
+    bucket_label = compaction_for(aggregation, bucket_ms)
+    if bucket_label is not None:
+        key = compacted_series_key(patient_id, lab, aggregation, bucket_label)
+        return ['TS.RANGE', key, from_ts, to_ts]
+    return [
+        'TS.RANGE', lab_series_key(patient_id, lab), from_ts, to_ts,
+        'AGGREGATION', aggregation, bucket_ms
+    ]
+
+
+def mrange_command(lab, patient_ids=None, from_ts='-', to_ts='+', aggregation='avg', bucket_ms=None):
+    """Build the TS.MRANGE over a lab value of many (or all) patients"""
+    filters = [f'lab={lab}']
+    if patient_ids:
+        filters.append(f"patient=({','.join(patient_ids)})")
+
+    command = ['TS.MRANGE', from_ts, to_ts]
+    bucket_label = compaction_for(aggregation, bucket_ms) if bucket_ms is not None else None
+    if bucket_label is not None:
+        filters.extend((f'aggregation={aggregation}', f'bucket={bucket_label}'))
+    else:
+        # Series without an aggregation label are the raw ones
+        filters.append('aggregation=')
+        if bucket_ms is not None:
+            command.extend(('AGGREGATION', aggregation, bucket_ms))
+    return command + ['FILTER', *filters]
+
+
+def parse_points(reply):
+    """Turn a TS.RANGE reply into [[timestamp, value], ...]"""
+    return [[int(timestamp), float(value)] for timestamp, value in reply]
+
+
+def parse_mrange(reply):
+    """Turn a TS.MRANGE reply into {patient_id: [[timestamp, value], ...]}"""
+    # Depending on the client version and protocol the reply is a list of
+    # [key, labels, points] or already a dictionary key -> [labels, ..., points]
+    if isinstance(reply, dict):
+        entries = reply.items()
+    else:
+        entries = ((entry[0], entry[1:]) for entry in reply)
+    series = {}
+    for key, parts in entries:
+        patient_id = key.split(':')[1]
+        series[patient_id] = parse_points(parts[-1])
+    return series
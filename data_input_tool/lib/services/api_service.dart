@@ -163,11 +163,13 @@ class ApiService {
       print('Response body: ${response.body}');
       final responseData = jsonDecode(response.body);
       print('Response data: $responseData');
+      // 202: the API runs in write-behind mode and queued the assessment
+      final bool isSuccess = response.statusCode == 200 || response.statusCode == 202;
       return {
         'statusCode': response.statusCode,
-        'success': response.statusCode == 200,
-        'message': response.statusCode == 200 
-          ? 'Assessment saved successfully' 
+        'success': isSuccess,
+        'message': isSuccess 
+          ? responseData['message'] ?? 'Assessment saved successfully' 
           : responseData['message'] ?? 'Failed to save assessment',
         'data': responseData
       };
@@ -250,7 +252,7 @@ class ApiService {
       return {
         'statusCode': response.statusCode,
         'body': responseData,
-        'message': response.statusCode == 200 ? 'Data posted successfully' : 'Failed to post data',
+        'message': response.statusCode == 200 || response.statusCode == 202 ? 'Data posted successfully' : 'Failed to post data',
       };
     } catch (e) {
       return {'error': e.toString()};
@@ -0,0 +1,201 @@
+"""
+Load test for the assessment API
+
+Seeds a set of patients with assessments and then drives a mixed read/write
+workload against one or more running instances of the API, reporting
+throughput and latency percentiles per target. Only the standard library is
+used, so it runs anywhere the API runs.
+
+Compare the Flask app with the ASGI app against the same local Redis:
+    docker run -d -p 6379:6379 redis:latest
+    python app.py                                    # sync, port 5000
+    uvicorn asgi_app:app --port 8000 --workers 1     # async, port 8000
+    python loadtest.py --target sync=http://localhost:5000 \\
+                       --target async=http://localhost:8000
+
+Reference run (--concurrency 32 --duration 20, default seed data), both apps
+and Redis on one shared CPU core; Redis was fakeredis' TCP server (RESP over
+localhost), so absolute numbers are far below a real redis-server:
+
+    target   req/s   p50 ms   p95 ms   p99 ms   errors
+    sync     197.2    54.77   697.19  1193.22        4
+    async    156.8   192.02   368.42   446.28        0
+
+The Flask development server (threaded) serves more requests when the single
+core is saturated, the ASGI app under uvicorn (one worker) keeps the tail
+latency down: p99 2.7x lower, and the snapshot route's p99 drops from 1498 ms
+to 439 ms because slow pipelines no longer hold a thread each.
+"""
+
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+ASSESSMENT_NAMES = ['Barthel Index', 'MoCA 5min', 'PHQ4', 'Schmerz']
+
+
+class ApiConnection:
+    """One keep-alive HTTP connection per worker thread"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload) if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body else {}
+        try:
+            self.connection.request(method, quote(path, safe='/?=&,'), body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, ConnectionError):
+            self.connection.close()
+            raise
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def seed(base_url, prefix, patients, assessments_per_patient):
+    """Create the patients and their assessment history"""
+    connection = ApiConnection(base_url)
+    patient_ids = []
+    for n in range(patients):
+        patient_id = f"{prefix}{n}"
+        connection.request('POST', '/api', {'identifier': patient_id})
+        for i in range(assessments_per_patient):
+            name = ASSESSMENT_NAMES[i % len(ASSESSMENT_NAMES)]
+            connection.request('POST', f'/api/{patient_id}/{name}',
+                               {'item_1': i % 4, 'item_2': {'answer': i}})
+        patient_ids.append(patient_id)
+    return patient_ids
+
+
+def operations(patient_ids, rng):
+    """Pick the next request of the mixed workload"""
+    patient_id = rng.choice(patient_ids)
+    name = rng.choice(ASSESSMENT_NAMES)
+    return rng.choices(
+        [
+            ('latest', 'GET', f'/api/{patient_id}/{name}/latest', None),
+            ('barthel_latest', 'GET', f'/api/{patient_id}/barthel/latest', None),
+            ('assessments', 'GET', f'/api/{patient_id}/assessments?limit=50', None),
+            ('all', 'GET', f'/api/{patient_id}/all?limit=50', None),
+            ('save', 'POST', f'/api/{patient_id}/{name}', {'item_1': rng.randint(0, 3)}),
+            ('snapshot', 'GET', '/api/ward-snapshot?patients='
+             + ','.join(rng.sample(patient_ids, min(10, len(patient_ids))))
+             + '&assessments=' + ','.join(ASSESSMENT_NAMES), None),
+        ],
+        weights=[40, 10, 15, 10, 20, 5],
+    )[0]
+
+
+def run_target(base_url, patient_ids, concurrency, duration, seed_value):
+    """Hammer one target and collect latencies per route"""
+    latencies = {}
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(worker_id):
+        nonlocal errors
+        rng = random.Random(seed_value + worker_id)
+        connection = ApiConnection(base_url)
+        local = {}
+        local_errors = 0
+        while time.perf_counter() < deadline:
+            route, method, path, payload = operations(patient_ids, rng)
+            start = time.perf_counter()
+            try:
+                status = connection.request(method, path, payload)
+            except (http.client.HTTPException, OSError):
+                status = 599
+            elapsed = time.perf_counter() - start
+            if status >= 500:
+                local_errors += 1
+            local.setdefault(route, []).append(elapsed)
+        with lock:
+            for route, values in local.items():
+                latencies.setdefault(route, []).extend(values)
+            errors += local_errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    wall_time = time.perf_counter() - started
+
+    report = {'errors': errors, 'routes': {}}
+    all_latencies = []
+    for route, values in sorted(latencies.items()):
+        values.sort()
+        all_latencies.extend(values)
+        report['routes'][route] = summarize(values, wall_time)
+    all_latencies.sort()
+    report['total'] = summarize(all_latencies, wall_time)
+    return report
+
+
+def summarize(sorted_values, wall_time):
+    return {
+        'requests': len(sorted_values),
+        'throughput_rps': round(len(sorted_values) / wall_time, 1) if wall_time else 0.0,
+        'p50_ms': round(percentile(sorted_values, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(sorted_values, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(sorted_values, 0.99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--target', action='append', required=True,
+                        help='name=base_url of an API instance, may be repeated')
+    parser.add_argument('--patients', type=int, default=50)
+    parser.add_argument('--assessments', type=int, default=20,
+                        help='assessments seeded per patient')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per target')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    targets = [target.split('=', 1) for target in args.target]
+    # All targets share the same Redis, so seeding through the first one is enough
+    prefix = 'load' + uuid.uuid4().hex[:8]
+    print(f"Seeding {args.patients} patients x {args.assessments} assessments ...")
+    patient_ids = seed(targets[0][1], prefix, args.patients, args.assessments)
+
+    results = {}
+    for name, base_url in targets:
+        print(f"Running {args.duration:.0f}s against {name} ({base_url}) "
+              f"with {args.concurrency} concurrent clients ...")
+        results[name] = run_target(base_url, patient_ids, args.concurrency,
+                                   args.duration, args.seed)
+
+    print(f"\n{'target':<10}{'route':<16}{'requests':>10}{'req/s':>10}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, report in results.items():
+        rows = list(report['routes'].items()) + [('TOTAL', report['total'])]
+        for route, stats in rows:
+            print(f"{name:<10}{route:<16}{stats['requests']:>10}{stats['throughput_rps']:>10}"
+                  f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+        print(f"{name:<10}{'errors':<16}{report['errors']:>10}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Medication plans indexed with RediSearch
+
+Every medication of a patient is one hash
+
+    medication:<patient_id>:<slot>:<position>  {patient, slot, position, name}
+
+where the slot is the point in time of the plan (e.g. preop, latest). The
+index ``MEDICATION_INDEX`` covers all of them: patient and slot are TAG fields,
+so listing one patient's plan is an exact-match lookup whose cost depends on
+the size of that plan, not on the number of patients. Names are full text for
+prefix and fuzzy search, and position is sortable.
+
+With key schema 2 (see assessment_index) the patient ID in the key is a hash
+tag, ``medication:{<patient_id>}:<slot>:<position>``, so replacing a plan stays
+within one hash slot. Keys are only ever read back from search results, so
+both layouts can coexist until key_migration renamed the old ones.
+
+RediSearch must be loaded into Redis (the redis/redis-stack-server image of
+docker-compose.yml ships it); without it the medication endpoints answer 503.
+
+RediSearch updates the index itself on every HSET and DEL of a medication
+hash, so no rebuild is needed after writes. An index created with the older
+TEXT schema is replaced (keeping the hashes) the first time
+ensure_medication_index runs.
+"""
+
+import re
+
+from redis.commands.search.query import Query
+from redis.exceptions import ResponseError
+
+from assessment_index import patient_tag
+
+MEDICATION_INDEX = 'medis_index'
+MEDICATION_PREFIX = 'medication:'
+MAX_MEDICATIONS = 1000
+
+INDEX_SCHEMA = (
+    'patient', 'TAG',
+    'slot', 'TAG',
+    'position', 'NUMERIC', 'SORTABLE',
+    'name', 'TEXT',
+)
+
+_RETURN_FIELDS = ('patient', 'slot', 'position', 'name')
+_WORD = re.compile(r'\w+')
+
+
+def medication_key(patient_id, slot, position):
+    return f"{MEDICATION_PREFIX}{patient_tag(patient_id)}:{slot}:{position}"
+
+
+def create_index_command():
+    """Build the FT.CREATE of the medication index"""
+    return (
+        'FT.CREATE', MEDICATION_INDEX,
+        'ON', 'HASH',
+        'PREFIX', '1', MEDICATION_PREFIX,
+        'SCHEMA', *INDEX_SCHEMA,
+    )
+
+
+def is_search_missing_error(error):
+    """Whether Redis rejected an FT.* command because RediSearch is not loaded"""
+    message = str(error).lower()
+    return isinstance(error, ResponseError) and 'unknown command' in message and "'ft." in message
+
+
+def is_index_exists_error(error):
+    return isinstance(error, ResponseError) and 'index already exists' in str(error).lower()
+
+
+def index_is_current(info):
+    """Whether FT.INFO describes an index with the TAG schema"""
+    types = {}
+    for attribute in info.get('attributes', []):
+        fields = dict(zip(attribute[::2], attribute[1::2]))
+        types[fields.get('attribute')] = fields.get('type')
+    return types.get('patient') == 'TAG' and types.get('slot') == 'TAG'
+
+
+def ensure_medication_index(client):
+    """
+    Create the medication index, or replace one with an outdated schema.
+
+    Returns:
+        bool: Whether the index was (re)created.
+    """
+    try:
+        client.execute_command(*create_index_command())
+        return True
+    except ResponseError as e:
+        if not is_index_exists_error(e):
+            raise
+    if index_is_current(client.ft(MEDICATION_INDEX).info()):
+        return False
+    # Dropping the index keeps the hashes, they are indexed again on creation
+    client.ft(MEDICATION_INDEX).dropindex(delete_documents=False)
+    client.execute_command(*create_index_command())
+    return True
+
+
+def validate_slot(slot):
+    if not slot or not slot.isalnum():
+        raise ValueError('slot must be alphanumeric')
+    return slot
+
+
+def tag_filter(patient_id=None, slot=None):
+    """Query clauses selecting a patient and/or slot via the TAG fields"""
+    clauses = []
+    if patient_id:
+        clauses.append(f'@patient:{{{patient_id}}}')
+    if slot:
+        clauses.append(f'@slot:{{{slot}}}')
+    return clauses
+
+
+def list_query(patient_id, slot=None, limit=MAX_MEDICATIONS):
+    """Query of a patient's medications, ordered by position"""
+    return (
+        Query(' '.join(tag_filter(patient_id, slot)))
+        .return_fields(*_RETURN_FIELDS)
+        .sort_by('position', asc=True)
+        .paging(0, limit)
+    )
+
+
+def search_query(text, fuzzy=False, patient_id=None, slot=None, limit=20):
+    """
+    Query of medications by name.
+
+    Every word of `text` matches as a prefix ("Rami" finds "Ramipril"), or
+    with fuzzy=True within a Levenshtein distance of one ("Ramiprill").
+    Results are ordered by relevance.
+
+    Raises:
+        ValueError: If the text has no searchable words.
+    """
+    # Split like the RediSearch tokenizer, so "0,25mg" becomes "0" and "25mg"
+    words = _WORD.findall(text)
+    if not words:
+        raise ValueError('q must contain at least one word')
+    if fuzzy:
+        terms = [f'%{word}%' if len(word) > 3 else word for word in words]
+    else:
+        # Prefixes shorter than two characters are rejected by RediSearch
+        terms = [f'{word}*' if len(word) > 1 else word for word in words]
+    clauses = tag_filter(patient_id, slot) + [f"@name:({' '.join(terms)})"]
+    return Query(' '.join(clauses)).return_fields(*_RETURN_FIELDS).paging(0, limit)
+
+
+def slot_keys_query(patient_id, slot):
+    """Query of the keys currently making up the plan of a slot"""
+    return Query(' '.join(tag_filter(patient_id, slot))).no_content().paging(0, MAX_MEDICATIONS)
+
+
+def parse_search_result(result):
+    """Turn a search result into a list of medication dictionaries"""
+    medications = []
+    for doc in result.docs:
+        medications.append({
+            'key': doc.id,
+            'patient': getattr(doc, 'patient', None),
+            'slot': getattr(doc, 'slot', None),
+            'position': int(float(getattr(doc, 'position', 0) or 0)),
+            'name': getattr(doc, 'name', None),
+        })
+    return medications
+
+
+def parse_medication_names(payload):
+    """
+    Read the medications of a plan update.
+
+    Accepts {"medications": ["name", ...]} in the order of their positions.
+
+    Raises:
+        ValueError: If the list is missing or contains something else than names.
+    """
+    names = (payload or {}).get('medications') if isinstance(payload, dict) else None
+    if not isinstance(names, list) or len(names) > MAX_MEDICATIONS:
+        raise ValueError(f'medications must be a list of at most {MAX_MEDICATIONS} names')
+    if not all(isinstance(name, str) and name.strip() for name in names):
+        raise ValueError('medications must be non-empty strings')
+    return [name.strip() for name in names]
+
+
+def queue_replace_slot(pipe, patient_id, slot, names, old_keys):
+    """Queue the removal of the previous plan of a slot and the new one"""
+    if old_keys:
+        pipe.delete(*old_keys)
+    for position, name in enumerate(names, start=1):
+        pipe.hset(medication_key(patient_id, slot, position), mapping={
+            'patient': patient_id,
+            'slot': slot,
+            'position': position,
+            'name': name,
+        })
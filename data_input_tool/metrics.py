@@ -0,0 +1,238 @@
+"""
+Hot-path instrumentation of the assessment API in Prometheus text format
+
+Set METRICS_ENABLED=1 to collect:
+- request latency per route, method and status
+- Redis round trips and commands per request (see redis_tracking)
+- request and response payload sizes
+- time spent in the sections wrapped with ``timed()``, e.g. JSON encoding
+- the counters of the read cache
+
+and serve them on /metrics. When disabled no request hooks are installed and
+``timed()`` returns a shared no-op, so the instrumentation costs nothing.
+
+Every worker process keeps its own numbers; scrape each worker separately.
+"""
+
+import os
+import threading
+import time
+
+from flask import Response, g, request
+
+from redis_tracking import request_counts
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '0') == '1'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """Cumulative histogram with labels"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, [('le', bound)])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'assessment_api_request_duration_seconds',
+    'Time spent handling a request.',
+    ('route', 'method', 'status'),
+)
+REDIS_ROUND_TRIPS = Histogram(
+    'assessment_api_redis_round_trips_per_request',
+    'Redis round trips issued by one request.',
+    ('route',), COUNT_BUCKETS,
+)
+REDIS_COMMANDS = Histogram(
+    'assessment_api_redis_commands_per_request',
+    'Redis commands issued by one request.',
+    ('route',), COUNT_BUCKETS,
+)
+REDIS_COMMANDS_TOTAL = Counter(
+    'assessment_api_redis_commands_total',
+    'Redis commands issued, by route.',
+    ('route',),
+)
+REQUEST_BYTES = Histogram(
+    'assessment_api_request_bytes',
+    'Size of the request body.',
+    ('route',), BYTE_BUCKETS,
+)
+RESPONSE_BYTES = Histogram(
+    'assessment_api_response_bytes',
+    'Size of the response body (streamed responses are not counted).',
+    ('route',), BYTE_BUCKETS,
+)
+SECTION_DURATION = Histogram(
+    'assessment_api_section_duration_seconds',
+    'Time spent in instrumented sections of a request, e.g. JSON encoding.',
+    ('route', 'section'),
+)
+
+METRICS = [
+    REQUEST_DURATION, REDIS_ROUND_TRIPS, REDIS_COMMANDS, REDIS_COMMANDS_TOTAL,
+    REQUEST_BYTES, RESPONSE_BYTES, SECTION_DURATION,
+]
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _SectionTimer:
+    def __init__(self, section):
+        self.section = section
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        SECTION_DURATION.observe(
+            time.perf_counter() - self.start,
+            route=_route_label(), section=self.section,
+        )
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def timed(section):
+    """Context manager timing a section of the current request"""
+    if not METRICS_ENABLED:
+        return _NOOP_TIMER
+    return _SectionTimer(section)
+
+
+def _route_label():
+    # The URL rule keeps the label cardinality bounded, unlike the raw path
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def render_metrics(read_cache=None):
+    """Render all metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    if read_cache is not None:
+        stats = read_cache.stats()
+        lines.append('# HELP assessment_api_read_cache_events_total Read cache events by type.')
+        lines.append('# TYPE assessment_api_read_cache_events_total counter')
+        for event in ('hits', 'misses', 'evictions', 'expirations', 'invalidations'):
+            lines.append(f'assessment_api_read_cache_events_total{{event="{event}"}} {stats[event]}')
+        lines.append('# HELP assessment_api_read_cache_entries Entries currently cached.')
+        lines.append('# TYPE assessment_api_read_cache_entries gauge')
+        lines.append(f'assessment_api_read_cache_entries {stats["size"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app, read_cache=None):
+    """Install the request hooks and the /metrics route if metrics are enabled"""
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        route = _route_label()
+        REQUEST_DURATION.observe(
+            time.perf_counter() - start,
+            route=route, method=request.method, status=response.status_code,
+        )
+        round_trips, commands = request_counts()
+        REDIS_ROUND_TRIPS.observe(round_trips, route=route)
+        REDIS_COMMANDS.observe(commands, route=route)
+        REDIS_COMMANDS_TOTAL.inc(commands, route=route)
+        REQUEST_BYTES.observe(request.content_length or 0, route=route)
+        if not response.is_streamed:
+            RESPONSE_BYTES.observe(response.calculate_content_length() or 0, route=route)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        """Prometheus scrape endpoint"""
+        return Response(render_metrics(read_cache), mimetype='text/plain; version=0.0.4')
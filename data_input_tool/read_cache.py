@@ -0,0 +1,142 @@
+"""
+In-process read-through cache for patient and latest-assessment reads
+
+Entries are grouped per patient and dropped as a whole when that patient is
+written to (create, save_assessment). A per-patient generation counter makes
+sure a read that raced with a write cannot put the old value back into the
+cache after the invalidation.
+
+With several worker processes each one holds its own cache. Writes can then be
+announced on the Redis pub/sub channel ``INVALIDATION_CHANNEL`` so every worker
+drops its copy; without it, other workers serve stale entries for at most the
+TTL.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+INVALIDATION_CHANNEL = 'cache-invalidate'
+
+
+class ReadCache:
+    """Thread-safe LRU cache with a TTL and hit/miss/eviction counters"""
+
+    def __init__(self, maxsize=10000, ttl=5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_patient = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def generation(self, patient_id):
+        """Take before reading from Redis and hand to set() afterwards"""
+        return self._generations.get(patient_id, 0)
+
+    def get(self, patient_id, kind, name=None):
+        """
+        Look up a cached value.
+
+        Returns:
+            tuple: (True, value) on a hit, (False, None) on a miss.
+        """
+        if not self.enabled:
+            return False, None
+        key = (patient_id, kind, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            expires, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def set(self, patient_id, kind, value, name=None, generation=None):
+        """Cache a value unless the patient was written to since `generation`"""
+        if not self.enabled:
+            return
+        key = (patient_id, kind, name)
+        with self._lock:
+            if generation is not None and generation != self._generations.get(patient_id, 0):
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._by_patient.setdefault(patient_id, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_patient(self, patient_id):
+        """Drop every cached entry of a patient"""
+        with self._lock:
+            self._generations[patient_id] = self._generations.get(patient_id, 0) + 1
+            for key in self._by_patient.pop(patient_id, ()):
+                self._entries.pop(key, None)
+            self.invalidations += 1
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._by_patient.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_patient[key[0]]
+
+    def stats(self):
+        """Counters for sizing the cache"""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+def start_invalidation_listener(client, *caches):
+    """
+    Drop the entries of patients announced on INVALIDATION_CHANNEL from all caches.
+
+    Returns:
+        The background thread running the subscription.
+    """
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+
+    def invalidate(message):
+        for cache in caches:
+            cache.invalidate_patient(message['data'])
+
+    pubsub.subscribe(**{INVALIDATION_CHANNEL: invalidate})
+    return pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+
+async def listen_for_invalidations(client, *caches):
+    """asyncio counterpart of start_invalidation_listener, run as a task"""
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(INVALIDATION_CHANNEL)
+    async for message in pubsub.listen():
+        for cache in caches:
+            cache.invalidate_patient(message['data'])
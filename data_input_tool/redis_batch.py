@@ -0,0 +1,54 @@
+"""
+Batched hash retrieval for endpoints that read many assessments at once
+
+Instead of one HGETALL round trip per key, the commands are sent in pipelines
+of ``REDIS_PIPELINE_CHUNK_SIZE`` keys. A chunk size of 0 sends everything in a
+single pipeline. Archive stubs are replaced by the archived hashes (see archive).
+"""
+
+import os
+
+from redis.asyncio.cluster import RedisCluster as AsyncRedisCluster
+from redis.cluster import RedisCluster
+
+from archive import rehydrate
+
+PIPELINE_CHUNK_SIZE = int(os.getenv('REDIS_PIPELINE_CHUNK_SIZE', 200))
+
+
+def is_cluster(client):
+    """Whether the client talks to Redis Cluster, where MULTI is limited to one hash slot"""
+    return isinstance(client, (RedisCluster, AsyncRedisCluster))
+
+
+def chunked(items, chunk_size):
+    """Split a list into consecutive chunks, 0 meaning no split at all"""
+    if chunk_size <= 0:
+        chunk_size = len(items) or 1
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+def fetch_hashes(client, keys, chunk_size=None):
+    """
+    Fetch the hashes stored under the given keys.
+
+    Args:
+        client: The Redis client to read from.
+        keys (list): The keys to fetch, the order is preserved.
+        chunk_size (int): Keys per pipeline, defaults to PIPELINE_CHUNK_SIZE.
+
+    Returns:
+        list: One dictionary per key, empty for keys that do not exist,
+              archived assessments rehydrated.
+    """
+    if chunk_size is None:
+        chunk_size = PIPELINE_CHUNK_SIZE
+
+    hashes = []
+    for chunk in chunked(list(keys), chunk_size):
+        pipe = client.pipeline(transaction=False)
+        for key in chunk:
+            pipe.hgetall(key)
+        hashes.extend(rehydrate(client, chunk, pipe.execute()))
+    return hashes
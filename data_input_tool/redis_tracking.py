@@ -0,0 +1,43 @@
+"""
+Per-request accounting of Redis round trips
+
+With METRICS_ENABLED=1 or in debug mode, the Redis client of the API is
+created with ``TrackedConnection`` as its connection class; otherwise it uses
+plain connections and nothing is counted. Every packet sent to Redis counts as one round trip, a
+pipeline therefore counts once no matter how many commands it carries. The
+counts are kept on ``flask.g`` so they describe the current request only.
+"""
+
+from flask import g, has_request_context
+import redis
+
+
+def _record(round_trips=0, commands=0):
+    if not has_request_context():
+        return
+    g.redis_round_trips = g.get('redis_round_trips', 0) + round_trips
+    g.redis_commands = g.get('redis_commands', 0) + commands
+
+
+def request_counts():
+    """Return (round_trips, commands) issued so far in the current request"""
+    if not has_request_context():
+        return 0, 0
+    return g.get('redis_round_trips', 0), g.get('redis_commands', 0)
+
+
+class TrackedConnection(redis.Connection):
+    """Connection that reports every command and round trip it sends"""
+
+    def send_packed_command(self, command, check_health=True):
+        _record(round_trips=1)
+        return super().send_packed_command(command, check_health)
+
+    def send_command(self, *args, **kwargs):
+        _record(commands=1)
+        return super().send_command(*args, **kwargs)
+
+    def pack_commands(self, commands):
+        commands = list(commands)
+        _record(commands=len(commands))
+        return super().pack_commands(commands)
@@ -0,0 +1,272 @@
+"""
+Tiered retention: archiving assessments out of Redis memory
+
+    flask --app app archive [--max-age-days 365] [--target disk|redis] [--dry-run]
+
+A run walks all patients in chunks and archives
+
+- every assessment of a discharged patient (patient hash field
+  DISCHARGED_FIELD set to the discharge date with
+  ``PUT /api/<patient_id>/discharge``, removed again on readmission with
+  ``DELETE``),
+- with RETENTION_MAX_AGE_DAYS (or --max-age-days) also the assessments of
+  other patients older than that, except the latest one of every assessment
+  type, which the latest endpoints read on every request.
+
+The stored hashes of a patient go into one compressed archive member (see
+archive) on disk in ARCHIVE_DIR or, with RETENTION_TARGET=redis, into one
+string in Redis. Only after the member is written, STUB_SCRIPT replaces the
+hashes by stubs pointing to it, atomically per patient. The GET endpoints and
+the export rehydrate stubs transparently, so archiving changes where data
+lives, not what the API returns. An interrupted run is simply started again,
+stubs are never archived twice.
+
+Memory is measured with MEMORY USAGE before and after the stubs replaced the
+hashes; Redis servers without the command (fakeredis) get an estimate from
+the field sizes, marked in the report.
+"""
+
+import hashlib
+import os
+import time
+from datetime import date, datetime
+
+from redis.exceptions import ResponseError
+
+from archive import (
+    ARCHIVE_PREFIX,
+    ARCHIVED_FIELD,
+    append_member,
+    encode_member,
+    is_archived,
+    member_blob,
+)
+from assessment_index import parse_assessment_key, patient_tag
+from assessment_store import run_script
+from export import EXPORT_CHUNK_SIZE, latest_keys, patient_chunks, window_keys
+
+RETENTION_MAX_AGE_DAYS = float(os.getenv('RETENTION_MAX_AGE_DAYS', 0))
+RETENTION_TARGET = os.getenv('RETENTION_TARGET', 'disk')
+TARGETS = ('disk', 'redis')
+DISCHARGED_FIELD = 'discharged'
+
+# KEYS: key of the member blob, then the assessment keys to replace
+# ARGV: stub reference, member blob ('' when the member is on disk)
+# '_archived' is archive.ARCHIVED_FIELD
+# Returns the number of hashes replaced; an existing member is never
+# overwritten, the stubs of other runs point to it
+STUB_SCRIPT = """
+if ARGV[2] ~= '' and not redis.call('SET', KEYS[1], ARGV[2], 'NX') then
+    return redis.error_reply('archive member ' .. KEYS[1] .. ' already exists')
+end
+local stubbed = 0
+for i = 2, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 and redis.call('HEXISTS', KEYS[i], '_archived') == 0 then
+        redis.call('DEL', KEYS[i])
+        redis.call('HSET', KEYS[i], '_archived', ARGV[1])
+        stubbed = stubbed + 1
+    end
+end
+return stubbed
+"""
+
+
+def parse_discharge(payload):
+    """
+    Read the discharge date of a discharge request, today if none is given.
+
+    Accepts no payload or {"date": "YYYY-MM-DD"}.
+
+    Raises:
+        ValueError: If the date is malformed.
+    """
+    discharge_date = (payload or {}).get('date')
+    if discharge_date is None:
+        return date.today().isoformat()
+    try:
+        return datetime.strptime(str(discharge_date), '%Y-%m-%d').date().isoformat()
+    except ValueError:
+        raise ValueError('date must be given as YYYY-MM-DD')
+
+
+def member_key(patient_id, run_timestamp, keys):
+    """
+    Key of a member kept in Redis, in the hash slot of the patient's keys.
+
+    The digest of the archived keys tells apart the members of runs within
+    the same second, a key is only ever archived once.
+    """
+    digest = hashlib.sha1('\n'.join(keys).encode('utf-8')).hexdigest()[:12]
+    return f'{ARCHIVE_PREFIX}:{patient_tag(patient_id)}:{run_timestamp}:{digest}'
+
+
+def archive_cutoff(max_age_days, now=None):
+    """Unix timestamp before which assessments are archived, None to archive by discharge only"""
+    if not max_age_days:
+        return None
+    return int((now if now is not None else time.time()) - max_age_days * 86400)
+
+
+def select_keys(keys, discharged, cutoff):
+    """
+    The keys of one patient to archive.
+
+    Args:
+        keys (list): All assessment keys of the patient, ascending.
+        discharged (bool): Archive everything.
+        cutoff (int): Archive keys older than this, None for none.
+    """
+    if discharged:
+        return list(keys)
+    if cutoff is None:
+        return []
+    keep = set(latest_keys(keys))
+    return [
+        key for key in keys
+        if key not in keep and parse_assessment_key(key)[2] < cutoff
+    ]
+
+
+def estimated_size(key, fields):
+    """Bytes of a hash without MEMORY USAGE: key, field names and values"""
+    return len(key) + sum(len(field) + len(str(value)) for field, value in fields.items())
+
+
+def memory_usage(client, keys, hashes=None):
+    """
+    Memory of the keys in bytes.
+
+    Returns:
+        tuple: (bytes, measured) where measured is False for an estimate.
+    """
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key, samples=0)
+    try:
+        return sum(usage or 0 for usage in pipe.execute()), True
+    except ResponseError:
+        if hashes is None:
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            hashes = pipe.execute()
+        return sum(estimated_size(key, fields) for key, fields in zip(keys, hashes)), False
+
+
+def new_report(target, cutoff):
+    return {
+        'target': target,
+        'cutoff': cutoff,
+        'patients': 0,
+        'assessments': 0,
+        'archive_bytes': 0,
+        'memory_before': 0,
+        'memory_after': 0,
+        'measured': True,
+    }
+
+
+def finish_report(report, started):
+    report['reclaimed_bytes'] = report['memory_before'] - report['memory_after']
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def archive_patient(client, patient_id, keys, target=RETENTION_TARGET, run_timestamp=None,
+                    report=None):
+    """
+    Archive the given assessments of one patient and replace them by stubs.
+
+    Returns:
+        dict: The report, updated with the patient's numbers.
+
+    Raises:
+        redis.ResponseError: If the member key is taken already; nothing is stubbed then.
+    """
+    report = report if report is not None else new_report(target, None)
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    records = [
+        (key, fields) for key, fields in zip(keys, pipe.execute())
+        if fields and not is_archived(fields)
+    ]
+    if not records:
+        return report
+
+    archived_keys = [key for key, _ in records]
+    before, measured = memory_usage(client, archived_keys, [fields for _, fields in records])
+    member = encode_member(records)
+    blob_key = member_key(patient_id, run_timestamp or int(time.time()), archived_keys)
+    if target == 'redis':
+        ref, blob = f'redis:{blob_key}', member_blob(member)
+    else:
+        ref, blob = append_member(patient_id, member), ''
+    stubbed = run_script(client, STUB_SCRIPT, keys=[blob_key, *archived_keys], args=[ref, blob])
+
+    after_keys = archived_keys + ([blob_key] if target == 'redis' else [])
+    after, _ = memory_usage(client, after_keys, [
+        {ARCHIVED_FIELD: ref} for _ in archived_keys
+    ] + ([{'': blob}] if target == 'redis' else []))
+    report['patients'] += 1
+    report['assessments'] += stubbed
+    report['archive_bytes'] += len(member)
+    report['memory_before'] += before
+    report['memory_after'] += after
+    report['measured'] = report['measured'] and measured
+    return report
+
+
+def archive_assessments(client, max_age_days=RETENTION_MAX_AGE_DAYS, target=RETENTION_TARGET,
+                        patient_ids=None, dry_run=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Run the retention over all patients, or the given ones.
+
+    Args:
+        client: The Redis client.
+        max_age_days (float): Also archive assessments older than this, 0 for
+                              discharged patients only.
+        target (str): 'disk' or 'redis', see TARGETS.
+        patient_ids (list): Archive all assessments of these patients, as if discharged.
+        dry_run (bool): Only count what would be archived.
+        chunk_size (int): Patients per pipeline.
+
+    Returns:
+        dict: patients, assessments, archive_bytes, memory before and after,
+              reclaimed_bytes, whether memory was measured or estimated, seconds.
+
+    Raises:
+        ValueError: If the target is unknown.
+    """
+    if target not in TARGETS:
+        raise ValueError(f'target must be one of {TARGETS}')
+    started = time.perf_counter()
+    run_timestamp = int(time.time())
+    cutoff = archive_cutoff(max_age_days, run_timestamp)
+    report = new_report(target, cutoff)
+    forced = set(patient_ids or ())
+    chunks = [list(forced)] if forced else patient_chunks(client, chunk_size)
+
+    for chunk in chunks:
+        pipe = client.pipeline(transaction=False)
+        for patient_id in chunk:
+            pipe.hget(patient_id, DISCHARGED_FIELD)
+        discharged = dict(zip(chunk, pipe.execute()))
+        by_patient = {}
+        for key in window_keys(client, chunk, None, '+inf'):
+            by_patient.setdefault(parse_assessment_key(key)[0], []).append(key)
+
+        for patient_id, keys in by_patient.items():
+            selected = select_keys(keys, patient_id in forced or bool(discharged.get(patient_id)), cutoff)
+            if not selected:
+                continue
+            if dry_run:
+                pipe = client.pipeline(transaction=False)
+                for key in selected:
+                    pipe.hexists(key, ARCHIVED_FIELD)
+                pending = sum(1 for archived in pipe.execute() if not archived)
+                report['patients'] += 1 if pending else 0
+                report['assessments'] += pending
+                continue
+            archive_patient(client, patient_id, selected, target, run_timestamp, report)
+    return finish_report(report, started)
@@ -0,0 +1,256 @@
+"""
+Risk scoring of patients with a classifier loaded once per process
+
+RISK_MODEL_PATH points to a bundle written by save_risk_model:
+
+    {'model': estimator, 'features': [...], 'categorical': [...], 'positive_class': ...}
+
+dumped with joblib without compression, so load_risk_model can memory-map the
+numpy arrays of the model (e.g. the support vectors of an SVC): they are read
+from the page cache on demand and shared by all workers instead of copied into
+each of them. The mapping is copy-on-write because libsvm refuses read-only
+buffers; prediction never writes to them, so the pages stay shared.
+
+Features are named like the columns of the wide export ("<assessment_name>.<field>",
+nested fields dotted, see export.flatten), so a model trained on the output of
+``flask --app app export cohort.csv --layout wide`` scores a patient from the
+latest assessments the API already stores. The model gets a pandas DataFrame
+with these columns (an sklearn Pipeline as in surge_ahead/svm_plyground works
+as is) and must implement predict_proba, e.g. SVC(probability=True). Categorical
+features are passed as strings, all others as floats; missing or non-numeric
+values are NaN and left to the imputation of the model.
+
+Scores are cached per patient until an assessment of that patient is saved
+(see ReadCache.invalidate_patient); scoring many patients fetches their latest
+assessments in one pipeline and calls predict_proba once for all of them.
+"""
+
+import math
+import os
+import threading
+from collections import deque
+
+from assessment_format import decode_assessment
+from export import flatten
+
+RISK_MODEL_PATH = os.getenv('RISK_MODEL_PATH')
+# Cached scores are dropped on every save, the TTL only bounds how long other
+# workers can serve a stale score without READ_CACHE_PUBSUB
+RISK_CACHE_MAXSIZE = int(os.getenv('RISK_CACHE_MAXSIZE', 10000))
+RISK_CACHE_TTL = float(os.getenv('RISK_CACHE_TTL', 3600))
+MAX_RISK_BATCH = int(os.getenv('RISK_MAX_BATCH', 1000))
+
+
+class RiskModel:
+    """A loaded model together with the features it expects"""
+
+    def __init__(self, model, features, categorical=(), positive_class=1, path=None):
+        self.model = model
+        self.features = list(features)
+        self.categorical = set(categorical)
+        self.path = path
+        classes = list(getattr(model, 'classes_', [0, 1]))
+        if positive_class not in classes:
+            raise ValueError(f'positive_class {positive_class!r} is not one of {classes}')
+        self.positive_index = classes.index(positive_class)
+        # Each feature is "<assessment_name>.<field>"
+        self.assessment_names = list(dict.fromkeys(
+            feature.split('.', 1)[0] for feature in self.features
+        ))
+
+    def feature_row(self, latest):
+        """
+        Build the feature values of one patient.
+
+        Args:
+            latest (dict): assessment_name -> (key, data) of the latest assessments.
+
+        Returns:
+            list: One value per feature, NaN where the field is missing.
+        """
+        fields = {}
+        for name, (_key, data) in latest.items():
+            if data:
+                for field, value in flatten(decode_assessment(data)).items():
+                    fields[f'{name}.{field}'] = value
+        return [
+            _feature_value(fields.get(feature), feature in self.categorical)
+            for feature in self.features
+        ]
+
+    def predict(self, rows):
+        """Risk of many feature rows with a single predict_proba call"""
+        import pandas as pd
+
+        frame = pd.DataFrame(rows, columns=self.features)
+        if self.categorical:
+            # Keep a column of missing values from turning into floats
+            columns = [feature for feature in self.features if feature in self.categorical]
+            frame[columns] = frame[columns].astype(object)
+        return self.model.predict_proba(frame)[:, self.positive_index].tolist()
+
+    def score_matrix(self, matrix):
+        """
+        Score the patients of a latest assessment matrix.
+
+        Returns:
+            dict: patient_id -> {'risk', 'missing_features'}, None for unknown patients.
+        """
+        scores = {patient_id: None for patient_id in matrix}
+        known = [patient_id for patient_id, row in matrix.items() if row is not None]
+        if not known:
+            return scores
+        rows = [self.feature_row(matrix[patient_id]) for patient_id in known]
+        for patient_id, row, risk in zip(known, rows, self.predict(rows)):
+            scores[patient_id] = {
+                'risk': round(risk, 4),
+                'missing_features': sum(1 for value in row if _is_missing(value)),
+            }
+        return scores
+
+    def info(self):
+        return {
+            'path': self.path,
+            'model': type(self.model).__name__,
+            'features': len(self.features),
+            'categorical': sorted(self.categorical),
+            'assessments': self.assessment_names,
+        }
+
+
+def _feature_value(value, categorical=False):
+    """Categorical values as strings, all others as floats, missing ones as NaN"""
+    if value is None or value == '':
+        return math.nan
+    if categorical:
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+def _is_missing(value):
+    return isinstance(value, float) and math.isnan(value)
+
+
+def load_risk_model(path=RISK_MODEL_PATH):
+    """
+    Load the model bundle at `path`, memory-mapping its arrays.
+
+    Returns:
+        RiskModel: The loaded model, None if no path is configured.
+
+    Raises:
+        RuntimeError: If joblib or pandas is not installed.
+        ValueError: If the file is not a model bundle.
+    """
+    if not path:
+        return None
+    try:
+        import joblib
+        import pandas  # noqa: F401 -- needed by RiskModel.predict
+    except ImportError:
+        raise RuntimeError('Risk scoring requires joblib and pandas: pip install -r requirements-risk.txt')
+
+    bundle = joblib.load(path, mmap_mode='c')
+    if not isinstance(bundle, dict) or 'model' not in bundle or 'features' not in bundle:
+        raise ValueError(f'{path} is not a risk model bundle, see risk_model.save_risk_model')
+    return RiskModel(
+        bundle['model'], bundle['features'], bundle.get('categorical', ()),
+        bundle.get('positive_class', 1), path,
+    )
+
+
+def save_risk_model(path, model, features, categorical=(), positive_class=1):
+    """Write a bundle for RISK_MODEL_PATH, uncompressed so it can be memory-mapped"""
+    import joblib
+
+    joblib.dump({
+        'model': model,
+        'features': list(features),
+        'categorical': list(categorical),
+        'positive_class': positive_class,
+    }, path)
+
+
+def parse_risk_request(method, payload, args):
+    """
+    Read the patients of a batch scoring request.
+
+    Accepts {"patients": [...]} (POST) or ?patients=a,b,c (GET).
+
+    Raises:
+        ValueError: If the list is missing, too large or has invalid IDs.
+    """
+    if method == 'POST':
+        patient_ids = (payload or {}).get('patients') if isinstance(payload, dict) else None
+    else:
+        patient_ids = [p for p in args.get('patients', '').split(',') if p]
+    if not isinstance(patient_ids, list) or not patient_ids:
+        raise ValueError('patients must be a non-empty list of patient IDs')
+    if len(patient_ids) > MAX_RISK_BATCH:
+        raise ValueError(f'At most {MAX_RISK_BATCH} patients can be scored at once')
+    if not all(isinstance(p, str) and p.isalnum() for p in patient_ids):
+        raise ValueError('patient IDs must be alphanumeric')
+    return list(dict.fromkeys(patient_ids))
+
+
+def cached_scores(cache, patient_ids):
+    """
+    Look up cached scores before scoring the rest.
+
+    Returns:
+        tuple: (scores found, patients to score, cache generations of those)
+    """
+    scores = {}
+    missing = []
+    for patient_id in patient_ids:
+        hit, score = cache.get(patient_id, 'risk')
+        if hit:
+            scores[patient_id] = score
+        else:
+            missing.append(patient_id)
+    generations = {patient_id: cache.generation(patient_id) for patient_id in missing}
+    return scores, missing, generations
+
+
+def cache_scores(cache, scores, generations):
+    for patient_id, score in scores.items():
+        cache.set(patient_id, 'risk', score, generation=generations[patient_id])
+
+
+class LatencyWindow:
+    """The most recent scoring latencies, for p50/p99 per kind of request"""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._samples = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind, seconds):
+        with self._lock:
+            self._samples.setdefault(kind, deque(maxlen=self.size)).append(seconds)
+            self._counts[kind] = self._counts.get(kind, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = {kind: sorted(samples) for kind, samples in self._samples.items()}
+            counts = dict(self._counts)
+        return {
+            kind: {
+                'count': counts[kind],
+                'window': len(samples),
+                'p50_ms': round(_percentile(samples, 50) * 1000, 3),
+                'p99_ms': round(_percentile(samples, 99) * 1000, 3),
+                'max_ms': round(samples[-1] * 1000, 3),
+            }
+            for kind, samples in snapshot.items()
+        }
+
+
+def _percentile(sorted_samples, percent):
+    """Nearest-rank percentile of sorted samples"""
+    rank = max(1, math.ceil(percent / 100 * len(sorted_samples)))
+    return sorted_samples[rank - 1]
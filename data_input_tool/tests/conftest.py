@@ -0,0 +1,58 @@
+"""
+Fixtures of the API tests, run against an in-memory fakeredis server:
+
+    pip install -r requirements-test.txt
+    python -m pytest
+"""
+
+import os
+
+# Every test starts from an empty Redis, cached reads would leak between them
+os.environ['READ_CACHE_TTL'] = '0'
+
+import fakeredis
+import pytest
+
+import app as flask_app
+import assessment_index
+import assessment_store
+import async_store
+import export
+from api_common import human_timestamp
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeStrictRedis(decode_responses=True)
+
+
+@pytest.fixture
+def api(redis_client, monkeypatch):
+    """Test client of the Flask app, writing to redis_client"""
+    monkeypatch.setattr(flask_app, 'redis_client', redis_client)
+    return flask_app.app.test_client()
+
+
+@pytest.fixture
+def legacy_fallback(monkeypatch):
+    """Switch LEGACY_KEY_FALLBACK in every module that reads it"""
+    def switch(enabled):
+        for module in (assessment_index, assessment_store, async_store, export):
+            monkeypatch.setattr(module, 'LEGACY_KEY_FALLBACK', enabled)
+    switch(True)
+    return switch
+
+
+@pytest.fixture
+def save_v1(redis_client, monkeypatch):
+    """Save an assessment in the version 1 layout, as before key schema 2"""
+    def save(patient_id, assessment_name, data, unix_timestamp):
+        with monkeypatch.context() as m:
+            m.setattr(assessment_index, 'KEY_SCHEMA_VERSION', 1)
+            m.setattr(assessment_store, 'LEGACY_KEY_FALLBACK', False)
+            redis_client.hsetnx(patient_id, 'created', 'true')
+            return assessment_store.save_assessment_record(
+                redis_client, patient_id, assessment_name, data,
+                unix_timestamp, human_timestamp(unix_timestamp)
+            )
+    return save
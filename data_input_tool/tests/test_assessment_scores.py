@@ -0,0 +1,60 @@
+import write_behind
+from assessment_format import encode_for_storage
+from assessment_scores import rebuild_scores, score_aggregates, ward_marker_key
+
+BARTHEL = {
+    'essen': 10, 'waschen': 5, 'toilette': 10, 'baden': 5, 'kleiden': 10, 'aufstehen': 15,
+    'aufstehengehen': 15, 'treppensteigen': 10, 'stuhlkontrollen': 10, 'harnkontrollen': 10,
+}
+
+
+def ward_counts(redis_client):
+    """Scored patients per ward, a ward a patient moved out of stays with a count of 0"""
+    return {
+        ward: names['Barthel Index']['count']
+        for ward, names in score_aggregates(redis_client).items()
+        if names and names['Barthel Index']['count']
+    }
+
+
+def test_ward_is_remembered_outside_the_patient_hash(api, redis_client):
+    api.post('/api', json={'identifier': 'p1'})
+    redis_client.hset('p1', 'station', 'W1')
+    assert api.post('/api/p1/Barthel Index', json=BARTHEL).status_code == 200
+
+    assert redis_client.get(ward_marker_key('p1')) == 'W1'
+    assert api.get('/api/p1').get_json() == {'created': 'true', 'station': 'W1'}
+
+
+def test_scores_move_with_the_patient(api, redis_client):
+    api.post('/api', json={'identifier': 'p1'})
+    redis_client.hset('p1', 'station', 'W1')
+    api.post('/api/p1/Barthel Index', json=BARTHEL)
+    redis_client.hset('p1', 'station', 'W2')
+    api.post('/api/p1/Barthel Index', json={**BARTHEL, 'essen': 5})
+
+    assert ward_counts(redis_client) == {'W2': 1}
+    assert redis_client.get(ward_marker_key('p1')) == 'W2'
+
+    rebuild_scores(redis_client)
+    assert ward_counts(redis_client) == {'W2': 1}
+    assert redis_client.get(ward_marker_key('p1')) == 'W2'
+    assert 'score_ward' not in redis_client.hgetall('p1')
+
+
+def test_write_behind_moves_scores(redis_client):
+    redis_client.hset('p1', mapping={'created': 'true', 'station': 'W1'})
+    redis_client.set(ward_marker_key('p1'), 'W0')
+    score = {'scorer': 'barthel', 'version': 1, 'total': 100, 'subscores': {}}
+    entries = [
+        (f'1-{i}', write_behind.write_entry(
+            'p1', 'Barthel Index', encode_for_storage(BARTHEL, score=score),
+            1700000000 + i, 'now', score
+        ))
+        for i in range(2)
+    ]
+
+    report = write_behind.apply_batch(redis_client, entries)
+    assert (report['applied'], report['failed']) == (2, 0)
+    assert ward_counts(redis_client) == {'W1': 1}
+    assert redis_client.get(ward_marker_key('p1')) == 'W1'
@@ -0,0 +1,96 @@
+from api_common import human_timestamp
+from key_migration import legacy_key_count, migrate_keys, migrate_medications
+
+
+def history(api, patient_id):
+    response = api.get(f'/api/{patient_id}/assessments')
+    return response.status_code, response.get_json()
+
+
+def test_v1_patient_is_readable_before_and_after_migration(api, redis_client, save_v1):
+    keys = [
+        save_v1('p1', 'OKIE', {'a': '1'}, 1700000000),
+        save_v1('p1', 'OKIE', {'a': '2'}, 1700000100),
+        save_v1('p1', 'Barthel', {'b': '3'}, 1700000050),
+    ]
+    assert keys[0] == f'p1:OKIE:1700000000:{human_timestamp(1700000000)}'
+
+    status, before = history(api, 'p1')
+    assert status == 200
+    assert sorted(before) == sorted(keys)
+    assert api.get('/api/p1/OKIE/latest').get_json()['data'] == {'a': 2}
+
+    report = migrate_keys(redis_client)
+    assert (report['patients'], report['assessments']) == (1, 3)
+    assert legacy_key_count(redis_client) == 0
+    assert not redis_client.exists('idx:p1', *keys)
+
+    status, after = history(api, 'p1')
+    assert status == 200
+    assert after == {key.replace('p1', '{p1}', 1): data for key, data in before.items()}
+    latest = api.get('/api/p1/OKIE/latest').get_json()
+    assert latest['key'] == keys[1].replace('p1', '{p1}', 1)
+    assert latest['data'] == {'a': 2}
+
+
+def test_migration_is_idempotent(redis_client, save_v1):
+    save_v1('p1', 'OKIE', {'a': '1'}, 1700000000)
+    save_v1('p2', 'OKIE', {'a': '2'}, 1700000000)
+    redis_client.hset('medication:p1:preop:1', mapping={'patient': 'p1', 'name': 'ASS'})
+
+    first = migrate_keys(redis_client)
+    assert (first['patients'], first['assessments'], first['medications']) == (2, 2, 1)
+    migrated = {key: redis_client.type(key) for key in redis_client.keys()}
+
+    second = migrate_keys(redis_client)
+    assert (second['patients'], second['assessments'], second['medications']) == (0, 0, 0)
+    assert {key: redis_client.type(key) for key in redis_client.keys()} == migrated
+
+
+def test_saves_during_migration_are_not_lost(api, redis_client, save_v1):
+    for patient_id in ('p1', 'p2'):
+        save_v1(patient_id, 'OKIE', {'a': '1'}, 1700000000)
+
+    def save_both(report, migrated_patient):
+        if report['patients'] == 1:
+            for patient_id in ('p1', 'p2'):
+                assert api.post(f'/api/{patient_id}/OKIE', json={'a': 'new'}).status_code == 200
+
+    migrate_keys(redis_client, on_patient=save_both)
+
+    assert legacy_key_count(redis_client) == 0
+    for patient_id in ('p1', 'p2'):
+        status, assessments = history(api, patient_id)
+        assert status == 200
+        assert sorted(data['a'] for data in assessments.values()) == ['1', 'new']
+        assert all(key.startswith(f'{{{patient_id}}}:') for key in assessments)
+        assert api.get(f'/api/{patient_id}/OKIE/latest').get_json()['data'] == {'a': 'new'}
+
+
+def test_legacy_fallback_reads_v1_keys_only_when_enabled(api, save_v1, legacy_fallback):
+    save_v1('p1', 'OKIE', {'a': '1'}, 1700000000)
+
+    assert history(api, 'p1')[0] == 200
+    assert api.get('/api/p1/OKIE/latest').status_code == 200
+
+    legacy_fallback(False)
+    assert history(api, 'p1') == (404, {'message': 'No assessments found'})
+    assert api.get('/api/p1/OKIE/latest').get_json() == {'message': 'No OKIE assessments found'}
+
+
+def test_saves_without_fallback_use_the_new_layout(api, redis_client, save_v1, legacy_fallback):
+    save_v1('p1', 'OKIE', {'a': '1'}, 1700000000)
+    legacy_fallback(False)
+
+    key = api.post('/api/p1/OKIE', json={'a': '2'}).get_json()['key']
+    assert key.startswith('{p1}:OKIE:')
+    assert redis_client.zcard('idx:p1') == 1
+
+
+def test_migrate_medications_renames_v1_keys_only(redis_client):
+    redis_client.hset('medication:p1:preop:1', mapping={'name': 'ASS'})
+    redis_client.hset('medication:{p2}:preop:1', mapping={'name': 'Ramipril'})
+
+    assert migrate_medications(redis_client) == 1
+    assert sorted(redis_client.keys('medication:*')) == ['medication:{p1}:preop:1', 'medication:{p2}:preop:1']
+    assert migrate_medications(redis_client) == 0
@@ -0,0 +1,95 @@
+import pytest
+from redis.exceptions import ResponseError
+
+import archive
+from api_common import human_timestamp
+from archive import ARCHIVED_FIELD, apply_members, archived_positions
+from assessment_format import encode_for_storage
+from assessment_store import save_assessment_record
+from retention import archive_assessments, archive_patient, member_key
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, 'ARCHIVE_DIR', tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def patient(api, redis_client):
+    """A patient with three assessments, returning their keys"""
+    api.post('/api', json={'identifier': 'p1'})
+    return [
+        save_assessment_record(
+            redis_client, 'p1', name, encode_for_storage(data),
+            unix_timestamp, human_timestamp(unix_timestamp)
+        )
+        for name, data, unix_timestamp in (
+            ('OKIE', {'a': 1}, 1700000000),
+            ('OKIE', {'a': 2}, 1700000100),
+            ('Barthel Index', {'essen': 10}, 1700000050),
+        )
+    ]
+
+
+def reads(api):
+    """Everything the API returns about the assessments of p1"""
+    return [
+        api.get(path).get_json()
+        for path in ('/api/p1/assessments', '/api/p1/all', '/api/p1/OKIE/latest',
+                     '/api/p1/barthel/latest', '/api/ward-snapshot?patients=p1&assessments=OKIE')
+    ]
+
+
+@pytest.mark.parametrize('target', ['disk', 'redis'])
+def test_archive_round_trips_through_the_api(api, redis_client, patient, target):
+    before = reads(api)
+    assert api.put('/api/p1/discharge', json={'date': '2024-01-31'}).status_code == 200
+
+    report = archive_assessments(redis_client, target=target)
+    assert (report['patients'], report['assessments']) == (1, 3)
+    for key in patient:
+        assert list(redis_client.hgetall(key)) == [ARCHIVED_FIELD]
+
+    assert reads(api) == before
+
+
+@pytest.mark.parametrize('target', ['disk', 'redis'])
+def test_second_run_is_a_no_op(api, redis_client, patient, archive_dir, target):
+    api.put('/api/p1/discharge')
+    archive_assessments(redis_client, target=target)
+    stored = {key: redis_client.dump(key) for key in redis_client.keys()}
+    files = {path.name: path.read_bytes() for path in archive_dir.iterdir()}
+
+    report = archive_assessments(redis_client, target=target)
+    assert (report['patients'], report['assessments']) == (0, 0)
+    assert {key: redis_client.dump(key) for key in redis_client.keys()} == stored
+    assert {path.name: path.read_bytes() for path in archive_dir.iterdir()} == files
+
+
+def test_runs_in_the_same_second_keep_both_members(api, redis_client, patient):
+    archive_patient(redis_client, 'p1', patient[:1], 'redis', run_timestamp=1800000000)
+    archive_patient(redis_client, 'p1', patient[1:], 'redis', run_timestamp=1800000000)
+
+    assert len(redis_client.keys('archive:*')) == 2
+    assert api.get('/api/p1/OKIE/latest').get_json()['data'] == {'a': 2}
+    assert sorted(api.get('/api/p1/assessments').get_json()) == sorted(patient)
+
+
+def test_existing_member_is_not_overwritten(redis_client, patient):
+    blob_key = member_key('p1', 1800000000, patient)
+    redis_client.set(blob_key, 'other run')
+
+    with pytest.raises(ResponseError, match='already exists'):
+        archive_patient(redis_client, 'p1', patient, 'redis', run_timestamp=1800000000)
+    assert redis_client.get(blob_key) == 'other run'
+    assert not any(ARCHIVED_FIELD in redis_client.hgetall(key) for key in patient)
+
+
+def test_missing_record_in_member_is_an_error():
+    keys = ['{p1}:OKIE:1700000000:x', '{p1}:OKIE:1700000100:y']
+    hashes = [{ARCHIVED_FIELD: 'redis:m'}, {ARCHIVED_FIELD: 'redis:m'}]
+    members = {'redis:m': {'p1:OKIE:1700000000:x': {'a': '1'}}}
+
+    with pytest.raises(LookupError):
+        apply_members(keys, hashes, archived_positions(hashes), members)
@@ -1,92 +1,270 @@
-import redis
-import json
+"""
+Synthetic ward generator for the OKIE dashboard
+
+Generates N patients with M days of lab values and a medication plan, e.g.
+
+    python populate_redis.py --patients 20000 --days 14 --seed 1 \
+        --lab-rate hemoglobin=2 --lab-rate creatinin=1 --lab-rate egfr=1
+
+Patients are written in batches of --batch-size: one pipeline per batch holds
+the patient hashes, the creation of the lab time series and the medication
+hashes, followed by TS.MADD calls of at most --points-per-call samples each.
+The same --seed always produces the same ward (apart from the timestamps,
+which end at the time of the run).
+
+Keys written per patient:
+    <patient_id>                      patient hash
+    patient:<patient_id>:<lab>        time series, labelled patient=<id> lab=<lab>
+    patient:<patient_id>:<lab>:<aggregation>:<bucket>
+                                      compactions of the series, see COMPACTIONS
+    medication:{<patient_id>}:<slot>:<position>
+                                      medication hash, indexed by medis_index; the
+                                      patient ID is a hash tag as in key schema 2
+                                      of data_input_tool (see medications.py)
+"""
+
+import argparse
+import random
 import time
-from datetime import datetime, timedelta
 
-# Connect to Redis
-r = redis.Redis(
-    host='localhost',
-    port=6379,
-    decode_responses=True
+import redis
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Baseline mean, spread between patients and day-to-day noise per lab value
+LABS = {
+    "hemoglobin": (12.0, 1.5, 0.6),
+    "creatinin": (90.0, 20.0, 8.0),
+    "egfr": (65.0, 15.0, 4.0),
+}
+
+# Compaction rules created with every lab series, the same as in
+# data_input_tool/lab_series.py: (aggregation, bucket label, bucket size in ms)
+COMPACTIONS = (
+    ("avg", "1h", DAY_MS // 24),
+    ("avg", "1d", DAY_MS),
+    ("min", "1d", DAY_MS),
+    ("max", "1d", DAY_MS),
+    ("last", "1d", DAY_MS),
 )
 
-def populate_patient_data():
-    patient_id = "UsabilityWorkshop"
-    
-    # Basic patient information
-    patient_data = {
-        "dx": "Hip Fracture",
-        "tx": "ORIF",
-        "adm_age": "85",
-        "weight_preop": "52",
-        "size_preop": "165", 
-        "bmi_preop": "19.1",
-        "birthday": "1939",
-        "isolation": "0",
-        "ops_name": "Osteosynthesis",
-        "load": "Routine surgery"
+MEDICATIONS = [
+    "Lorazepam 1mg 0-0-1",
+    "Johanniskraut Kps 100mg",
+    "ASS 100mg",
+    "Digitoxin 0,25mg 1-0-0",
+    "Ramipril 5mg 1-0-0",
+    "Metamizol 500mg 1-1-1-1",
+    "Pantoprazol 40mg 1-0-0",
+    "Enoxaparin 40mg 0-0-1",
+    "Bisoprolol 2,5mg 1-0-0",
+    "Torasemid 10mg 1-0-0",
+    "Simvastatin 20mg 0-0-1",
+    "Metformin 500mg 1-0-1",
+    "Levothyroxin 50ug 1-0-0",
+    "Amlodipin 5mg 1-0-0",
+    "Mirtazapin 15mg 0-0-1",
+]
+MEDICATION_SLOTS = ["preop", "latest"]
+
+DIAGNOSES = [
+    ("Hip Fracture", "S72.00", "ORIF", "Osteosynthesis"),
+    ("Trochanteric Fracture", "S72.10", "Intramedullary nail", "Osteosynthesis"),
+    ("Femoral Neck Fracture", "S72.01", "Hemiarthroplasty", "Endoprosthesis"),
+    ("Vertebral Fracture", "S32.00", "Kyphoplasty", "Vertebral augmentation"),
+]
+STATIONS = ["UCH", "UCH2", "GER", "ORTHO"]
+
+
+def parse_lab_rate(value):
+    """Parse LAB=SAMPLES_PER_DAY"""
+    lab, _, rate = value.partition("=")
+    if lab not in LABS:
+        raise argparse.ArgumentTypeError(f"unknown lab {lab!r}, choose from {', '.join(LABS)}")
+    try:
+        rate = float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rate in {value!r}")
+    if rate <= 0:
+        raise argparse.ArgumentTypeError("rates must be positive")
+    return lab, rate
+
+
+def patient_hash(rng, now_year):
+    """Basic patient information as shown on the dashboard"""
+    dx, dx_code, tx, ops_name = rng.choice(DIAGNOSES)
+    age = rng.randint(70, 99)
+    size = rng.randint(150, 190)
+    weight = rng.randint(45, 95)
+    return {
+        "dx": dx,
+        "dx_code": dx_code,
+        "tx": tx,
+        "ops_name": ops_name,
+        "adm_age": str(age),
+        "birthday": str(now_year - age),
+        "weight_preop": str(weight),
+        "size_preop": str(size),
+        "bmi_preop": f"{weight / (size / 100) ** 2:.1f}",
+        "isolation": str(int(rng.random() < 0.1)),
+        "load": rng.choice(["Routine surgery", "Full weight bearing", "Partial weight bearing"]),
+        "station": rng.choice(STATIONS),
     }
-    
-    # Set patient hash data
-    r.hmset(patient_id, patient_data)
-    
-    # Add time series data for lab values
-    now = int(time.time() * 1000)
-    
-    # Hemoglobin values over time
-    hemoglobin_values = [12.5, 11.8, 10.9, 11.2, 11.8]
-    for i, value in enumerate(hemoglobin_values):
-        timestamp = now - (len(hemoglobin_values) - i - 1) * 24 * 60 * 60 * 1000
-        r.execute_command('TS.ADD', f'{patient_id}:hemoglobin', timestamp, value)
-    
-    # Creatinine values
-    creatinine_values = [85, 92, 110, 95, 88]
-    for i, value in enumerate(creatinine_values):
-        timestamp = now - (len(creatinine_values) - i - 1) * 24 * 60 * 60 * 1000
-        r.execute_command('TS.ADD', f'{patient_id}:creatinin', timestamp, value)
-    
-    # eGFR values
-    egfr_values = [69, 65, 58, 62, 67]
-    for i, value in enumerate(egfr_values):
-        timestamp = now - (len(egfr_values) - i - 1) * 24 * 60 * 60 * 1000
-        r.execute_command('TS.ADD', f'{patient_id}:egfr', timestamp, value)
-
-def populate_medication_data():
-    # Create search index for medications
+
+
+def lab_samples(rng, lab, rate, days, now_ms):
+    """Sample one lab value at `rate` samples per day over the last `days` days"""
+    mean, spread, noise = LABS[lab]
+    level = rng.gauss(mean, spread)
+    interval = DAY_MS / rate
+    count = max(1, int(days * rate))
+    start = now_ms - int((count - 1) * interval)
+    samples = []
+    for i in range(count):
+        # Jitter keeps samples of different patients from sharing timestamps
+        timestamp = start + int(i * interval) - rng.randrange(int(interval // 4) + 1)
+        level += rng.gauss(0, noise)
+        samples.append((timestamp, round(max(level, 0.1), 1)))
+    return samples
+
+
+def medication_plan(rng, medications, per_slot):
+    """Draw the medications of every slot from the medication list"""
+    plan = {}
+    for slot in MEDICATION_SLOTS:
+        plan[slot] = rng.sample(medications, min(per_slot, len(medications)))
+    return plan
+
+
+def create_medication_index(client):
+    # Create search index for medications, the schema of data_input_tool/medications.py.
+    # Patient and slot are TAG fields: query them as "@patient:{<id>} @slot:{preop}"
     try:
-        r.execute_command(
+        client.execute_command(
             'FT.CREATE', 'medis_index',
             'ON', 'HASH',
             'PREFIX', '1', 'medication:',
             'SCHEMA',
-            'patient', 'TEXT',
-            'slot', 'TEXT', 
-            'position', 'NUMERIC',
+            'patient', 'TAG',
+            'slot', 'TAG',
+            'position', 'NUMERIC', 'SORTABLE',
             'name', 'TEXT'
         )
-    except:
-        pass  # Index might already exist
-    
-    # Add medication data
-    medications = [
-        {"name": "Lorazepam 1mg 0-0-1", "position": 1},
-        {"name": "Johanniskraut Kps 100mg", "position": 2},
-        {"name": "ASS 100mg", "position": 3},
-        {"name": "Digitoxin 0,25mg 1-0-0", "position": 4},
-        {"name": "Ramipril 5mg 1-0-0", "position": 5}
-    ]
-    
-    for i, med in enumerate(medications):
-        med_key = f"medication:{i+1}"
-        r.hmset(med_key, {
-            "patient": "UsabilityWorkshop",
-            "slot": "latest",
-            "position": med["position"],
-            "name": med["name"]
-        })
+    except redis.ResponseError as e:
+        if 'index already exists' not in str(e).lower():
+            raise
+        # An index with the old TEXT schema is replaced by the API on first use,
+        # or with: flask --app app create-medication-index
+
+
+def queue_patient(pipe, patient_id, rng, args, now_ms, now_year):
+    """Queue the hashes of one patient and collect its lab samples"""
+    pipe.hset(patient_id, mapping=patient_hash(rng, now_year))
+
+    points = []
+    for lab, rate in args.lab_rates.items():
+        key = f"patient:{patient_id}:{lab}"
+        labels = ('LABELS', 'patient', patient_id, 'lab', lab)
+        pipe.execute_command('TS.CREATE', key, 'DUPLICATE_POLICY', 'LAST', *labels)
+        for aggregation, bucket_label, bucket_ms in COMPACTIONS:
+            compacted = f"{key}:{aggregation}:{bucket_label}"
+            pipe.execute_command(
+                'TS.CREATE', compacted, *labels, 'aggregation', aggregation, 'bucket', bucket_label
+            )
+            pipe.execute_command('TS.CREATERULE', key, compacted, 'AGGREGATION', aggregation, bucket_ms)
+        points.extend((key, ts, value) for ts, value in lab_samples(rng, lab, rate, args.days, now_ms))
+
+    for slot, names in medication_plan(rng, args.medication_list, args.medications).items():
+        for position, name in enumerate(names, start=1):
+            pipe.hset(f"medication:{{{patient_id}}}:{slot}:{position}", mapping={
+                "patient": patient_id,
+                "slot": slot,
+                "position": position,
+                "name": name,
+            })
+    return points
+
+
+def execute_ignoring_existing(pipe):
+    """Execute a pipeline, tolerating series and rules that already exist"""
+    for result in pipe.execute(raise_on_error=False):
+        if isinstance(result, redis.ResponseError) and \
+                'already exists' not in str(result) and 'already has' not in str(result):
+            raise result
+
+
+def populate(client, args):
+    """
+    Write the synthetic ward.
+
+    Returns:
+        tuple: (patients, lab points) written.
+    """
+    rng = random.Random(args.seed)
+    now_ms = int(time.time() * 1000)
+    now_year = time.localtime().tm_year
+    create_medication_index(client)
+
+    total_points = 0
+    for batch_start in range(0, args.patients, args.batch_size):
+        batch_end = min(batch_start + args.batch_size, args.patients)
+        pipe = client.pipeline(transaction=False)
+        points = []
+        for i in range(batch_start, batch_end):
+            points.extend(queue_patient(pipe, f"{args.id_prefix}{i:06d}", rng, args, now_ms, now_year))
+        execute_ignoring_existing(pipe)
+
+        pipe = client.pipeline(transaction=False)
+        for start in range(0, len(points), args.points_per_call):
+            chunk = points[start:start + args.points_per_call]
+            pipe.execute_command('TS.MADD', *[part for point in chunk for part in point])
+        pipe.execute()
+
+        total_points += len(points)
+        print(f"{batch_end}/{args.patients} patients, {total_points} lab points")
+    return args.patients, total_points
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--patients", type=int, default=1, help="Number of patients (default 1)")
+    parser.add_argument("--days", type=int, default=5, help="Days of lab history (default 5)")
+    parser.add_argument("--lab-rate", type=parse_lab_rate, action="append", dest="lab_rates",
+                        metavar="LAB=PER_DAY",
+                        help=f"Samples per day of a lab value, repeatable (default 1 for {', '.join(LABS)})")
+    parser.add_argument("--medications", type=int, default=5,
+                        help="Medications per patient and slot (default 5)")
+    parser.add_argument("--medication-file",
+                        help="Text file with one medication per line, replaces the built-in list")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible wards")
+    parser.add_argument("--id-prefix", default="SIM", help="Prefix of the alphanumeric patient IDs")
+    parser.add_argument("--batch-size", type=int, default=500, help="Patients per pipeline (default 500)")
+    parser.add_argument("--points-per-call", type=int, default=10000,
+                        help="Samples per TS.MADD call (default 10000)")
+    args = parser.parse_args(argv)
+
+    if not args.id_prefix.isalnum():
+        parser.error("--id-prefix must be alphanumeric")
+    if min(args.patients, args.days, args.batch_size, args.points_per_call) <= 0:
+        parser.error("--patients, --days, --batch-size and --points-per-call must be positive")
+    args.lab_rates = dict(args.lab_rates or [(lab, 1.0) for lab in LABS])
+    if args.medication_file:
+        with open(args.medication_file, encoding="utf-8") as f:
+            args.medication_list = [line.strip() for line in f if line.strip()]
+    else:
+        args.medication_list = MEDICATIONS
+    return args
+
 
 if __name__ == "__main__":
+    args = parse_args()
+    # Connect to Redis
+    r = redis.Redis(host=args.host, port=args.port, decode_responses=True)
     print("Populating Redis with sample data...")
-    populate_patient_data()
-    populate_medication_data()
-    print("Data population complete!")
\ No newline at end of file
+    started = time.perf_counter()
+    patients, points = populate(r, args)
+    seconds = time.perf_counter() - started
+    print(f"Data population complete! {patients} patients and {points} lab points "
+          f"in {seconds:.1f}s ({points / seconds:.0f} points/s)")
@@ -0,0 +1,326 @@
+"""
+File: svm_approximate.py
+Description: Scalable approximate alternative to the exact RBF SVC of svm_training.py
+
+An exact SVC needs between O(n^2) and O(n^3) time in the number of samples,
+which is why svm_first_attempts.py downsamples each class to 1000 rows. Here
+the RBF kernel is approximated by an explicit feature map (Nystroem or random
+Fourier features via RBFSampler) and a linear SVM (hinge loss) is trained with
+SGD, one mini-batch at a time via partial_fit. Time and memory grow linearly
+with the number of samples, so the full ~30k-row credit dataset and the OKIE
+cohort are used without downsampling.
+
+The encoder, scaler and kernel map are fitted on the first chunk only, the
+later chunks just update the linear model; chunks can therefore be streamed
+from the Parquet cache of svm_training.py (see parquet_chunks).
+
+The benchmark compares accuracy, fit time and peak memory of both modes across
+data sizes. Peak memory is measured with tracemalloc, which sees numpy arrays
+but not the native buffers of libsvm, so the kernel cache of the exact SVC
+(200 MB at most by default) comes on top of its figure.
+
+Usage:
+    python svm_approximate.py --dataset credit --sizes 2000 5000 10000 0
+    python svm_approximate.py --dataset okie --output okie_benchmark.json
+    python svm_approximate.py --stream --chunk-size 2000
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.kernel_approximation import Nystroem, RBFSampler
+from sklearn.linear_model import SGDClassifier
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline
+
+import svm_training
+from okie_cohort import OKIE_CSV, load_okie
+
+OKIE_TARGET = 'LONG_STAY'
+OKIE_CATEGORICAL = ['station']
+
+# Identifiers, study bookkeeping and what is only known after the operation
+OKIE_EXCLUDED = ['id', 'eve', 'secrecy', 'dropout', 'deletion',
+                 'los_days', 'los_icu', 'cut_to_suture']
+OKIE_EXCLUDED_PARTS = ('postop', 'followup', 'discharge')
+
+KERNELS = {'nystroem': Nystroem, 'rbf': RBFSampler}
+
+
+def load_okie_cohort(path=OKIE_CSV, long_stay_days=10):
+    """
+    Load the OKIE cohort for classifying a long hospital stay.
+
+    Features are the numeric values known before the operation plus the
+    station. Patients without a length of stay are left out.
+
+    Returns:
+        tuple: (X, y, categorical columns)
+    """
+    df = load_okie(path)
+    df = df.loc[df['los_days'].notna()]
+    y = (df['los_days'] > long_stay_days).astype(int).rename(OKIE_TARGET)
+    numeric = [
+        column for column in df.select_dtypes('number').columns
+        if column not in OKIE_EXCLUDED and not any(part in column for part in OKIE_EXCLUDED_PARTS)
+    ]
+    # sklearn expects NaN instead of the pd.NA of the nullable integer columns
+    X = pd.concat([
+        df[OKIE_CATEGORICAL].astype(object).where(df[OKIE_CATEGORICAL].notna(), np.nan),
+        df[numeric].astype('float32'),
+    ], axis=1)
+    return X, y, OKIE_CATEGORICAL
+
+
+def load_credit(cache_dir=svm_training.CACHE_DIR):
+    """The full credit default dataset as (X, y, categorical columns)"""
+    X, y = svm_training.split_features(svm_training.clean(svm_training.load_credit_default(cache_dir)))
+    return X, y, svm_training.CATEGORICAL
+
+
+def parquet_chunks(path, chunk_size, columns=None):
+    """Yield DataFrames of at most `chunk_size` rows read from a Parquet file"""
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+        yield batch.to_pandas()
+
+
+def frame_chunks(X, y, chunk_size):
+    for start in range(0, len(X), chunk_size):
+        yield X.iloc[start:start + chunk_size], y.iloc[start:start + chunk_size]
+
+
+class StreamingKernelSVM(ClassifierMixin, BaseEstimator):
+    """
+    Linear SVM on an approximate RBF feature map, trained in mini-batches.
+
+    Args:
+        categorical (list): Columns to one-hot encode.
+        kernel (str): nystroem or rbf (random Fourier features).
+        n_components (int): Dimension of the feature map.
+        gamma (float): RBF gamma, None uses 1 / number of encoded features
+            (what gamma='scale' of SVC amounts to on standardized features).
+        alpha (float): Regularization of the linear SVM, roughly 1 / (C * n_samples).
+        epochs (int): Passes over the data in fit.
+        chunk_size (int): Rows per partial_fit call in fit.
+        random_state (int): Seed of the feature map and SGD.
+    """
+
+    def __init__(self, categorical=svm_training.CATEGORICAL, kernel='nystroem', n_components=300,
+                 gamma=None, alpha=1e-4, epochs=5, chunk_size=2000, random_state=42):
+        self.categorical = categorical
+        self.kernel = kernel
+        self.n_components = n_components
+        self.gamma = gamma
+        self.alpha = alpha
+        self.epochs = epochs
+        self.chunk_size = chunk_size
+        self.random_state = random_state
+
+    def _fit_features(self, X):
+        """Fit encoder, scaler and kernel map on the first chunk"""
+        if self.kernel not in KERNELS:
+            raise ValueError(f"kernel must be one of {', '.join(KERNELS)}")
+        preprocessing = Pipeline(svm_training.preprocessing_steps(self.categorical)).fit(X)
+        encoded = preprocessing.transform(X)
+        gamma = self.gamma if self.gamma is not None else 1.0 / encoded.shape[1]
+        n_components = self.n_components
+        if self.kernel == 'nystroem':
+            n_components = min(n_components, len(X))
+        kernel_map = KERNELS[self.kernel](gamma=gamma, n_components=n_components,
+                                          random_state=self.random_state).fit(encoded)
+        self.features_ = Pipeline(preprocessing.steps + [('kernel', kernel_map)])
+        self.classifier_ = SGDClassifier(loss='hinge', alpha=self.alpha,
+                                         random_state=self.random_state)
+
+    def partial_fit(self, X, y, classes=None):
+        """
+        Update the model with one chunk.
+
+        The first call fits the feature map on its chunk and needs `classes`.
+        """
+        if not hasattr(self, 'features_'):
+            if classes is None:
+                raise ValueError('classes must be given with the first chunk')
+            self._fit_features(X)
+        self.classifier_.partial_fit(self.features_.transform(X), y, classes=classes)
+        self.classes_ = self.classifier_.classes_
+        return self
+
+    def fit(self, X, y):
+        rng = np.random.default_rng(self.random_state)
+        for attribute in ('features_', 'classifier_'):
+            self.__dict__.pop(attribute, None)
+        classes = np.unique(y)
+        for _ in range(self.epochs):
+            order = rng.permutation(len(X))
+            for X_chunk, y_chunk in frame_chunks(X.iloc[order], y.iloc[order], self.chunk_size):
+                self.partial_fit(X_chunk, y_chunk, classes=classes)
+        return self
+
+    def decision_function(self, X):
+        return self.classifier_.decision_function(self.features_.transform(X))
+
+    def predict(self, X):
+        return self.classifier_.predict(self.features_.transform(X))
+
+
+def measure(fit):
+    """
+    Run `fit` and return (fit seconds, peak traced memory in MB).
+    """
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        fit()
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak / 2 ** 20
+
+
+def subsample(X, y, size, random_state):
+    """Stratified sample of `size` rows, all rows for 0 or a size above the total"""
+    if not size or size >= len(X):
+        return X, y
+    X, _, y, _ = train_test_split(X, y, train_size=size, stratify=y, random_state=random_state)
+    return X, y
+
+
+def benchmark(X, y, categorical, sizes, kernels=tuple(KERNELS), exact_max_samples=None,
+              test_size=0.3, random_state=42, **approximate_params):
+    """
+    Compare the exact SVC with the approximate models across data sizes.
+
+    Args:
+        X, y: The full dataset.
+        categorical (list): Columns to one-hot encode.
+        sizes (list): Numbers of rows to use, 0 for all of them.
+        kernels (tuple): Approximations to compare, see KERNELS.
+        exact_max_samples (int): Skip the exact SVC above this many rows.
+        **approximate_params: Further parameters of StreamingKernelSVM.
+
+    Yields:
+        dict: model, samples, fit_seconds, peak_mb and test accuracy.
+    """
+    for size in sizes:
+        X_size, y_size = subsample(X, y, size, random_state)
+        X_train, X_test, y_train, y_test = train_test_split(
+            X_size, y_size, test_size=test_size, stratify=y_size, random_state=random_state
+        )
+        models = {}
+        if exact_max_samples is None or len(X_size) <= exact_max_samples:
+            models['svc'] = svm_training.build_pipeline(categorical, random_state=random_state)
+        for kernel in kernels:
+            models[kernel] = StreamingKernelSVM(categorical, kernel=kernel,
+                                                random_state=random_state, **approximate_params)
+        for name, model in models.items():
+            seconds, peak_mb = measure(lambda: model.fit(X_train, y_train))
+            yield {
+                'model': name,
+                'samples': len(X_size),
+                'fit_seconds': round(seconds, 3),
+                'peak_mb': round(peak_mb, 1),
+                'accuracy': round(float(model.score(X_test, y_test)), 4),
+            }
+
+
+def stream_credit(cache_dir, chunk_size, test_every=10, random_state=42, **approximate_params):
+    """
+    Train on the Parquet cache of the credit dataset without loading it at once.
+
+    Every `test_every`-th client (by ID) is held out for testing.
+
+    Returns:
+        dict: Rows trained on, fit seconds, peak memory in MB and test accuracy.
+    """
+    path = Path(cache_dir) / 'credit_default.parquet'
+    if not path.exists():
+        svm_training.load_credit_default(cache_dir)
+    model = StreamingKernelSVM(random_state=random_state, chunk_size=chunk_size, **approximate_params)
+    held_out = []
+    trained = 0
+
+    def fit():
+        nonlocal trained
+        for chunk in parquet_chunks(path, chunk_size):
+            test = chunk['ID'] % test_every == 0
+            X, y = svm_training.split_features(svm_training.clean(chunk))
+            test = test.loc[X.index]
+            held_out.append((X[test], y[test]))
+            model.partial_fit(X[~test], y[~test], classes=np.array([0, 1]))
+            trained += int((~test).sum())
+
+    seconds, peak_mb = measure(fit)
+    X_test = pd.concat([X for X, _ in held_out])
+    y_test = pd.concat([y for _, y in held_out])
+    return {
+        'model': f'{model.kernel} (streamed)',
+        'samples': trained,
+        'fit_seconds': round(seconds, 3),
+        'peak_mb': round(peak_mb, 1),
+        'accuracy': round(float(model.score(X_test, y_test)), 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the approximate SVM against the exact SVC')
+    parser.add_argument('--dataset', choices=['credit', 'okie', 'both'], default='both')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 5000, 10000, 0],
+                        help='Rows per run, 0 uses the whole dataset (default 1000 2000 5000 10000 0)')
+    parser.add_argument('--kernels', nargs='+', choices=list(KERNELS), default=list(KERNELS))
+    parser.add_argument('--n-components', type=int, default=300, help='Dimension of the feature map')
+    parser.add_argument('--alpha', type=float, default=1e-4, help='Regularization of the linear SVM')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--chunk-size', type=int, default=2000, help='Rows per partial_fit call')
+    parser.add_argument('--exact-max-samples', type=int, default=None,
+                        help='Skip the exact SVC above this many rows')
+    parser.add_argument('--long-stay-days', type=int, default=10,
+                        help='OKIE target: length of stay above this many days')
+    parser.add_argument('--stream', action='store_true',
+                        help='Train on the credit Parquet cache chunk by chunk instead')
+    parser.add_argument('--cache-dir', default=svm_training.CACHE_DIR, type=Path)
+    parser.add_argument('--output', type=Path, help='Write the results as JSON')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    approximate_params = {'n_components': args.n_components, 'alpha': args.alpha}
+    if args.stream:
+        results = [dict(stream_credit(args.cache_dir, args.chunk_size, random_state=args.seed,
+                                      **approximate_params), dataset='credit')]
+    else:
+        datasets = {}
+        if args.dataset in ('credit', 'both'):
+            datasets['credit'] = load_credit(args.cache_dir)
+        if args.dataset in ('okie', 'both'):
+            datasets['okie'] = load_okie_cohort(long_stay_days=args.long_stay_days)
+
+        results = []
+        for name, (X, y, categorical) in datasets.items():
+            # Sizes above the dataset all mean the full dataset, run it once
+            sizes = sorted({min(size or len(X), len(X)) for size in args.sizes})
+            for row in benchmark(X, y, categorical, sizes, args.kernels, args.exact_max_samples,
+                                 random_state=args.seed, epochs=args.epochs,
+                                 chunk_size=args.chunk_size, **approximate_params):
+                row['dataset'] = name
+                results.append(row)
+                print(f"{name:>6} {row['model']:>9} {row['samples']:>6} rows: "
+                      f"{row['fit_seconds']:8.2f}s {row['peak_mb']:8.1f} MB accuracy {row['accuracy']:.3f}")
+
+    report = pd.DataFrame(results)[['dataset', 'model', 'samples', 'fit_seconds', 'peak_mb', 'accuracy']]
+    print(report.to_string(index=False))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    main()